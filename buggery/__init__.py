@@ -1,5 +1,5 @@
-import utils
-from debug import Debugger
+import sys
+import types
 
 
 class error(Exception):
@@ -7,3 +7,37 @@ class error(Exception):
 
 class DebuggerException(error):
     pass
+
+
+# name -> (submodule, attribute or None for the module itself)
+#
+# Nothing here is imported until it is first used, so `import buggery`
+# doesn't load comtypes, generate the DbgEng bindings or look for the engine.
+_LAZY = {
+    'Debugger': ('debug', 'Debugger'),
+    'debug': ('debug', None),
+    'idebug': ('idebug', None),
+    'utils': ('utils', None),
+}
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        try:
+            modname, attr = _LAZY[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        module = __import__("%s.%s" % (self.__name__, modname), fromlist=[modname])
+        value = module if attr is None else getattr(module, attr)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY))
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# keep the real module alive, python 2 clears a module's globals when it goes
+_module._real_module = sys.modules[__name__]
+sys.modules[__name__] = _module
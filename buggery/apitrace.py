@@ -0,0 +1,358 @@
+'''ltrace for Windows: hook exports, decode their arguments, log the calls.
+
+Prototypes come from a spec file, one C-ish declaration a line:
+
+    # ret [callconv] module!function(type [name], ...)
+    handle kernel32!CreateFileW(wstr lpFileName, dword dwDesiredAccess, dword, ptr, dword, dword, handle)
+    int __stdcall ws2_32!recv(socket s, outbuf(ret) buf, int len, int flags)
+    bool kernel32!WriteFile(handle, buf(nNumberOfBytesToWrite) lpBuffer, dword nNumberOfBytesToWrite, ptr, ptr)
+
+Types are the integer names below, ptr/handle/socket/size_t (pointer
+sized), str and wstr (NUL terminated strings), buf(len) (decoded on entry)
+and outbuf(len) (decoded on return). len names another argument, gives its
+position, or is "ret" for the return value. Calling conventions are
+__stdcall, __cdecl and __win64; on x64 everything is __win64 anyway.
+
+    protos = apitrace.load_spec("win32.spec")
+    tracer = apitrace.ApiTracer(dbg, protos, "trace.bin", budget=2000)
+    tracer.hook()
+    ...
+    tracer.close()
+    print tracer.stats()
+
+Render the log with tracelog.py. Every hook is a deferred breakpoint tagged
+with its function name, so DLLs that load late cost nothing until they do.
+budget bounds what tracing costs: a function hit more than `budget` times
+in `window` seconds has its hook disabled for `cooloff` seconds. The
+time spent decoding and logging is measured per function, see stats().
+'''
+import re
+import sys
+import time
+from collections import namedtuple
+
+import hookers
+import tracelog
+
+
+class SpecError(RuntimeError): pass
+
+
+# name -> (size, signed), size None is pointer sized
+INTEGERS = {
+    'int8': (1, True), 'uint8': (1, False), 'byte': (1, False),
+    'char': (1, True), 'uchar': (1, False),
+    'int16': (2, True), 'uint16': (2, False), 'word': (2, False),
+    'short': (2, True), 'ushort': (2, False),
+    'int32': (4, True), 'uint32': (4, False), 'dword': (4, False),
+    'int': (4, True), 'uint': (4, False), 'long': (4, True),
+    'ulong': (4, False), 'bool': (4, True), 'ntstatus': (4, False),
+    'int64': (8, True), 'uint64': (8, False), 'qword': (8, False),
+    'ptr': (None, False), 'handle': (None, False), 'socket': (None, False),
+    'size_t': (None, False),
+}
+STRINGS = ('str', 'wstr')
+BUFFERS = ('buf', 'outbuf')
+CALLCONVS = ('__stdcall', '__cdecl', '__win64')
+
+TAG = "apitrace"
+
+
+Arg = namedtuple("Arg", "name, type, ref")
+
+class Prototype(namedtuple("Prototype", "module, name, callconv, args, ret")):
+    @property
+    def fullname(self):
+        return "%s!%s" % (self.module, self.name)
+
+    @property
+    def outs(self):
+        return [arg for arg in self.args if arg.type == 'outbuf']
+
+    def header(self):
+        '''what tracelog needs to know to render the records'''
+        return {"name": self.fullname, "ret": self.ret,
+                "args": [(arg.name, arg.type) for arg in self.args],
+                "outs": [(arg.name, arg.type) for arg in self.outs]}
+
+
+_DECL = re.compile(r"^(?P<ret>\w+)\s+(?:(?P<cc>__\w+)\s+)?"
+                   r"(?P<module>[\w.]+)!(?P<name>[\w@?$]+)\s*"
+                   r"\((?P<args>.*)\)\s*;?$")
+_ARG = re.compile(r"^(?P<type>\w+)(?:\(\s*(?P<ref>\w+)\s*\))?(?:\s+(?P<name>\w+))?$")
+
+
+def parse_prototype(line):
+    m = _DECL.match(line.strip())
+    if m is None:
+        raise SpecError("Not a prototype: %r" % line)
+
+    ret, callconv = m.group("ret"), m.group("cc") or "__stdcall"
+    if ret != "void" and ret not in INTEGERS:
+        raise SpecError("Bad return type %r" % ret)
+    if callconv not in CALLCONVS:
+        raise SpecError("Unsupported calling convention %r" % callconv)
+
+    args = []
+    text = m.group("args").strip()
+    if text and text != "void":
+        for i, part in enumerate(text.split(",")):
+            am = _ARG.match(part.strip())
+            if am is None:
+                raise SpecError("Bad argument %r" % part.strip())
+            typ, ref = am.group("type"), am.group("ref")
+            if typ not in INTEGERS and typ not in STRINGS and typ not in BUFFERS:
+                raise SpecError("Unknown type %r" % typ)
+            if (typ in BUFFERS) != (ref is not None):
+                raise SpecError("%s: only buf and outbuf take a length" % typ)
+            args.append(Arg(am.group("name") or "arg%d" % i, typ, ref))
+
+    names = [arg.name for arg in args]
+    for i, arg in enumerate(args):
+        if arg.ref is None:
+            continue
+        if arg.ref == "ret":
+            if arg.type != "outbuf" or ret == "void":
+                raise SpecError("%s: only an outbuf can take its length from the return value" % arg.name)
+            continue
+        if arg.ref.isdigit():
+            index = int(arg.ref)
+        elif arg.ref in names:
+            index = names.index(arg.ref)
+        else:
+            raise SpecError("%s: no argument %r" % (arg.name, arg.ref))
+        if index >= len(args) or args[index].type not in INTEGERS:
+            raise SpecError("%s: length argument %r isn't an integer" % (arg.name, arg.ref))
+        args[i] = arg._replace(ref=index)
+
+    return Prototype(m.group("module").lower(), m.group("name"), callconv,
+                     tuple(args), ret)
+
+
+def parse_spec(text):
+    protos = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            protos.append(parse_prototype(line))
+        except SpecError, e:
+            raise SpecError("line %d: %s" % (lineno, e))
+    return protos
+
+
+def load_spec(path):
+    with open(path, "rb") as fp:
+        return parse_spec(fp.read())
+
+
+def _convert(value, size, signed):
+    value &= (1 << (size * 8)) - 1
+    if signed and value >> (size * 8 - 1):
+        value -= 1 << (size * 8)
+    return value
+
+
+class CallStats(object):
+    __slots__ = ('calls', 'returns', 'overhead', 'worst', 'throttled',
+                 'window_start', 'window_calls', 'disabled_until')
+
+    def __init__(self):
+        self.calls = 0
+        self.returns = 0
+        self.overhead = 0.0
+        self.worst = 0.0
+        self.throttled = 0
+        self.window_start = 0.0
+        self.window_calls = 0
+        self.disabled_until = None
+
+
+class ApiTracer(object):
+    '''
+    protos: [Prototype, ...], see load_spec()
+    path: where the binary log goes
+    max_string/max_buffer: cap on what is read per string/buffer argument
+    budget/window/cooloff: see the module docstring, budget None is no cap
+    '''
+    # time.clock() is the high resolution one on Windows
+    timer = time.clock if sys.platform == "win32" else time.time
+
+    def __init__(self, dbg, protos, path, max_string=256, max_buffer=64,
+                 budget=None, window=1.0, cooloff=5.0):
+        self.dbg = dbg
+        self.protos = list(protos)
+        self.max_string = max_string
+        self.max_buffer = max_buffer
+        self.budget = budget
+        self.window = window
+        self.cooloff = cooloff
+
+        self.log = tracelog.TraceWriter(path, [p.header() for p in self.protos])
+        self.calls = [CallStats() for p in self.protos]
+        self._sandwiches = []
+        self._callid = 0
+        self._disabled = set()
+        self._x64 = None
+        self._argstrs = None
+
+    def hook(self):
+        for index, proto in enumerate(self.protos):
+            sandwich = hookers.FunctionSandwich(self.dbg, proto.fullname,
+                                    self._on_enter, self._on_exit, index)
+            sandwich.inject(deferred=True, tags=(TAG, proto.fullname))
+            self._sandwiches.append(sandwich)
+        if self.budget is not None:
+            self.dbg.add_poller(self._poll)
+
+    def unhook(self):
+        for sandwich in self._sandwiches:
+            sandwich.remove()
+        self._sandwiches = []
+        if self.budget is not None:
+            self.dbg.remove_poller(self._poll)
+
+    def close(self):
+        self.unhook()
+        self.log.close()
+
+    # argument layout, worked out on the first hit when the target's
+    # pointer size is known
+    def _slot_code(self, typ):
+        if self._x64:
+            return "Q"
+        size = INTEGERS.get(typ, (None, False))[0]
+        return "Q" if size == 8 else "I"
+
+    def _setup(self):
+        self._x64 = self.dbg.control.is_pointer_64bit()
+        self.ptr_size = 8 if self._x64 else 4
+        self._argstrs = ["<" + "".join(self._slot_code(arg.type) for arg in proto.args)
+                         for proto in self.protos]
+
+    # decoding
+    def _read_string(self, address, wide):
+        if not address:
+            return None
+        if wide:
+            return self.dbg.addrspace.read_wstring(address, self.max_string)
+        return self.dbg.addrspace.read_cstring(address, self.max_string)
+
+    def _read_buffer(self, address, size):
+        if not address:
+            return None
+        return bytearray(self.dbg.dataspaces.read(address, min(size, self.max_buffer)))
+
+    def _decode(self, arg, value, raw):
+        try:
+            if arg.type in INTEGERS:
+                size, signed = INTEGERS[arg.type]
+                return _convert(value, size or self.ptr_size, signed)
+            if arg.type in STRINGS:
+                return self._read_string(value, arg.type == 'wstr')
+            if arg.type == 'buf':
+                return self._read_buffer(value, raw[arg.ref])
+            # outbuf, the pointer now, the contents on return
+            return value
+        except Exception, e:
+            return tracelog.Unreadable(str(e))
+
+    # hooks
+    def _throttle(self, index, stats, now):
+        if now - stats.window_start >= self.window:
+            stats.window_start, stats.window_calls = now, 0
+        stats.window_calls += 1
+        if stats.window_calls <= self.budget:
+            return False
+        stats.throttled += 1
+        stats.disabled_until = now + self.cooloff
+        self._disabled.add(index)
+        self.dbg.breakpoints.disable(tag=self.protos[index].fullname)
+        return True
+
+    def _poll(self):
+        if not self._disabled:
+            return
+        now = time.time()
+        for index in list(self._disabled):
+            stats = self.calls[index]
+            if now >= stats.disabled_until:
+                stats.disabled_until = None
+                self._disabled.discard(index)
+                self.dbg.breakpoints.enable(tag=self.protos[index].fullname)
+
+    def _account(self, stats, start):
+        spent = self.timer() - start
+        stats.overhead += spent
+        if spent > stats.worst:
+            stats.worst = spent
+
+    def _on_enter(self, index):
+        start = self.timer()
+        if self._argstrs is None:
+            self._setup()
+        proto = self.protos[index]
+        stats = self.calls[index]
+        stats.calls += 1
+
+        now = time.time()
+        if self.budget is not None and self._throttle(index, stats, now):
+            self._account(stats, start)
+            return hookers.FunctionSandwich.SKIP
+
+        raw = self.dbg.read_args(self._argstrs[index]) if proto.args else ()
+        values = [self._decode(arg, raw[i], raw) for i, arg in enumerate(proto.args)]
+        tid = self.dbg.systemobjects.get_event_thread()
+        self._callid = callid = (self._callid + 1) & 0xffffffff
+        self.log.write(tracelog.ENTER, index, tid, callid, now, values)
+
+        self._account(stats, start)
+        if proto.ret == "void" and not proto.outs:
+            return hookers.FunctionSandwich.SKIP
+        return (index, tid, callid, raw)
+
+    def _on_exit(self, retval, retargs):
+        start = self.timer()
+        index, tid, callid, raw = retargs
+        proto = self.protos[index]
+        stats = self.calls[index]
+        stats.returns += 1
+
+        values = [None]
+        if proto.ret != "void":
+            size, signed = INTEGERS[proto.ret]
+            size = size or self.ptr_size
+            if size == 8 and not self._x64:
+                retval |= self.dbg.registers["edx"] << 32
+            values[0] = _convert(retval, size, signed)
+
+        for i, arg in enumerate(proto.args):
+            if arg.type != 'outbuf':
+                continue
+            length = values[0] if arg.ref == "ret" else raw[arg.ref]
+            try:
+                values.append(self._read_buffer(raw[i], max(length or 0, 0)))
+            except Exception, e:
+                values.append(tracelog.Unreadable(str(e)))
+
+        self.log.write(tracelog.EXIT, index, tid, callid, time.time(), values)
+        self._account(stats, start)
+
+    def stats(self):
+        '''stats() -> [dict, ...], the most expensive function first
+
+        overhead/worst are seconds spent in the tracer's own callbacks,
+        mean is per traced call.
+        '''
+        rows = []
+        for proto, stats in zip(self.protos, self.calls):
+            if not stats.calls:
+                continue
+            rows.append({'function': proto.fullname, 'calls': stats.calls,
+                         'returns': stats.returns,
+                         'throttled': stats.throttled,
+                         'overhead': stats.overhead, 'worst': stats.worst,
+                         'mean': stats.overhead / stats.calls})
+        rows.sort(key=lambda row: row['overhead'], reverse=True)
+        return rows
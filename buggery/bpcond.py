@@ -0,0 +1,193 @@
+'''Breakpoint conditions evaluated by the engine instead of in Python.
+
+A condition is a small Python-looking predicate over registers, memory and
+the thread id:
+
+    rcx == 0x10 and [rdx+8] != 0
+    tid == 0x1a4 and dword[esp+4] > 0x100
+
+    name        a register (@name), or one of the pseudo registers below
+    [expr]      pointer sized read (poi)
+    byte[expr], word[expr], dword[expr], qword[expr], ptr[expr]
+    + - * / % & | ^ << >>, comparisons, and/or/not, unary - and ~
+
+It compiles to a MASM expression. Debugger.breakpoint(condition=...)
+evaluates that in the engine on every hit and only calls the Python
+callback when it holds: DbgEng calls the event callbacks before it runs a
+breakpoint's command, so every hit still leaves the engine, and what is
+saved is the callback's own work. breakpoint_command() wraps the expression
+in a command which resumes the target when the condition is false; that
+keeps false hits inside the engine only for breakpoints no event callback
+answers, e.g. ones set with `bp` through Debugger.execute(). Nothing here
+touches the engine.
+'''
+import ast
+
+try:
+    long
+except NameError:
+    long = int
+
+
+class ConditionError(RuntimeError): pass
+
+
+PSEUDO_REGISTERS = {
+    'tid': '@$tid',
+    'pid': '@$tpid',
+    'ip': '@$ip',
+    'pc': '@$ip',
+    'sp': '@$csp',
+    'retreg': '@$retreg',
+    'ra': '@$ra',
+}
+
+DEREFS = {
+    'byte': 'by',
+    'word': 'wo',
+    'dword': 'dwo',
+    'qword': 'qwo',
+    'ptr': 'poi',
+}
+
+_BINOPS = {
+    ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/', ast.FloorDiv: '/',
+    ast.Mod: '%', ast.BitAnd: '&', ast.BitOr: '|', ast.BitXor: '^',
+    ast.LShift: '<<', ast.RShift: '>>',
+}
+
+_CMPOPS = {
+    ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=',
+    ast.Gt: '>', ast.GtE: '>=',
+}
+
+_MASK64 = 0xffffffffffffffff
+
+
+class _Compiler(object):
+    def __init__(self, registers=None):
+        self.registers = registers
+
+    def boolean(self, node):
+        # `and`/`or` are bitwise in MASM, so make sure both sides are 0/1
+        if isinstance(node, (ast.BoolOp, ast.Compare)) or \
+           (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not)):
+            return self.expr(node)
+        return "(%s != 0)" % self.expr(node)
+
+    def expr(self, node):
+        if isinstance(node, ast.BoolOp):
+            op = ' and ' if isinstance(node.op, ast.And) else ' or '
+            return "(%s)" % op.join(self.boolean(v) for v in node.values)
+
+        if isinstance(node, ast.Compare):
+            left = self.expr(node.left)
+            parts = []
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in _CMPOPS:
+                    raise ConditionError("Unsupported comparison: %s" % type(op).__name__)
+                right = self.expr(comparator)
+                parts.append("(%s %s %s)" % (left, _CMPOPS[type(op)], right))
+                left = right
+            if len(parts) == 1:
+                return parts[0]
+            return "(%s)" % " and ".join(parts)
+
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return "(%s == 0)" % self.expr(node.operand)
+            if isinstance(node.op, ast.USub):
+                return "(-%s)" % self.expr(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return self.expr(node.operand)
+            if isinstance(node.op, ast.Invert):
+                return "(%s ^ 0x%x)" % (self.expr(node.operand), _MASK64)
+
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINOPS:
+                raise ConditionError("Unsupported operator: %s" % type(node.op).__name__)
+            return "(%s %s %s)" % (self.expr(node.left), _BINOPS[type(node.op)],
+                                   self.expr(node.right))
+
+        value = self.number(node)
+        if value is not None:
+            return "0x%x" % value
+
+        if isinstance(node, ast.Name):
+            return self.register(node.id)
+
+        if isinstance(node, ast.List):
+            if len(node.elts) != 1:
+                raise ConditionError("A dereference takes exactly one address")
+            return "poi(%s)" % self.expr(node.elts[0])
+
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+            if node.value.id not in DEREFS:
+                raise ConditionError("Unknown dereference size: %s" % node.value.id)
+            index = node.slice
+            if isinstance(index, getattr(ast, 'Index', ())):
+                index = index.value
+            if isinstance(index, ast.List) and len(index.elts) == 1:
+                index = index.elts[0]
+            return "%s(%s)" % (DEREFS[node.value.id], self.expr(index))
+
+        raise ConditionError("Unsupported expression: %s" % type(node).__name__)
+
+    def number(self, node):
+        if isinstance(node, getattr(ast, 'Constant', ())):
+            value = node.value
+        elif isinstance(node, getattr(ast, 'Num', ())):
+            value = node.n
+        else:
+            return None
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            raise ConditionError("Only integer constants are allowed: %r" % (value,))
+        if value < 0:
+            raise ConditionError("Negative constant: %r" % (value,))
+        return value
+
+    def register(self, name):
+        if name in ('True', 'False', 'None'):
+            # constants in python 3, names in python 2
+            raise ConditionError("Only integer constants are allowed: %s" % name)
+        lname = name.lower()
+        if lname in PSEUDO_REGISTERS:
+            return PSEUDO_REGISTERS[lname]
+        if lname in DEREFS:
+            raise ConditionError("%s needs an address: %s[...]" % (name, name))
+        if self.registers is not None and lname not in self.registers:
+            raise ConditionError("No such register: %s" % name)
+        return "@" + lname
+
+
+def compile_condition(source, registers=None):
+    '''compile_condition(source, registers=None) -> MASM expression
+
+    registers: optional collection of valid register names, e.g.
+               Debugger.registers.keys(), to catch typos up front
+    '''
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ConditionError("Bad condition %r: %s" % (source, e))
+    return _Compiler(registers).boolean(tree.body)
+
+
+def breakpoint_command(source, then='', style='j', registers=None):
+    '''breakpoint_command(source, then='', style='j') -> command string
+
+    The command resumes the target (gc) when the condition is false. When
+    it is true `then` runs; the default empty command leaves the target
+    broken in.
+
+    style='j'   j (cond) 'then'; 'gc'
+    style='if'  .if (cond) { then } .else { gc }
+    '''
+    cond = compile_condition(source, registers)
+    if style == 'j':
+        if "'" in then:
+            raise ConditionError("j command can't quote %r" % then)
+        return "j %s '%s'; 'gc'" % (cond, then)
+    if style == 'if':
+        return ".if %s { %s } .else { gc }" % (cond, then)
+    raise ConditionError("Unknown command style: %r" % (style,))
@@ -0,0 +1,240 @@
+'''Python side bookkeeping for the breakpoints a Debugger has set.
+
+Every ProcessContext has a BreakpointTable. It remembers what the engine
+would otherwise have to be asked for (id, offset, flags, type) and indexes
+the breakpoints by id, address, module and tag, so a hit is dispatched with
+one dict lookup and
+
+    dbg.breakpoints.disable(module=base)
+    dbg.breakpoints.remove_all(tag="heap")
+    [e.offset for e in dbg.breakpoints]
+
+don't make a COM call per breakpoint just to find them. One shot
+breakpoints leave the table when they fire, same as they leave the engine.
+sync() drops whatever the engine removed behind our back. Enable and
+disable single breakpoints with set_enabled(), not through the Breakpoint,
+or the flags the table remembers go stale.
+'''
+from comtypes import COMError
+
+import idebug
+
+
+class BreakpointEntry(object):
+    '''What the table knows about one breakpoint.
+
+    offset is None for a deferred breakpoint (an expression that doesn't
+    resolve yet), it is filled in the first time it hits.
+    '''
+    __slots__ = ('id', 'bp', 'offset', 'flags', 'type', 'module', 'tags',
+                 'callback')
+
+    def __init__(self, bp, offset, flags, type, module, tags, callback):
+        self.id = bp.id
+        self.bp = bp
+        self.offset = offset
+        self.flags = flags
+        self.type = type
+        self.module = module
+        self.tags = tags
+        self.callback = callback
+
+    @property
+    def enabled(self):
+        return bool(self.flags & idebug.DbgEng.DEBUG_BREAKPOINT_ENABLED)
+    @property
+    def oneshot(self):
+        return bool(self.flags & idebug.DbgEng.DEBUG_BREAKPOINT_ONE_SHOT)
+
+    def __repr__(self):
+        return "<BreakpointEntry id=%d offset=%s flags=0x%x tags=%r>" % (
+                self.id, "?" if self.offset is None else "0x%x" % self.offset,
+                self.flags, sorted(self.tags))
+
+
+class BreakpointTable(object):
+    def __init__(self, dbg, context=None):
+        self.dbg = dbg
+        self.context = context
+        self._entries = {}
+        self._by_address = {}
+        self._by_module = {}
+        self._by_tag = {}
+
+    def __len__(self):
+        return len(self._entries)
+    def __contains__(self, bpid):
+        return bpid in self._entries
+    def __getitem__(self, bpid):
+        return self._entries[bpid]
+    def __iter__(self):
+        return iter(self._entries.values())
+
+    def get(self, bpid, default=None):
+        return self._entries.get(bpid, default)
+
+    def at(self, address):
+        '''at(address) -> [BreakpointEntry, ...] set on address'''
+        return [self._entries[bpid] for bpid in self._by_address.get(address, ())]
+    def in_module(self, base):
+        '''in_module(base) -> [BreakpointEntry, ...] inside the module at base'''
+        return [self._entries[bpid] for bpid in self._by_module.get(base, ())]
+    def tagged(self, tag):
+        return [self._entries[bpid] for bpid in self._by_tag.get(tag, ())]
+
+    def select(self, module=None, tag=None):
+        '''select(module=None, tag=None) -> [BreakpointEntry, ...]
+
+        Everything when neither is given, both have to match when both are.
+        '''
+        if module is None and tag is None:
+            return self._entries.values()
+        ids = None
+        if module is not None:
+            ids = self._by_module.get(module, set())
+        if tag is not None:
+            tagged = self._by_tag.get(tag, set())
+            ids = tagged if ids is None else ids & tagged
+        return [self._entries[bpid] for bpid in ids]
+
+    # indexes
+    def _index(self, table, key, bpid):
+        if key is not None:
+            table.setdefault(key, set()).add(bpid)
+    def _unindex(self, table, key, bpid):
+        ids = table.get(key)
+        if ids is not None:
+            ids.discard(bpid)
+            if not ids:
+                del table[key]
+
+    def _module_of(self, offset):
+        if offset is None or self.context is None:
+            return None
+        module = self.context.module_at(offset)
+        return None if module is None else module.baseOffset
+
+    def _locate(self, entry, offset):
+        self._unindex(self._by_address, entry.offset, entry.id)
+        self._unindex(self._by_module, entry.module, entry.id)
+        entry.offset = offset
+        entry.module = self._module_of(offset)
+        self._index(self._by_address, entry.offset, entry.id)
+        self._index(self._by_module, entry.module, entry.id)
+
+    def add(self, bp, callback, args=(), kwargs=None, tags=()):
+        '''add(bp, callback, args, kwargs, tags) -> BreakpointEntry
+
+        bp is an idebug.Breakpoint the engine already has.
+        '''
+        try:
+            offset = bp.offset
+        except COMError:
+            # deferred
+            offset = None
+        entry = BreakpointEntry(bp, None, bp.flags, bp.type, None,
+                                set(tags), (callback, args, kwargs or {}))
+        self.discard(entry.id)
+        self._entries[entry.id] = entry
+        self._locate(entry, offset)
+        for tag in entry.tags:
+            self._index(self._by_tag, tag, entry.id)
+        return entry
+
+    def discard(self, bpid):
+        '''discard(bpid) -> BreakpointEntry or None
+
+        Forgets the breakpoint, the engine isn't touched.
+        '''
+        entry = self._entries.pop(bpid, None)
+        if entry is not None:
+            self._unindex(self._by_address, entry.offset, bpid)
+            self._unindex(self._by_module, entry.module, bpid)
+            for tag in entry.tags:
+                self._unindex(self._by_tag, tag, bpid)
+        return entry
+
+    def remove(self, bpid):
+        '''removes the breakpoint from the engine and the table'''
+        entry = self.discard(bpid)
+        try:
+            self.dbg.control.remove_breakpoint(bpid)
+        except COMError:
+            # already gone on the engine side
+            pass
+        return entry
+
+    def tag(self, bpid, *tags):
+        entry = self._entries[bpid]
+        for tag in tags:
+            entry.tags.add(tag)
+            self._index(self._by_tag, tag, bpid)
+
+    def set_enabled(self, bpid, enabled=True):
+        entry = self._entries[bpid]
+        flag = idebug.DbgEng.DEBUG_BREAKPOINT_ENABLED
+        if enabled:
+            entry.bp.enable()
+            entry.flags |= flag
+        else:
+            entry.bp.disable()
+            entry.flags &= ~flag
+
+    # bulk operations, see select() for the arguments
+    def enable(self, module=None, tag=None):
+        flag = idebug.DbgEng.DEBUG_BREAKPOINT_ENABLED
+        entries = self.select(module, tag)
+        for entry in entries:
+            if not entry.flags & flag:
+                entry.bp.enable()
+                entry.flags |= flag
+        return len(entries)
+
+    def disable(self, module=None, tag=None):
+        flag = idebug.DbgEng.DEBUG_BREAKPOINT_ENABLED
+        entries = self.select(module, tag)
+        for entry in entries:
+            if entry.flags & flag:
+                entry.bp.disable()
+                entry.flags &= ~flag
+        return len(entries)
+
+    def remove_all(self, module=None, tag=None):
+        entries = list(self.select(module, tag))
+        for entry in entries:
+            self.remove(entry.id)
+        return len(entries)
+
+    # keeping up with the engine
+    def dispatch(self, bp):
+        '''dispatch(bp) -> status from the callback, None if it isn't ours'''
+        entry = self._entries.get(bp.id)
+        if entry is None:
+            return None
+        if entry.offset is None:
+            try:
+                self._locate(entry, bp.offset)
+            except COMError:
+                pass
+        if entry.oneshot:
+            # the engine deletes it as soon as this event is over
+            self.discard(entry.id)
+        callback, args, kwargs = entry.callback
+        return callback(entry.bp, *args, **kwargs)
+
+    def module_unloaded(self, base):
+        '''the module at base is gone, its breakpoints are deferred now'''
+        for bpid in list(self._by_module.get(base, ())):
+            self._locate(self._entries[bpid], None)
+
+    def sync(self):
+        '''sync() -> [BreakpointEntry, ...] the engine no longer has'''
+        alive = self.dbg.control.get_breakpoint_ids()
+        return [self.discard(bpid) for bpid in list(self._entries)
+                if bpid not in alive]
+
+    def clear(self):
+        self._entries.clear()
+        self._by_address.clear()
+        self._by_module.clear()
+        self._by_tag.clear()
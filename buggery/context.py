@@ -0,0 +1,77 @@
+import debug
+import bptable
+
+
+class ProcessAddressSpace(debug.AddressSpace):
+    '''AddressSpace that makes its process the engine's current one first'''
+    def __init__(self, dbg, context):
+        super(ProcessAddressSpace, self).__init__(dbg)
+        self.context = context
+
+    def __getitem__(self, offset):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).__getitem__(offset)
+    def __setitem__(self, offset, buf):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).__setitem__(offset, buf)
+    def unpack(self, fmt, addr):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).unpack(fmt, addr)
+    def pack(self, fmt, addr, *args):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).pack(fmt, addr, *args)
+    def read_cstring(self, address, max=1024):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).read_cstring(address, max)
+    def read_wstring(self, address, max=1024):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).read_wstring(address, max)
+    def read_strings(self, addresses, max=1024, wide=False):
+        self.context.activate()
+        return super(ProcessAddressSpace, self).read_strings(addresses, max, wide)
+
+
+class ProcessContext(object):
+    '''Everything the Debugger keeps per debuggee process.
+
+    pid is the engine's process id (SystemObjects.get_event_process), not
+    the system one.
+
+    breakpoints: bptable.BreakpointTable of the breakpoints set in it
+    modules: module base -> LoadModuleEvent
+    caches: free for anything that has to be thrown away with the process
+    '''
+    def __init__(self, dbg, pid):
+        self.dbg = dbg
+        self.pid = pid
+        self.modules = {}
+        self.breakpoints = bptable.BreakpointTable(dbg, self)
+        self.caches = {}
+        self.exited = False
+        self.exit_code = None
+        self.addrspace = ProcessAddressSpace(dbg, self)
+
+    def __repr__(self):
+        return "<ProcessContext pid=%r modules=%d breakpoints=%d>" % (
+                self.pid, len(self.modules), len(self.breakpoints))
+
+    def activate(self):
+        '''make this the engine's current process'''
+        if self.pid is None:
+            return
+        sysobjs = self.dbg.systemobjects
+        if sysobjs.get_current_process_id() != self.pid:
+            sysobjs.set_current_process_id(self.pid)
+
+    def module_at(self, address):
+        '''module_at(address) -> LoadModuleEvent or None'''
+        for base, module in self.modules.iteritems():
+            if base <= address < base + module.moduleSize:
+                return module
+        return None
+
+    def teardown(self):
+        self.exited = True
+        self.breakpoints.clear()
+        self.modules.clear()
+        self.caches.clear()
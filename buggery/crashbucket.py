@@ -0,0 +1,146 @@
+import os
+import hashlib
+from collections import namedtuple
+
+import idebug
+
+
+CrashInfo = namedtuple("CrashInfo", "code, address, module, offset, frames, exact, fuzzy")
+
+
+class BucketStore(object):
+    '''Persistent set of crash bucket keys.
+
+    The on-disk index is an append-only log, one "<kind> <key>" line per new
+    bucket. It is read once into a set, after that a lookup never touches
+    the disk and only new buckets cost a write.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._seen = set()
+        self.hits = {}
+
+        if os.path.exists(path):
+            with open(path, "rb") as fp:
+                for line in fp:
+                    line = line.strip()
+                    if line:
+                        self._seen.add(line)
+        self._log = open(path, "ab")
+
+    def __contains__(self, key):
+        return key in self._seen
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, key):
+        '''add(key) -> True if the key was new'''
+        self.hits[key] = self.hits.get(key, 0) + 1
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._log.write(key + "\n")
+        self._log.flush()
+        return True
+
+    def close(self):
+        self._log.close()
+
+
+class CrashBucketer(object):
+    '''Buckets crashes by exception code, faulting module+offset and the top
+    of the stack, and only writes a dump for buckets it hasn't seen before.
+
+    exact := code, fault module+offset, top `frames` frames as module+offset
+    fuzzy := code, fault module+offset, modules of the top `fuzzy_frames`
+
+    dump_on selects which kind of new bucket triggers a dump ('exact' or
+    'fuzzy'). With index_path None there is no store, only bucket() works.
+    '''
+    def __init__(self, dbg, index_path, dumpdir=None, frames=8, fuzzy_frames=3,
+                 dump_on='exact', dump_mode=0, first_chance=False,
+                 on_crash=None):
+        self.dbg = dbg
+        self.store = None
+        if index_path is not None:
+            self.store = BucketStore(index_path)
+        self.dumpdir = dumpdir
+        self.frames = frames
+        self.fuzzy_frames = fuzzy_frames
+        self.dump_on = dump_on
+        self.dump_mode = dump_mode
+        self.first_chance = first_chance
+        self.on_crash = on_crash
+        self._modnames = {}
+
+    def install(self):
+        self._need_store()
+        self.dbg.set_event_handler('EXCEPTION', self.on_exception)
+
+    def _need_store(self):
+        if self.store is None:
+            raise RuntimeError("CrashBucketer has no index_path, only bucket() works")
+
+    def module_offset(self, address):
+        '''module_offset(address) -> (modulename, offset)'''
+        mod = self.dbg.symbols.get_module_by_offset(address)
+        if mod is None:
+            return ("?", address)
+        index, base = mod
+        try:
+            name = self._modnames[base]
+        except KeyError:
+            name = self.dbg.symbols.get_module_name(index, base)
+            self._modnames[base] = name
+        return (name, address - base)
+
+    def bucket(self, code, address):
+        module, offset = self.module_offset(address)
+        frames = [self.module_offset(fr.instruction)
+                  for fr in self.dbg.control.get_stack_trace(self.frames)]
+
+        fault = "%08x %s+%x" % (code, module, offset)
+        exact = [fault] + ["%s+%x" % fr for fr in frames]
+        fuzzy = [fault] + [name for name, off in frames[:self.fuzzy_frames]]
+
+        return CrashInfo(code, address, module, offset, frames,
+                         hashlib.sha1("|".join(exact)).hexdigest(),
+                         hashlib.sha1("|".join(fuzzy)).hexdigest())
+
+    def record(self, code=None, address=None):
+        '''record(code, address) -> (CrashInfo, new_exact, new_fuzzy)
+
+        Without a code/address the last event (see
+        Control.get_access_violation_event) is used.
+        '''
+        self._need_store()
+        if code is None:
+            evtype, pid, tid, exinfo = self.dbg.control.get_access_violation_event()
+            code, address = exinfo.code, exinfo.address
+
+        info = self.bucket(code, address)
+        new_fuzzy = self.store.add("F " + info.fuzzy)
+        new_exact = self.store.add("E " + info.exact)
+
+        if self.dumpdir is not None:
+            if (new_exact and self.dump_on == 'exact') or \
+               (new_fuzzy and self.dump_on == 'fuzzy'):
+                self.write_dump(info)
+        return info, new_exact, new_fuzzy
+
+    def write_dump(self, info):
+        if not os.path.isdir(self.dumpdir):
+            os.makedirs(self.dumpdir)
+        key = info.exact if self.dump_on == 'exact' else info.fuzzy
+        path = os.path.join(self.dumpdir, "%08x_%s.dmp" % (info.code, key))
+        self.dbg.writedump(path, self.dump_mode)
+        return path
+
+    def on_exception(self, event):
+        if event.firstchance and not self.first_chance:
+            return idebug.GO_NOT_HANDLED
+
+        info, new_exact, new_fuzzy = self.record(event.code, event.address)
+        if self.on_crash is not None:
+            return self.on_crash(event, info, new_exact, new_fuzzy)
+        return idebug.GO_NOT_HANDLED
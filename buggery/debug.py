@@ -1,6 +1,11 @@
 
 import idebug
+import bpcond
+import utils
+import re
 import sys
+import time
+import struct
 from contextlib import contextmanager
 
 
@@ -44,7 +49,25 @@ class DebugEventHandler(idebug.EventHandler):
             'INTERESTMASK': self.get_interest_mask,
             'BREAKPOINT': self._on_breakpoint,
         }
-        self._bp_callbacks = {}
+        self._callbacks = {}
+        self._hooks = {}
+        self._after_hooks = {}
+        # set by Debugger to route breakpoints to the right process
+        self.get_context = None
+        # set by Debugger, batched events are delivered in the process and
+        # thread they happened in
+        self.systemobjects = None
+        # batched delivery, see batch()
+        self._batched = frozenset()
+        self._pending = []
+        self._pending_since = None
+        self._batch_hooks = []
+        self.max_batch = 1024
+        self.max_delay = 0.25
+        self.counts = {}
+        self.batches = 0
+        # events delivered so far, batched ones as they are flushed
+        self.delivered = 0
 
     def get_interest_mask(self, ignored):
         return self.INTEREST_MASK
@@ -56,20 +79,175 @@ class DebugEventHandler(idebug.EventHandler):
         return bool(self.INTEREST_MASK & interest)
 
     def _on_breakpoint(self, bp):
-        if bp.id in self._bp_callbacks:
-            handler,args,kwargs = self._bp_callbacks[bp.id]
+        if self.get_context is not None:
+            return self.get_context().breakpoints.dispatch(bp)
+        if bp.id in self._callbacks:
+            handler,args,kwargs = self._callbacks[bp.id]
             return handler(bp, *args, **kwargs)
 
+    def add_hook(self, eventtype, hook, after=False):
+        '''add_hook(eventtype, hook, after=False)
+
+        Hooks run before the handler for `eventtype`, in the order they were
+        added. The first hook to return a status answers the event and the
+        handler isn't called. With after=True the hook runs after the
+        handler instead and its return value is ignored.
+        '''
+        hooks = self._after_hooks if after else self._hooks
+        hooks.setdefault(eventtype, []).append(hook)
+    def remove_hook(self, eventtype, hook, after=False):
+        hooks = self._after_hooks if after else self._hooks
+        hooks[eventtype].remove(hook)
+
+    # batching
+    #
+    # Thread and module lifecycle events can come by the thousand. Batched,
+    # they are answered at once and kept as raw argument tuples along with
+    # the engine process and thread ids they came from, then delivered in
+    # order, through the usual hooks and handlers and to the batch hooks as
+    # one list, before the next event that isn't batched, after every wait
+    # (Debugger flushes from a poller), or once there are max_batch of them
+    # or the oldest is max_delay seconds old. While an event is delivered
+    # its process and thread are the engine's current ones (an exited
+    # thread can't be made current, the ids in the batch still say which).
+    BATCHABLE = {
+        'CREATETHREAD': idebug.CreateThreadEvent,
+        'EXITTHREAD': None,
+        'LOADMODULE': idebug.LoadModuleEvent,
+        'UNLOADMODULE': idebug.UnloadModuleEvent,
+    }
+    # notifications, not stops, they don't flush
+    _PASSIVE = frozenset(['INTERESTMASK', 'DEBUGEESTATE', 'ENGINESTATE',
+                          'SYMBOLSTATE', 'SESSIONSTATUS'])
+
+    def batch(self, eventtypes, max_batch=None, max_delay=None):
+        for eventtype in eventtypes:
+            if eventtype not in self.BATCHABLE:
+                raise RuntimeError("%s events can't be batched" % eventtype)
+        self.flush()
+        self._batched = frozenset(eventtypes)
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if max_delay is not None:
+            self.max_delay = max_delay
+
+    def unbatch(self):
+        self.flush()
+        self._batched = frozenset()
+
+    def add_batch_hook(self, hook):
+        '''add_batch_hook(hook), hook([(eventtype, event, pid, tid), ...]) on every flush'''
+        self._batch_hooks.append(hook)
+    def remove_batch_hook(self, hook):
+        self._batch_hooks.remove(hook)
+
+    def _buffer(self, eventtype, args):
+        self.counts[eventtype] = self.counts.get(eventtype, 0) + 1
+        pid = tid = None
+        if self.systemobjects is not None:
+            pid = self.systemobjects.get_event_process()
+            tid = self.systemobjects.get_event_thread()
+        now = time.time()
+        if not self._pending:
+            self._pending_since = now
+        self._pending.append((eventtype, args, pid, tid))
+        if len(self._pending) >= self.max_batch or \
+           now - self._pending_since >= self.max_delay:
+            self.flush()
+        return idebug.GO_HANDLED
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self.batches += 1
+        events = []
+        for eventtype, args, pid, tid in pending:
+            cls = self.BATCHABLE[eventtype]
+            events.append((eventtype, cls(*args) if cls is not None else args[0],
+                           pid, tid))
+
+        sysobjs = self.systemobjects
+        current = None
+        if sysobjs is not None:
+            try:
+                current = (sysobjs.get_current_process_id(),
+                           sysobjs.get_current_thread_id())
+            except Exception:
+                pass
+        routed = current
+        try:
+            for eventtype, event, pid, tid in events:
+                if (pid, tid) != routed and pid is not None:
+                    self._route(pid, tid)
+                    routed = (pid, tid)
+                self._deliver(eventtype, event)
+        finally:
+            if current is not None and routed != current:
+                self._route(*current)
+        for hook in self._batch_hooks:
+            try:
+                hook(events)
+            except Exception, e:
+                sys.stderr.write("%r" % e)
+
+    def _route(self, pid, tid):
+        sysobjs = self.systemobjects
+        try:
+            sysobjs.set_current_process_id(pid)
+            sysobjs.set_current_thread_id(tid)
+        except Exception:
+            # the thread is gone already
+            pass
+
+    def onCreateThread(self, handle, dataOffset, startOffset):
+        if 'CREATETHREAD' in self._batched:
+            return self._buffer('CREATETHREAD', (handle, dataOffset, startOffset))
+        return super(DebugEventHandler, self).onCreateThread(handle, dataOffset, startOffset)
+
+    def onExitThread(self, exitCode):
+        if 'EXITTHREAD' in self._batched:
+            return self._buffer('EXITTHREAD', (exitCode,))
+        return super(DebugEventHandler, self).onExitThread(exitCode)
+
+    def onLoadModule(self, *args):
+        if 'LOADMODULE' in self._batched:
+            return self._buffer('LOADMODULE', args)
+        return super(DebugEventHandler, self).onLoadModule(*args)
+
+    def onUnloadModule(self, imageBaseName, baseOffset):
+        if 'UNLOADMODULE' in self._batched:
+            return self._buffer('UNLOADMODULE', (imageBaseName, baseOffset))
+        return super(DebugEventHandler, self).onUnloadModule(imageBaseName, baseOffset)
+
     def handle_event(self, eventtype, event):
+        if self._pending and eventtype not in self._PASSIVE:
+            self.flush()
+        return self._deliver(eventtype, event)
+
+    def _deliver(self, eventtype, event):
+        self.delivered += 1
         try:
             retval = None
-            retval = self.handlers[eventtype](event)
-        except KeyError:
-            retval = idebug.GO_HANDLED
+            for hook in self._hooks.get(eventtype, ()):
+                retval = hook(event)
+                if retval is not None:
+                    return retval
+            handler = self.handlers.get(eventtype)
+            if handler is None:
+                retval = idebug.GO_HANDLED
+            else:
+                retval = handler(event)
         except Exception, e:
             sys.stderr.write("%r" % e)
             retval = idebug.GO_IGNORED
 
+        for hook in self._after_hooks.get(eventtype, ()):
+            try:
+                hook(event)
+            except Exception, e:
+                sys.stderr.write("%r" % e)
+
         if retval is None:
             retval = idebug.GO_HANDLED
 
@@ -94,12 +272,101 @@ class AddressSpace(object):
                 raise RuntimeError("Buffer size and slice range don't agree: %d != %d" % (len(buf), count))
         else:
             address, count = offset, len(buf)
-        num = self.dbg.dataspaces.write(offset, buf)
+        num = self.dbg.dataspaces.write(address, buf)
 
         if num != count:
-            raise RuntimeError("Short write to memory %d < %d. Inconsistent state, bailing out...", num, count)
+            raise RuntimeError("Short write to memory %d < %d. Inconsistent state, bailing out..." % (num, count))
         return self
 
+    # strings
+    #
+    # Read in chunks that start small and double, but never cross a page
+    # boundary in one read: the tail of a string can sit right before an
+    # unmapped page and a read over it fails as a whole.
+    FIRST_CHUNK = 64
+
+    def _read_terminated(self, address, limit, width, read=None, chunk=None):
+        read = read or self.dbg.dataspaces.read
+        chunk = chunk or self.FIRST_CHUNK
+        terminator = "\0" * width
+        data = ""
+        while len(data) < limit:
+            here = address + len(data)
+            size = min(chunk, limit - len(data),
+                       utils.PAGE_SIZE - (here & (utils.PAGE_SIZE - 1)))
+            try:
+                buf = read(here, size)
+            except RuntimeError:
+                if not data:
+                    raise
+                break
+            if not buf:
+                break
+            # the terminator can straddle two reads
+            start = max(0, len(data) - width + 1)
+            start -= start % width
+            data += buf
+            end = data.find(terminator, start)
+            while end != -1 and end % width:
+                end = data.find(terminator, end + 1)
+            if end != -1:
+                return data[:end]
+            chunk *= 2
+        return data[:limit - limit % width]
+
+    def read_cstring(self, address, max=1024):
+        '''read_cstring(address, max) -> str, without the NUL
+
+        Stops at the NUL, after `max` bytes, or where memory stops being
+        readable. Raises if nothing at address can be read.
+        '''
+        return self._read_terminated(address, max, 1)
+
+    def read_wstring(self, address, max=1024):
+        '''read_wstring(address, max) -> unicode, max is in characters'''
+        data = self._read_terminated(address, max * 2, 2)
+        return data.decode("utf-16le", "replace")
+
+    def read_strings(self, addresses, max=1024, wide=False):
+        '''read_strings([address, ...], max, wide) -> [string or None, ...]
+
+        Every page is read once, whole, however many strings are on it.
+        NULL and unreadable pointers give None.
+        '''
+        read = self.dbg.dataspaces.read
+        pages = {}
+        def page_read(address, size):
+            base = address & ~(utils.PAGE_SIZE - 1)
+            try:
+                page = pages[base]
+            except KeyError:
+                try:
+                    page = read(base, utils.PAGE_SIZE)
+                except RuntimeError:
+                    page = None
+                pages[base] = page
+            if page is None:
+                raise RuntimeError("Page at 0x%x isn't readable" % base)
+            offset = address - base
+            return page[offset:offset+size]
+
+        width = 2 if wide else 1
+        strings = []
+        for address in addresses:
+            if not address:
+                strings.append(None)
+                continue
+            try:
+                data = self._read_terminated(address, max * width, width,
+                                             page_read, utils.PAGE_SIZE)
+            except RuntimeError:
+                strings.append(None)
+                continue
+            if wide:
+                data = data.decode("utf-16le", "replace")
+            strings.append(data)
+        return strings
+
     def find(self, pattern, address, count, alignment=1):
         return self.dbg.dataspaces.search(pattern, address, count, alignment)
 
@@ -109,13 +376,13 @@ class AddressSpace(object):
         return st.unpack(buf)
     def pack(self, fmt, addr, *args):
         st = struct.Struct(fmt)
-        buf = st.pack(fmt, *args)
+        buf = st.pack(*args)
         return self.dbg.dataspaces.write(addr, buf)
     # stupid convenience functions
-    def get_int8(self, addr): return self.unpack('c', addr)
-    def put_int8(self, addr, val): return self.pack('c', addr, val)
-    def get_uint8(self, addr): return self.unpack('C', addr)
-    def put_uint8(self, addr, val): return self.pack('C', addr, val)
+    def get_int8(self, addr): return self.unpack('b', addr)
+    def put_int8(self, addr, val): return self.pack('b', addr, val)
+    def get_uint8(self, addr): return self.unpack('B', addr)
+    def put_uint8(self, addr, val): return self.pack('B', addr, val)
     def get_int16(self, addr): return self.unpack('h', addr)
     def put_int16(self, addr, val): return self.pack('h', addr, val)
     def get_uint16(self, addr): return self.unpack('H', addr)
@@ -139,45 +406,102 @@ class AddressSpace(object):
         return self.put_uint32(addr, value)
 
 
+_ARG_CODE = re.compile(r"(\d*)([xcbB?hHiIlLqQfdP])")
+
+def _arg_codes(argstr):
+    '''"<2IQ" -> ["I", "I", "Q"], one code per argument'''
+    codes = []
+    fmt = argstr.lstrip("@=<>!")
+    pos = 0
+    while pos < len(fmt):
+        m = _ARG_CODE.match(fmt, pos)
+        if m is None:
+            raise RuntimeError("Can't read %r as arguments" % (fmt[pos:],))
+        codes.extend([m.group(2)] * int(m.group(1) or 1))
+        pos = m.end()
+    return [c for c in codes if c != "x"]
+
+
 class Debugger(object):
     def __init__(self, interestmask=None):
         self._output = CollectOutputCallbacks()
         self._events = DebugEventHandler(interestmask)
+
+        # per process state, keyed by engine process id. None holds what is
+        # set up before there is a process, the first one inherits it.
+        self.contexts = {}
+        self._new_context(None)
+        self._events.get_context = self.get_context
+        self._events.add_hook('CREATEPROCESS', self._on_create_process)
+        self._events.add_hook('EXITPROCESS', self._on_exit_process, after=True)
+        self._events.add_hook('LOADMODULE', self._on_load_module)
+        self._events.add_hook('UNLOADMODULE', self._on_unload_module)
+        # the events behind them are only asked for once contexts are used
+        self._tracking = False
+
         self.client = idebug.Client(output_cb=self._output,
                                    event_cb=self._events)
 
         self.dataspaces = idebug.DataSpaces(self.client)
+        self.dataspaces.write_listener = self.memory_written
         self.registers = idebug.Registers(self.client)
         self.control = idebug.Control(self.client)
+        self.symbols = idebug.Symbols(self.client)
+        self.systemobjects = idebug.SystemObjects(self.client)
+        self._events.systemobjects = self.systemobjects
         #
         self.addrspace = AddressSpace(self)
+        self._pollers = []
+        # engine waits so far, a poller can tell whether a stop came from
+        # the wait it asked for
+        self.waits = 0
+        self._watchpoints = None
+        self._deferred = None
+        self._patches = None
+        self._disasm = None
+        self._detours = None
+        self._write_listeners = []
+
+    EVENT_INTERESTS = {
+        'BREAKPOINT': idebug.DbgEng.DEBUG_EVENT_BREAKPOINT,
+        'EXCEPTION': idebug.DbgEng.DEBUG_EVENT_EXCEPTION,
+        'CREATETHREAD': idebug.DbgEng.DEBUG_EVENT_CREATE_THREAD,
+        'EXITTHREAD': idebug.DbgEng.DEBUG_EVENT_EXIT_THREAD,
+        'CREATEPROCESS': idebug.DbgEng.DEBUG_EVENT_CREATE_PROCESS,
+        'EXITPROCESS': idebug.DbgEng.DEBUG_EVENT_EXIT_PROCESS,
+        'LOADMODULE': idebug.DbgEng.DEBUG_EVENT_LOAD_MODULE,
+        'UNLOADMODULE': idebug.DbgEng.DEBUG_EVENT_UNLOAD_MODULE,
+        'SYSTEMERROR': idebug.DbgEng.DEBUG_EVENT_SYSTEM_ERROR,
+        'SESSIONSTATUS': idebug.DbgEng.DEBUG_EVENT_SESSION_STATUS,
+        'DEBUGEESTATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_DEBUGGEE_STATE,
+        'ENGINESTATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_ENGINE_STATE,
+        'SYMBOLSTATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_SYMBOL_STATE,
+    }
+    # old spellings, kept so existing scripts keep working
+    EVENT_ALIASES = {
+        'CREATE_THREAD': 'CREATETHREAD',
+        'THREAD': 'EXITTHREAD',
+        'CREATE_PROCESS': 'CREATEPROCESS',
+        'PROCESS': 'EXITPROCESS',
+        'LOAD_MODULE': 'LOADMODULE',
+        'UNLOAD_MODULE': 'UNLOADMODULE',
+        'SYSTEM_ERROR': 'SYSTEMERROR',
+        'SESSION_STATUS': 'SESSIONSTATUS',
+        'CHANGE_DEBUGGEE_STATE': 'DEBUGEESTATE',
+        'CHANGE_ENGINE_STATE': 'ENGINESTATE',
+        'CHANGE_SYMBOL_STATE': 'SYMBOLSTATE',
+    }
 
     def set_event_handler(self, eventtype, handler, add_interest=True):
         # TODO handling a list of eventtypes ?
-        # XXX edge case mishadling - if not add_interest no set_interest at all
-        interests = {
-            'BREAKPOINT': idebug.DbgEng.DEBUG_EVENT_BREAKPOINT,
-            'EXCEPTION': idebug.DbgEng.DEBUG_EVENT_EXCEPTION,
-            'CREATE_THREAD': idebug.DbgEng.DEBUG_EVENT_CREATE_THREAD,
-            'THREAD': idebug.DbgEng.DEBUG_EVENT_EXIT_THREAD,
-            'CREATE_PROCESS': idebug.DbgEng.DEBUG_EVENT_CREATE_PROCESS,
-            'PROCESS': idebug.DbgEng.DEBUG_EVENT_EXIT_PROCESS,
-            'LOAD_MODULE': idebug.DbgEng.DEBUG_EVENT_LOAD_MODULE,
-            'UNLOAD_MODULE': idebug.DbgEng.DEBUG_EVENT_UNLOAD_MODULE,
-            'SYSTEM_ERROR': idebug.DbgEng.DEBUG_EVENT_SYSTEM_ERROR,
-            'SESSION_STATUS': idebug.DbgEng.DEBUG_EVENT_SESSION_STATUS,
-            'CHANGE_DEBUGGEE_STATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_DEBUGGEE_STATE,
-            'CHANGE_ENGINE_STATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_ENGINE_STATE,
-            'CHANGE_SYMBOL_STATE': idebug.DbgEng.DEBUG_EVENT_CHANGE_SYMBOL_STATE,
-        }
-
-        if eventtype in interests:
-            eventtype = interests[eventtype]
+        # handlers are keyed by the name EventHandler passes to
+        # handle_event(), the interest mask wants the DEBUG_EVENT_* flag
+        eventtype = self.EVENT_ALIASES.get(eventtype, eventtype)
 
         self._events.set_handler(eventtype, handler)
 
-        if add_interest:
-            self.add_interest(eventtype)
+        if add_interest and eventtype in self.EVENT_INTERESTS:
+            self.add_interest(self.EVENT_INTERESTS[eventtype])
 
     def add_interest(self, interest):
         self._events.add_interest(interest)
@@ -188,36 +512,334 @@ class Debugger(object):
         self._events.set_interest_mask(interest_mask)
         return self.client.set_event_callbacks(self._events)
 
+    def add_hook(self, eventtype, hook, add_interest=True, after=False):
+        eventtype = self.EVENT_ALIASES.get(eventtype, eventtype)
+        self._events.add_hook(eventtype, hook, after)
+        if add_interest and eventtype in self.EVENT_INTERESTS:
+            self.add_interest(self.EVENT_INTERESTS[eventtype])
+
+    def batch_events(self, eventtypes=('CREATETHREAD', 'EXITTHREAD',
+                                       'LOADMODULE', 'UNLOADMODULE'),
+                     max_batch=1024, max_delay=0.25, hook=None):
+        '''batch_events(eventtypes, max_batch, max_delay, hook)
+
+        Thread and module events of those types are answered right away
+        and delivered later, in order, in batches (see DebugEventHandler).
+        hook([(eventtype, event, pid, tid), ...]) is called with every
+        batch, pid and tid being the engine ids the event came from. Hooks
+        that have to act before the target runs on (deferred breakpoints,
+        module patches) see a batched LOADMODULE late.
+        '''
+        eventtypes = [self.EVENT_ALIASES.get(e, e) for e in eventtypes]
+        self._events.batch(eventtypes, max_batch, max_delay)
+        for eventtype in eventtypes:
+            self.add_interest(self.EVENT_INTERESTS[eventtype])
+        if hook is not None:
+            self._events.add_batch_hook(hook)
+        if self._events.flush not in self._pollers:
+            self.add_poller(self._events.flush)
+
+    def unbatch_events(self):
+        self._events.unbatch()
+        if self._events.flush in self._pollers:
+            self.remove_poller(self._events.flush)
+
+    def set_exception_filter(self, exfilter):
+        '''set_exception_filter(exfilter)
+
+        Installs an exfilter.ExceptionFilter, it is consulted for every
+        exception before the EXCEPTION handler. None removes it.
+        '''
+        if self._events.exception_filter is not None:
+            self._events.exception_filter.unbind()
+        if exfilter is not None:
+            exfilter.bind(self)
+            self.add_interest(idebug.DbgEng.DEBUG_EVENT_EXCEPTION)
+        self._events.exception_filter = exfilter
+
+    # process contexts
+    def _new_context(self, pid):
+        import context
+        ctx = context.ProcessContext(self, pid)
+        self.contexts[pid] = ctx
+        return ctx
+
+    def _track_contexts(self):
+        # process and module events cost a trip into Python each, they are
+        # only asked for once something uses the contexts
+        if self._tracking:
+            return
+        self._tracking = True
+        self.add_interest(idebug.DbgEng.DEBUG_EVENT_CREATE_PROCESS |
+                          idebug.DbgEng.DEBUG_EVENT_EXIT_PROCESS |
+                          idebug.DbgEng.DEBUG_EVENT_LOAD_MODULE |
+                          idebug.DbgEng.DEBUG_EVENT_UNLOAD_MODULE)
+        sysobjs = self.systemobjects
+        try:
+            current = sysobjs.get_current_process_id()
+        except Exception:
+            # no process yet, its CREATEPROCESS names the context
+            return
+        # the CREATEPROCESS and LOADMODULEs of the processes there already
+        # went by untracked, the current one inherits what was set up
+        ctx = self.contexts.pop(None, None) or self._new_context(current)
+        ctx.pid = current
+        self.contexts[current] = ctx
+        try:
+            for pid, sysid in sysobjs.get_process_ids():
+                ctx = self.contexts.get(pid) or self._new_context(pid)
+                sysobjs.set_current_process_id(pid)
+                for index, base in self.symbols.get_modules():
+                    params = self.symbols.get_module_parameters(base)
+                    ctx.modules[base] = idebug.LoadModuleEvent(None, base,
+                            params.size, self.symbols.get_module_name(index, base),
+                            None, params.checksum, params.timestamp)
+        finally:
+            sysobjs.set_current_process_id(current)
+
+    def get_context(self, pid=None):
+        '''get_context(pid=None) -> ProcessContext
+
+        Without a pid, the context of the engine's current process, which
+        during an event is the process the event happened in.
+        '''
+        self._track_contexts()
+        if pid is None:
+            if len(self.contexts) == 1 and None in self.contexts:
+                return self.contexts[None]
+            try:
+                pid = self.systemobjects.get_current_process_id()
+            except Exception:
+                pid = None
+        ctx = self.contexts.get(pid)
+        if ctx is None:
+            # no CREATEPROCESS was seen for it, what is set up in it still
+            # has to be found again
+            ctx = self._new_context(pid)
+        return ctx
+    context = property(get_context)
+
+    def _on_create_process(self, event):
+        pid = self.systemobjects.get_event_process()
+        ctx = self.contexts.pop(None, None)
+        if ctx is None:
+            ctx = self._new_context(pid)
+        else:
+            ctx.pid = pid
+        self.contexts[pid] = ctx
+        # the process' own image doesn't get a LOADMODULE of its own
+        ctx.modules[event.baseOffset] = idebug.LoadModuleEvent(
+                event.imageFileHandle, event.baseOffset, event.moduleSize,
+                event.moduleName, event.imageName, event.checkSum,
+                event.timeDateStamp)
+
+    def _on_exit_process(self, exitcode):
+        pid = self.systemobjects.get_event_process()
+        ctx = self.contexts.pop(pid, None)
+        if ctx is not None:
+            ctx.exit_code = exitcode
+            ctx.teardown()
+
+    def _on_load_module(self, event):
+        self.context.modules[event.baseOffset] = event
+
+    def _on_unload_module(self, event):
+        ctx = self.context
+        ctx.modules.pop(event.baseOffset, None)
+        ctx.breakpoints.module_unloaded(event.baseOffset)
+
     def execute(self, cmd):
         with self._output.collect():
             self.control.execute(cmd)
             self.client.flush_output()
             return str(self._output)
 
-    def step_into(self): pass
-    def step_over(self): pass
-    def step_branch(self): pass
+    def _step(self, mode, count, path, registers, until, module):
+        import steptrace
+        tracer = steptrace.StepTracer(self, mode, path, registers)
+        try:
+            tracer.run(count, until, module)
+        finally:
+            tracer.close()
+        return tracer
+
+    def step_into(self, count=1, path=None, registers=(), until=None,
+                  module=False):
+        '''step_into(count, path, registers, until, module) -> StepTracer
+
+        Single steps `count` times (None: until another condition stops
+        it), recording every pc (and `registers`) into `path` if given.
+        See steptrace.StepTracer.run() for until and module. The tracer's
+        pc, steps and reason say where and why it stopped.
+        '''
+        return self._step('into', count, path, registers, until, module)
+    def step_over(self, count=1, path=None, registers=(), until=None,
+                  module=False):
+        return self._step('over', count, path, registers, until, module)
+    def step_branch(self, count=1, path=None, registers=(), until=None,
+                    module=False):
+        return self._step('branch', count, path, registers, until, module)
+
+    @property
+    def breakpoints(self):
+        '''the current process' bptable.BreakpointTable'''
+        return self.context.breakpoints
 
     def breakpoint(self, address, callback,oneshot=False,private=True,cmd=None,
-                  args=None, kwargs=None):
+                  args=None, kwargs=None, condition=None, tags=()):
+        '''breakpoint(address, callback, ...) -> Breakpoint
+
+        condition: predicate like "rcx == 0x10 and [rdx+8] != 0", compiled
+                   to a MASM expression (see bpcond.py) the engine evaluates
+                   on every hit; the callback is only called when it holds.
+                   Every hit still costs the trip out of the engine, plus an
+                   Evaluate, what's saved is the callback's own work.
+        tags: names to find it by later, see bptable.BreakpointTable
+        '''
+        if condition is not None:
+            callback = self._conditional(bpcond.compile_condition(condition),
+                                         callback)
         bp = self.control.set_breakpoint(address, oneshot, private, cmd)
-        self._events._bp_callbacks[bp.id] = callback,args,kwargs
+        self.breakpoints.add(bp, callback, args or (), kwargs, tags)
         return bp
 
-    def watchpoint(self, address, size, callback, mode='rwx', oneshot=False,private=True,cmd=None):
+    def _conditional(self, expr, callback):
+        evaluate = self.control.evaluate
+        def gate(bp, *args, **kwargs):
+            try:
+                holds = evaluate(expr)
+            except RuntimeError:
+                # memory it reads isn't there, like j with a bad poi()
+                return None
+            if holds:
+                return callback(bp, *args, **kwargs)
+            return None
+        return gate
+
+    def deferred_breakpoint(self, module, target, callback, cache_path=None,
+                            **kwargs):
+        '''deferred_breakpoint(module, symbol or rva, callback, ...)
+
+        Armed as an address when the module loads, see deferred.py. Takes
+        the keyword arguments breakpoint() does. cache_path keeps resolved
+        RVAs in a file across runs.
+        '''
+        if self._deferred is None:
+            import deferred
+            self._deferred = deferred.DeferredBreakpoints(self, cache_path)
+        elif cache_path is not None and cache_path != self._deferred.cache_path:
+            self._deferred.load(cache_path)
+        return self._deferred.add(module, target, callback, **kwargs)
+
+    def remove_deferred_breakpoint(self, dbp):
+        self._deferred.remove(dbp)
+
+    def remove_breakpoint(self, bp):
+        '''remove_breakpoint(bp or id)'''
+        bpid = bp if isinstance(bp, (int, long)) else bp.id
+        self.breakpoints.remove(bpid)
+
+    def sampled_breakpoint(self, address, callback, budget=100, window=1.0,
+                           every=None, cooloff=1.0, mode='passcount',
+                           oneshot=False, private=True, cmd=None,
+                           args=None, kwargs=None):
+        '''sampled_breakpoint(...) -> sampling.SamplingBreakpoint
+
+        A breakpoint that throttles itself once it gets hot, see sampling.py
+        '''
+        import sampling
+        sbp = sampling.SamplingBreakpoint(self, callback, budget, window,
+                                          every, cooloff, mode, args, kwargs)
+        sbp.bp = self.breakpoint(address, sbp._on_hit, oneshot, private, cmd)
+        sbp.arm()
+        return sbp
+
+    def watchpoint(self, address, size, callback, mode='rwx', oneshot=False,private=True,cmd=None,
+                   args=None, kwargs=None, tags=()):
         bp = self.control.set_watchpoint(address, size, mode, oneshot, private, cmd)
-        self._events._bp_callbacks[bp.id] = callback
+        self.breakpoints.add(bp, callback, args or (), kwargs, tags)
         return bp
 
+    def watch(self, address, size, callback, mode='w', args=None, kwargs=None):
+        '''watch(address, size, callback, mode) -> watchpoints.WatchedRange
+
+        Not limited by the debug registers, see watchpoints.py. The callback
+        is called as callback(watchedrange, address, *args, **kwargs)
+        '''
+        if self._watchpoints is None:
+            import watchpoints
+            self._watchpoints = watchpoints.WatchpointManager(self)
+        return self._watchpoints.watch(address, size, callback, mode, args, kwargs)
+
+    def unwatch(self, watched):
+        self._watchpoints.unwatch(watched)
+
+    @property
+    def patches(self):
+        '''the patch.PatchManager, see patch.py'''
+        if self._patches is None:
+            import patch
+            self._patches = patch.PatchManager(self)
+        return self._patches
+
+    @property
+    def detours(self):
+        '''the detour.DetourManager, see detour.py'''
+        if self._detours is None:
+            import detour
+            self._detours = detour.DetourManager(self)
+        return self._detours
+
+    def add_write_listener(self, listener):
+        '''add_write_listener(listener)
+
+        listener(address, size) is called after target memory is written
+        through DataSpaces.write() or assemble(), so whatever caches target
+        memory can drop that range.
+        '''
+        self._write_listeners.append(listener)
+    def remove_write_listener(self, listener):
+        self._write_listeners.remove(listener)
+
+    def memory_written(self, address, size):
+        for listener in list(self._write_listeners):
+            listener(address, size)
+
+    def disassemble(self, address, count=1, end=None):
+        '''disassemble(address, count=1, end=None) -> [Instruction, ...]
+
+        Cached per module build, see disasm.py.
+        '''
+        if self._disasm is None:
+            import disasm
+            self._disasm = disasm.DisassemblyCache(self)
+        return self._disasm.disassemble(address, count, end)
+
+    def assemble(self, address, asm):
+        '''assemble(address, asm) -> address after the new instruction'''
+        end = self.control.assemble(address, asm)
+        self.memory_written(address, end - address)
+        return end
+
     @property
     def ptr_size(self):
         return 8 if self.control.is_pointer_64bit() else 4
 
+    ARG_REGISTERS = ("rcx", "rdx", "r8", "r9")
+
     def read_args(self, argstr, use_frame=False):
         '''read_args( argstr ) -> tuple(arg0, arg1, ..., argN)
 
         argstr := struct.unpack() string of argument types
+
+        On x64 every argument is one 64 bit slot: the first four are taken
+        from rcx, rdx, r8 and r9 (so integers and pointers only, floats
+        travel in xmm0-3), the rest from the stack above the return address
+        and the 32 byte home area. Call it before the prologue runs.
         '''
+        if self.control.is_pointer_64bit():
+            return self._read_args_x64(argstr)
+
         # common case: bpx at the start of a function, before the prologue
         if use_frame:
             stack = self.registers.getframe()
@@ -225,10 +847,50 @@ class Debugger(object):
             stack = self.registers.getstack()
         # need to adjust stack ptr up by sizeof(return address)
         ret_addr_size = self.ptr_size
-        return self.dataspaces.unpack(argstr, stack + ret_addr_size)
+        st = struct.Struct(argstr)
+        return st.unpack(self.dataspaces.read(stack + ret_addr_size, st.size))
+
+    def _read_args_x64(self, argstr):
+        codes = _arg_codes(argstr)
+        nregs = min(len(codes), len(self.ARG_REGISTERS))
+        slots = [self.registers[reg] & 0xffffffffffffffff
+                 for reg in self.ARG_REGISTERS[:nregs]]
+        if len(codes) > nregs:
+            count = len(codes) - nregs
+            stack = self.registers.getstack() + 8 + 32
+            slots.extend(struct.unpack("<%dQ" % count,
+                                       self.dataspaces.read(stack, 8 * count)))
+        # a pointer is a Q here, "<P" isn't a thing
+        codes = ["Q" if code == "P" else code for code in codes]
+        return tuple(struct.unpack("<" + code,
+                        struct.pack("<Q", slot)[:struct.calcsize("<" + code)])[0]
+                     for code, slot in zip(codes, slots))
+
+    def add_poller(self, poller):
+        '''add_poller(poller)
+
+        poller() is called every time wait_for_event() returns, whether
+        there was an event or the wait timed out, and once after a step_*()
+        trace, not after each of its steps.
+        '''
+        self._pollers.append(poller)
+    def remove_poller(self, poller):
+        self._pollers.remove(poller)
+
+    def poll(self):
+        '''runs the pollers, as wait_for_event() does after every wait'''
+        for poller in list(self._pollers):
+            poller()
+
+    def wait_for_event(self, timeout_ms=-1):
+        self.waits += 1
+        retval = self.control.wait_for_event(timeout_ms)
+        self.poll()
+        return retval
 
-    def wait_for_event(self):
-        return self.control.wait_for_event()
+    def break_wait(self):
+        '''makes a wait_for_event() in progress return, safe from any thread'''
+        self.control.set_interrupt(idebug.DbgEng.DEBUG_INTERRUPT_EXIT)
 
     def next_event(self):
         self.wait_for_event()
@@ -247,7 +909,12 @@ class Debugger(object):
         self.client.terminate_processes()
 
     def opendump(self, path):
-        self.client.open_dump_file(path)
+        '''opendump(path), returns once the engine has loaded the dump'''
+        self.client.open_dumpfile(path)
+        self.wait_for_event()
+
+    def closedump(self):
+        self.client.end_session()
 
     def writedump(self, path, mode=0):
         self.client.write_dumpfile(path, mode)
@@ -0,0 +1,197 @@
+'''Breakpoints on modules that aren't loaded yet.
+
+A breakpoint on "module!symbol" given as an expression stays in the
+engine's deferred list and gets re-evaluated every time the symbol state
+changes. Here instead the breakpoints are declared as (module, symbol or
+RVA) and parked in a table keyed by module name. Nothing happens until
+LOADMODULE for that module (CREATEPROCESS for the executable itself), then
+the whole batch is armed as plain addresses: module base + RVA.
+
+Resolved RVAs are cached per module build (name, timestamp, checksum), so
+the symbol lookup is paid once per build, and not at all across runs when
+the cache is given a path. A symbol that doesn't resolve isn't cached, it
+is looked up again the next time the module loads (symbols can fail to
+load for a while).
+
+    dbg.deferred_breakpoint("mshtml", "CTreeNode::Release", on_release)
+    dbg.deferred_breakpoint("mshtml.dll", 0x1a2b30, on_hit, tags=("ie",),
+                            cache_path="rvas.json")
+'''
+import os
+import json
+
+
+def module_key(name):
+    '''module_key("C:\\\\Windows\\\\kernel32.dll") -> "kernel32"'''
+    return os.path.splitext(os.path.basename(name))[0].lower()
+
+
+class DeferredBreakpoint(object):
+    '''A breakpoint declaration. target is a symbol name or an RVA.
+
+    armed: {(pid, base): Breakpoint} for every process it is armed in
+    '''
+    def __init__(self, module, target, callback, oneshot=False, private=True,
+                 cmd=None, args=None, kwargs=None, condition=None, tags=()):
+        self.module = module_key(module)
+        self.target = target
+        self.callback = callback
+        self.oneshot = oneshot
+        self.private = private
+        self.cmd = cmd
+        self.args = args
+        self.kwargs = kwargs
+        self.condition = condition
+        self.tags = tags
+        self.armed = {}
+
+    def __repr__(self):
+        target = self.target
+        if isinstance(target, (int, long)):
+            target = "0x%x" % target
+        return "<DeferredBreakpoint %s!%s armed=%d>" % (self.module, target,
+                                                        len(self.armed))
+
+
+class DeferredBreakpoints(object):
+    '''The pending table, see the module docstring.
+
+    cache_path: JSON file to keep resolved RVAs in between runs
+    '''
+    def __init__(self, dbg, cache_path=None):
+        self.dbg = dbg
+        self.cache_path = None
+        self.pending = {}
+        # [(DeferredBreakpoint, timestamp, checksum), ...] that didn't resolve
+        self.unresolved = []
+        # (name, timestamp, checksum) -> {symbol: rva}
+        self._rvas = {}
+        # (pid, base) -> [DeferredBreakpoint, ...]
+        self._armed = {}
+        self._cache_dirty = False
+        if cache_path is not None:
+            self.load(cache_path)
+
+        dbg.add_hook('CREATEPROCESS', self._on_create_process)
+        dbg.add_hook('LOADMODULE', self._on_load_module)
+        dbg.add_hook('UNLOADMODULE', self._on_unload_module)
+        dbg.add_hook('EXITPROCESS', self._on_exit_process)
+
+    def load(self, cache_path):
+        '''keep the RVA cache in cache_path, merging in what it has already'''
+        self.cache_path = cache_path
+        # whatever was resolved before goes in there too
+        self._cache_dirty = self._cache_dirty or bool(self._rvas)
+        if not os.path.exists(cache_path):
+            return
+        with open(cache_path, "rb") as fp:
+            for key, rvas in json.load(fp).iteritems():
+                name, timestamp, checksum = key.rsplit("|", 2)
+                cached = self._rvas.setdefault((name, int(timestamp), int(checksum)), {})
+                for symbol, rva in rvas.iteritems():
+                    if rva is not None:
+                        cached.setdefault(symbol, rva)
+
+    def add(self, module, target, callback, **kwargs):
+        '''add(module, target, callback, ...) -> DeferredBreakpoint
+
+        Takes the same keyword arguments as Debugger.breakpoint(). If the
+        module is already loaded the breakpoint is armed right away.
+        '''
+        dbp = DeferredBreakpoint(module, target, callback, **kwargs)
+        self.pending.setdefault(dbp.module, []).append(dbp)
+
+        loaded = self.dbg.symbols.get_module_by_name(dbp.module)
+        if loaded is not None:
+            params = self.dbg.symbols.get_module_parameters(loaded[1])
+            self._arm(dbp.module, params.base, params.timestamp,
+                      params.checksum, [dbp])
+            self.save()
+        return dbp
+
+    def remove(self, dbp):
+        self.pending[dbp.module].remove(dbp)
+        if not self.pending[dbp.module]:
+            del self.pending[dbp.module]
+        for key, bp in dbp.armed.items():
+            armed = self._armed.get(key)
+            if armed is not None and dbp in armed:
+                armed.remove(dbp)
+            self._disarm(dbp, key)
+
+    def _disarm(self, dbp, key):
+        bp = dbp.armed.pop(key, None)
+        if bp is not None and bp.id in self.dbg.breakpoints:
+            self.dbg.remove_breakpoint(bp)
+
+    def resolve(self, module, base, timestamp, checksum, target):
+        '''resolve(...) -> RVA of target in that build of module, or None'''
+        if isinstance(target, (int, long)):
+            return target
+        rvas = self._rvas.setdefault((module, timestamp, checksum), {})
+        try:
+            return rvas[target]
+        except KeyError:
+            pass
+        offset = self.dbg.symbols.get_offset_by_name("%s!%s" % (module, target))
+        if offset is None:
+            return None
+        rvas[target] = offset - base
+        self._cache_dirty = True
+        return offset - base
+
+    def _arm(self, module, base, timestamp, checksum, dbps):
+        pid = self.dbg.context.pid
+        armed = self._armed.setdefault((pid, base), [])
+        for dbp in dbps:
+            if (pid, base) in dbp.armed:
+                continue
+            rva = self.resolve(module, base, timestamp, checksum, dbp.target)
+            miss = (dbp, timestamp, checksum)
+            if rva is None:
+                if miss not in self.unresolved:
+                    self.unresolved.append(miss)
+                continue
+            if miss in self.unresolved:
+                self.unresolved.remove(miss)
+            dbp.armed[(pid, base)] = self.dbg.breakpoint(base + rva,
+                    dbp.callback, dbp.oneshot, dbp.private, dbp.cmd,
+                    dbp.args, dbp.kwargs, dbp.condition, dbp.tags)
+            armed.append(dbp)
+
+    def _on_load_module(self, event):
+        module = module_key(event.moduleName)
+        dbps = self.pending.get(module)
+        if dbps:
+            self._arm(module, event.baseOffset, event.timeDateStamp,
+                      event.checkSum, dbps)
+            self.save()
+
+    def _on_create_process(self, event):
+        # the process' own image doesn't get a LOADMODULE
+        self._on_load_module(event)
+
+    def _on_unload_module(self, event):
+        key = (self.dbg.context.pid, event.baseOffset)
+        for dbp in self._armed.pop(key, ()):
+            self._disarm(dbp, key)
+
+    def _on_exit_process(self, exitcode):
+        # the engine takes the breakpoints with the process
+        pid = self.dbg.systemobjects.get_event_process()
+        for key in [key for key in self._armed if key[0] == pid]:
+            for dbp in self._armed.pop(key):
+                dbp.armed.pop(key, None)
+
+    def save(self):
+        if self.cache_path is None or not self._cache_dirty:
+            return
+        data = dict(("%s|%d|%d" % key, rvas)
+                    for key, rvas in self._rvas.iteritems())
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "wb") as fp:
+            json.dump(data, fp)
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        os.rename(tmp, self.cache_path)
+        self._cache_dirty = False
@@ -0,0 +1,400 @@
+'''Logging hooks that run inside the target, without a breakpoint.
+
+A breakpoint hook costs an int3, a trip to the debugger and a COM callback
+on every call. A detour instead patches a jmp over the function's first
+instructions to a stub assembled in memory allocated in the target. The
+stub saves what it clobbers, takes a slot in a ring buffer with a locked
+xadd, copies the values asked for into it, restores everything, runs the
+instructions it displaced and jumps back. The target never stops for it.
+
+    detours = dbg.detours
+    log = detours.hook("kernel32!CreateFileW", ("tid", "arg0", "arg1", "ret"),
+                       callback=lambda detour, rows: out.extend(rows))
+    while True:
+        dbg.wait_for_event(100)     # drains, even when the wait timed out
+
+Values: any general purpose register, "argN" (the Nth argument, by the
+calling convention of the target's bitness, read at function entry),
+"ret" (the return address), "sp" (the stack pointer at entry) and "tid".
+
+The debugger drains every ring in bulk, a read or two per ring, from a
+poller: after every wait, at most every `interval` seconds. The rings are
+read with ReadProcessMemory on the process handle, not through the engine,
+so that works while the target runs, after a wait that timed out too. A
+record is [sequence, value, ...], the sequence is written last, so a record
+a thread is still filling in isn't taken, and one the ring has lapped is
+counted in Detour.dropped.
+
+The displaced instructions are copied as they are, so the first 5 bytes of
+the function may not hold a relative branch or a RIP relative operand;
+hook() refuses those, and refuses while a thread of the process is stopped
+inside those bytes. The entry jmp goes in through the patch manager,
+unhook() takes it out again, the stub memory is left alone (a thread may
+still be in there). Detours, rings and stub memory belong to the process
+that was current when hook() was called.
+'''
+import time
+import ctypes
+import struct
+
+from comtypes import COMError
+
+import patch
+import utils
+
+
+PAGE_EXECUTE_READWRITE = 0x40
+ARENA_SIZE = 0x10000
+# header of a ring: the write counter, records start at RECORDS
+RECORDS = 0x40
+JMP_SIZE = 5
+
+_RELATIVE = ("call", "loop", "loope", "loopne", "jecxz", "jrcxz", "ret")
+
+_X64_REGS = ("rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "r8", "r9",
+             "r10", "r11", "r12", "r13", "r14", "r15")
+_X86_REGS = ("eax", "ebx", "ecx", "edx", "esi", "edi", "ebp")
+
+
+class Detour(object):
+    def __init__(self, manager, pid, handle, x64, address, values, callback,
+                 slots, ring, stub, ps):
+        self.manager = manager
+        self.pid = pid
+        self.handle = handle
+        self.x64 = x64
+        self.address = address
+        self.values = tuple(values)
+        self.callback = callback
+        self.slots = slots
+        self.ring = ring
+        self.stub = stub
+        self.patch = ps
+        self.width = 1 + len(self.values)
+        self.records = 0
+        self.dropped = 0
+        self.log = []
+        self._read = 0
+        self._stalled = 0
+
+    def __repr__(self):
+        return "<Detour 0x%x %s records=%d dropped=%d>" % (self.address,
+                ",".join(self.values), self.records, self.dropped)
+
+
+class _Stub(object):
+    '''writes a stub, assembling it one instruction at a time'''
+    def __init__(self, dbg, address):
+        self.dbg = dbg
+        self.address = address
+
+    def asm(self, text):
+        self.address = self.dbg.assemble(self.address, text)
+
+    def raw(self, data):
+        self.dbg.dataspaces.write(self.address, data)
+        self.address += len(data)
+
+
+class DetourManager(object):
+    '''
+    slots: records in a ring, rounded up to a power of two
+    interval: seconds between two drains
+    '''
+    def __init__(self, dbg, slots=4096, interval=0.1):
+        self.dbg = dbg
+        self.slots = slots
+        self.interval = interval
+        self.detours = []
+        self.drains = 0
+        # pid -> [[base, end, next free], ...]
+        self._arenas = {}
+        self._last = 0.0
+        self._x64 = None
+        dbg.add_poller(self._poll)
+        dbg.add_hook('EXITPROCESS', self._on_exit_process)
+
+    # target memory
+    def _near(self, address, target):
+        return not self._x64 or abs(address - target) < (1 << 31) - ARENA_SIZE
+
+    def _alloc(self, size, near):
+        size = (size + 63) & ~63
+        arenas = self._arenas.setdefault(self.dbg.context.pid, [])
+        for arena in arenas:
+            if arena[2] + size <= arena[1] and self._near(arena[0], near):
+                address = arena[2]
+                arena[2] += size
+                return address
+
+        handle = self.dbg.systemobjects.get_current_process_handle()
+        arena_size = max(ARENA_SIZE, (size + ARENA_SIZE - 1) & ~(ARENA_SIZE - 1))
+        base = None
+        if not self._x64:
+            base = utils.virtual_alloc(handle, arena_size, PAGE_EXECUTE_READWRITE)
+        else:
+            # a rel32 jmp has to reach it, look within 2GB of the target
+            start = near & ~(ARENA_SIZE - 1)
+            step = 0x100000
+            for i in xrange(1, 2047):
+                for candidate in (start - i * step, start + i * step):
+                    if candidate > 0 and self._near(candidate, near):
+                        base = utils.virtual_alloc(handle, arena_size,
+                                        PAGE_EXECUTE_READWRITE, candidate)
+                        if base is not None:
+                            break
+                if base is not None:
+                    break
+            if base is None:
+                raise RuntimeError("No free memory within 2GB of 0x%x" % near)
+        arenas.append([base, base + arena_size, base + size])
+        return base
+
+    def _activate(self, pid):
+        self.dbg.get_context(pid).activate()
+
+    # the stub
+    def _check_threads(self, start, end):
+        sysobjs = self.dbg.systemobjects
+        current = sysobjs.get_current_thread_id()
+        try:
+            for tid, sysid in sysobjs.get_thread_ids():
+                sysobjs.set_current_thread_id(tid)
+                pc = self.dbg.registers.getpc()
+                if start < pc < end:
+                    raise RuntimeError("Thread %d is at 0x%x, inside what the jmp "
+                                       "goes over" % (sysid, pc))
+        finally:
+            sysobjs.set_current_thread_id(current)
+
+    def _check_displaced(self, address):
+        instructions = self.dbg.disassemble(address, end=address + JMP_SIZE)
+        if not instructions or instructions[-1].address + instructions[-1].size < address + JMP_SIZE:
+            raise RuntimeError("Can't disassemble 5 bytes at 0x%x" % address)
+        for insn in instructions:
+            mnemonic = insn.text.split(None, 1)[0] if insn.text else "?"
+            if mnemonic.startswith("j") or mnemonic in _RELATIVE or mnemonic == "?":
+                raise RuntimeError("Can't move %r from 0x%x" % (insn.text, insn.address))
+            # the engine shows a RIP relative operand as a symbol and address
+            if self._x64 and ("rip" in insn.text or "(" in insn.text or "`" in insn.text):
+                raise RuntimeError("Can't move %r from 0x%x" % (insn.text, insn.address))
+        end = instructions[-1].address + instructions[-1].size
+        return self.dbg.dataspaces.read(address, end - address)
+
+    def _load_x64(self, name):
+        '''-> asm loading value `name` into rcx'''
+        saved = {'rax': 0x10, 'rcx': 0x08, 'rdx': 0x00}
+        if name.startswith("arg"):
+            n = int(name[3:])
+            if n < 4:
+                name = self.dbg.ARG_REGISTERS[n]
+            else:
+                # home area and return address above the entry rsp
+                return ["mov rcx, qword ptr [rsp+%#x]" % (0x20 + 8 + 0x20 + 8 * (n - 4))]
+        if name == "ret":
+            return ["mov rcx, qword ptr [rsp+0x20]"]
+        if name == "sp":
+            return ["lea rcx, [rsp+0x20]"]
+        if name == "tid":
+            return ["mov rcx, qword ptr gs:[0x30]", "mov rcx, qword ptr [rcx+0x48]"]
+        if name in saved:
+            return ["mov rcx, qword ptr [rsp+%#x]" % saved[name]]
+        if name in _X64_REGS:
+            return ["mov rcx, %s" % name]
+        raise RuntimeError("Can't log %r" % name)
+
+    def _load_x86(self, name):
+        '''-> asm loading value `name` into ecx'''
+        saved = {'eax': 0x8, 'ecx': 0x4, 'edx': 0x0}
+        if name.startswith("arg"):
+            return ["mov ecx, dword ptr [esp+%#x]" % (0x10 + 4 + 4 * int(name[3:]))]
+        if name == "ret":
+            return ["mov ecx, dword ptr [esp+0x10]"]
+        if name == "sp":
+            return ["lea ecx, [esp+0x10]"]
+        if name == "tid":
+            return ["mov ecx, dword ptr fs:[0x24]"]
+        if name in saved:
+            return ["mov ecx, dword ptr [esp+%#x]" % saved[name]]
+        if name in _X86_REGS:
+            return ["mov ecx, %s" % name]
+        raise RuntimeError("Can't log %r" % name)
+
+    def _write_stub(self, stub, ring, slots, values, displaced, resume):
+        if self._x64:
+            a, c, d, word, flags, load = "rax", "rcx", "rdx", "qword", "fq", self._load_x64
+        else:
+            a, c, d, word, flags, load = "eax", "ecx", "edx", "dword", "fd", self._load_x86
+        size = 8 if self._x64 else 4
+        code = _Stub(self.dbg, stub)
+
+        code.asm("push" + flags)
+        for reg in (a, c, d):
+            code.asm("push %s" % reg)
+        # take a slot: rax = n, rdx = ring + RECORDS + (n % slots) * recsize
+        code.asm("mov %s, %#x" % (c, ring))
+        code.asm("mov eax, 0x1")
+        code.raw("\xf0")    # lock
+        code.asm("xadd %s ptr [%s], %s" % (word, c, a))
+        code.asm("mov %s, %s" % (d, a))
+        code.asm("and %s, %#x" % (d, slots - 1))
+        code.asm("imul %s, %s, %#x" % (d, d, size * (1 + len(values))))
+        code.asm("lea %s, [%s+%s+%#x]" % (d, c, d, RECORDS))
+        for i, name in enumerate(values):
+            for line in load(name):
+                code.asm(line)
+            code.asm("mov %s ptr [%s+%#x], %s" % (word, d, size * (i + 1), c))
+        # the sequence goes in last, the record is complete once it is n+1
+        code.asm("inc %s" % a)
+        code.asm("mov %s ptr [%s], %s" % (word, d, a))
+        for reg in (d, c, a):
+            code.asm("pop %s" % reg)
+        code.asm("pop" + flags)
+        code.raw(displaced)
+        code.asm("jmp %#x" % resume)
+        return code.address - stub
+
+    def hook(self, target, values=(), callback=None, slots=None):
+        '''hook(target, values, callback, slots) -> Detour
+
+        target: address or "module!symbol"
+        values: what each record holds, see the module docstring
+        callback: callback(detour, [(value, ...), ...]) with every drain,
+                  without one the rows pile up in detour.log
+        '''
+        dbg = self.dbg
+        self._x64 = dbg.control.is_pointer_64bit()
+        address = target
+        if not isinstance(target, (int, long)):
+            address = dbg.symbols.get_offset_by_name(target)
+            if address is None:
+                raise RuntimeError("Can't resolve %s" % target)
+
+        nslots = 1
+        while nslots < (slots or self.slots):
+            nslots <<= 1
+        values = tuple(values)
+        for name in values:
+            (self._load_x64 if self._x64 else self._load_x86)(name)
+        displaced = self._check_displaced(address)
+        self._check_threads(address, address + len(displaced))
+
+        size = 8 if self._x64 else 4
+        ring = self._alloc(RECORDS + nslots * size * (1 + len(values)), address)
+        stub = self._alloc(256 + len(displaced), address)
+        self._write_stub(stub, ring, nslots, values, displaced,
+                         address + len(displaced))
+
+        jmp = struct.pack("<Bi", 0xe9, stub - (address + JMP_SIZE))
+        ps = patch.PatchSet("detour 0x%x" % address)
+        ps.add(address, jmp + "\x90" * (len(displaced) - JMP_SIZE))
+        dbg.patches.apply(ps)
+
+        detour = Detour(self, dbg.context.pid,
+                        dbg.systemobjects.get_current_process_handle(),
+                        self._x64, address, values, callback, nslots, ring,
+                        stub, ps)
+        self.detours.append(detour)
+        return detour
+
+    def unhook(self, detour):
+        sysobjs = self.dbg.systemobjects
+        current = sysobjs.get_current_process_id()
+        try:
+            self._activate(detour.pid)
+            self._drain(detour)
+            self.dbg.patches.revert(detour.patch)
+        finally:
+            sysobjs.set_current_process_id(current)
+        self.detours.remove(detour)
+
+    # draining
+    def _drain(self, detour):
+        handle = detour.handle
+        def read(address, size):
+            return utils.read_process_memory(handle, address, size)
+        size = 8 if detour.x64 else 4
+        mask = (1 << (8 * size)) - 1
+        ctype = ctypes.c_uint64 if detour.x64 else ctypes.c_uint32
+
+        written, = struct.unpack("<Q" if detour.x64 else "<I", read(detour.ring, size))
+        pending = (written - detour._read) & mask
+        if not pending:
+            return 0
+        if pending > detour.slots:
+            detour.dropped += pending - detour.slots
+            detour._read = (written - detour.slots) & mask
+            pending = detour.slots
+
+        # at most two reads, the ring may wrap
+        recsize = size * detour.width
+        records = detour.ring + RECORDS
+        first = detour._read & (detour.slots - 1)
+        count = min(pending, detour.slots - first)
+        data = read(records + first * recsize, count * recsize)
+        if pending > count:
+            data += read(records, (pending - count) * recsize)
+        words = (ctype * (len(data) // size)).from_buffer_copy(data)
+
+        rows = []
+        width = detour.width
+        taken = 0
+        for k in xrange(len(data) // recsize):
+            seq = words[k * width]
+            expected = (detour._read + k + 1) & mask
+            if seq == expected:
+                rows.append(tuple(words[k*width+1:(k+1)*width]))
+            elif (expected - seq) & mask <= detour.slots or seq == 0:
+                # a thread is still filling it in, wait for it, unless it
+                # has been holding everybody up for a while
+                if detour._stalled < 3:
+                    detour._stalled += 1
+                    break
+                detour.dropped += 1
+            else:
+                # lapped while we were reading
+                detour.dropped += 1
+            detour._stalled = 0
+            taken += 1
+        detour._read = (detour._read + taken) & mask
+
+        detour.records += len(rows)
+        if rows:
+            if detour.callback is not None:
+                detour.callback(detour, rows)
+            else:
+                detour.log.extend(rows)
+        return len(rows)
+
+    def drain(self):
+        '''drain() -> records taken from every ring, the target may be running'''
+        self._last = time.time()
+        self.drains += 1
+        taken = 0
+        for detour in self.detours:
+            taken += self._drain(detour)
+        return taken
+
+    def _poll(self):
+        if self.detours and time.time() - self._last >= self.interval:
+            try:
+                self.drain()
+            except (RuntimeError, EnvironmentError, COMError):
+                # the target can be gone, or not readable right now
+                pass
+
+    def _on_exit_process(self, exitcode):
+        # the stubs and rings went with the process
+        pid = self.dbg.systemobjects.get_event_process()
+        self.detours = [d for d in self.detours if d.pid != pid]
+        self._arenas.pop(pid, None)
+
+    def stats(self):
+        return [{'address': d.address, 'values': d.values, 'records': d.records,
+                 'dropped': d.dropped} for d in self.detours]
+
+    def close(self):
+        for detour in self.detours[:]:
+            self.unhook(detour)
+        self.dbg.remove_poller(self._poll)
+        self.dbg._events.remove_hook('EXITPROCESS', self._on_exit_process)
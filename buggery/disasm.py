@@ -0,0 +1,253 @@
+'''Disassembly, cached per module build.
+
+    for insn in dbg.disassemble(dbg.registers.getpc(), 10):
+        print "%x %s" % (insn.address, insn.text)
+
+Instructions inside a module are cached by (module name, timestamp,
+checksum) and RVA, so the same code in the next run, or in another process
+loading the same build, is decoded once. Code outside any module (JIT,
+shellcode) isn't cached. Addresses inside the module in an instruction's
+text (branch targets, RIP relative operands as the engine shows them) are
+kept as RVAs and put back together with the base the module has now.
+
+Code memory is per process though. A write to target memory (Debugger's
+write listeners, so DataSpaces.write, assemble, patches and detours) gives
+the module it lands in a cache of its own in that process: a copy of the
+build's, minus every instruction the write could have touched. The build's
+cache keeps the code as it was for other processes and the next run; the
+copy goes when the module unloads or the process exits.
+
+The decoder is the engine's by default (Control.disassemble). Anything
+with the same signature can be plugged in instead, capstone_decoder() is
+one that reads the bytes and decodes them with capstone.
+'''
+import re
+import bisect
+
+import idebug
+
+
+# longest x86 instruction, a write this far after an instruction's start
+# can still hit it
+MAX_INSN = 15
+
+# what an address looks like in engine (00007ff6`1e0a2f40, 77a1b2c3, an
+# immediate 77A1B2C3h) and capstone (0x7ff61e0a2f40) text
+_ADDRESS = re.compile(r"\b(0x[0-9a-fA-F]+|[0-9a-fA-F]{8}`[0-9a-fA-F]{8}|"
+                      r"[0-9a-fA-F]{8}|[0-9a-fA-F]+h)\b")
+
+
+def _template(text, base, end):
+    '''-> text, or a tuple of text and (rva, as written) for the addresses
+    in [base, end)'''
+    parts = []
+    last = 0
+    for m in _ADDRESS.finditer(text):
+        token = m.group(1)
+        value = int(token.replace("`", "").rstrip("h"), 16)
+        if not base <= value < end:
+            continue
+        parts.append(text[last:m.start()])
+        parts.append((value - base, token))
+        last = m.end()
+    if not parts:
+        return text
+    parts.append(text[last:])
+    return tuple(parts)
+
+def _render(template, base):
+    if isinstance(template, basestring):
+        return template
+    text = []
+    for part in template:
+        if not isinstance(part, tuple):
+            text.append(part)
+            continue
+        rva, token = part
+        address = base + rva
+        if token.startswith("0x"):
+            text.append("0x%x" % address)
+        elif "`" in token:
+            text.append("%08x`%08x" % (address >> 32, address & 0xffffffff))
+        elif token.endswith("h"):
+            digits = token[:-1]
+            fmt = "%0*X" if digits == digits.upper() else "%0*x"
+            text.append(fmt % (len(digits), address) + "h")
+        else:
+            text.append("%0*x" % (len(token), address))
+    return "".join(text)
+
+
+class DisassemblyCache(object):
+    '''
+    decoder: decoder(address, count, end) -> [Instruction, ...], see
+             Control.disassemble
+    '''
+    def __init__(self, dbg, decoder=None):
+        self.dbg = dbg
+        self.decoder = decoder or dbg.control.disassemble
+        self.hits = 0
+        self.misses = 0
+        # (name, timestamp, checksum) -> {rva: (size, text or _template())}
+        self._builds = {}
+        # written to modules: (pid, base, build) -> their own cache
+        self._dirty = {}
+        # modules of the current context: sorted bases, base -> (end, build)
+        self._bases = []
+        self._modules = {}
+        self._pid = None
+
+        dbg.add_write_listener(self._on_write)
+        dbg.add_hook('UNLOADMODULE', self._on_unload_module)
+        dbg.add_hook('EXITPROCESS', self._on_exit_process)
+
+    def _module(self, address):
+        '''-> (base, cache of the build) or (None, None) outside any module'''
+        pid = self.dbg.context.pid
+        if pid != self._pid:
+            self._forget_modules()
+            self._pid = pid
+        i = bisect.bisect_right(self._bases, address) - 1
+        if i >= 0:
+            base = self._bases[i]
+            end, build = self._modules[base]
+            if address < end:
+                return base, self._cache(base, build)
+
+        symbols = self.dbg.symbols
+        mod = symbols.get_module_by_offset(address)
+        if mod is None:
+            return None, None
+        index, base = mod
+        params = symbols.get_module_parameters(base)
+        build = (symbols.get_module_name(index, base).lower(),
+                 params.timestamp, params.checksum)
+        self._builds.setdefault(build, {})
+        bisect.insort(self._bases, base)
+        self._modules[base] = (base + params.size, build)
+        return base, self._cache(base, build)
+
+    def _cache(self, base, build):
+        cache = self._dirty.get((self._pid, base, build))
+        if cache is None:
+            return self._builds[build]
+        return cache
+
+    def _forget_modules(self):
+        self._bases = []
+        self._modules = {}
+
+    def disassemble(self, address, count=1, end=None):
+        '''disassemble(address, count=1, end=None) -> [Instruction, ...]
+
+        Same as Control.disassemble, whatever isn't cached is decoded in
+        one call to the decoder.
+        '''
+        instructions = []
+        base, cache = self._module(address)
+        while address < end if end is not None else len(instructions) < count:
+            if cache is None:
+                break
+            if not base <= address < self._modules[base][0]:
+                # walked into the next module, or out of them
+                base, cache = self._module(address)
+                continue
+            hit = cache.get(address - base)
+            if hit is None:
+                break
+            instructions.append(idebug.Instruction(address, hit[0],
+                                                   _render(hit[1], base)))
+            address += hit[0]
+            self.hits += 1
+        else:
+            return instructions
+
+        if end is not None:
+            decoded = self.decoder(address, end=end)
+        else:
+            decoded = self.decoder(address, count - len(instructions))
+        self.misses += len(decoded)
+        instructions.extend(decoded)
+        for insn in decoded:
+            if cache is None or not base <= insn.address < self._modules[base][0]:
+                base, cache = self._module(insn.address)
+            if cache is not None:
+                cache[insn.address - base] = (insn.size,
+                        _template(insn.text, base, self._modules[base][0]))
+        return instructions
+
+    def invalidate(self, address, size):
+        '''drop what is cached of [address, address+size)'''
+        base, cache = self._module(address)
+        if cache is None:
+            return
+        key = (self._pid, base, self._modules[base][1])
+        if key not in self._dirty:
+            # what was decoded before the write still holds elsewhere
+            cache = self._dirty[key] = dict(cache)
+        if not cache:
+            return
+        start = address - base - MAX_INSN + 1
+        end = address - base + size
+        if end - start > len(cache):
+            for rva in [rva for rva in cache if start <= rva < end]:
+                del cache[rva]
+        else:
+            for rva in xrange(start, end):
+                cache.pop(rva, None)
+
+    def clear(self):
+        self._builds.clear()
+        self._dirty.clear()
+        self._forget_modules()
+
+    def _on_write(self, address, size):
+        if size:
+            self.invalidate(address, size)
+
+    def _on_unload_module(self, event):
+        self._forget_modules()
+        pid = self.dbg.context.pid
+        for key in [key for key in self._dirty
+                    if key[:2] == (pid, event.baseOffset)]:
+            del self._dirty[key]
+
+    def _on_exit_process(self, exitcode):
+        self._forget_modules()
+        self._pid = None
+        pid = self.dbg.systemobjects.get_event_process()
+        for key in [key for key in self._dirty if key[0] == pid]:
+            del self._dirty[key]
+
+    def close(self):
+        self.dbg.remove_write_listener(self._on_write)
+        self.dbg._events.remove_hook('UNLOADMODULE', self._on_unload_module)
+        self.dbg._events.remove_hook('EXITPROCESS', self._on_exit_process)
+
+
+def capstone_decoder(dbg):
+    '''capstone_decoder(dbg) -> decoder that doesn't need the engine's disassembler
+
+    Needs the capstone module.
+    '''
+    import capstone
+
+    x64 = dbg.control.is_pointer_64bit()
+    md = capstone.Cs(capstone.CS_ARCH_X86,
+                     capstone.CS_MODE_64 if x64 else capstone.CS_MODE_32)
+
+    def decoder(address, count=1, end=None):
+        size = (end - address) if end is not None else count * MAX_INSN
+        try:
+            code = dbg.dataspaces.read(address, size)
+        except RuntimeError:
+            return []
+        instructions = []
+        for insn in md.disasm_lite(code, address):
+            addr, length, mnemonic, operands = insn
+            instructions.append(idebug.Instruction(addr, length,
+                                    ("%s %s" % (mnemonic, operands)).strip()))
+            if end is None and len(instructions) == count:
+                break
+        return instructions
+    return decoder
@@ -0,0 +1,258 @@
+'''Triage a directory tree of crash dumps in parallel.
+
+    python -m buggery.dumptriage [-j 8] [--csv] [--frames 8] out.jsonl dumps/...
+
+Every .dmp under the directories is hashed, and the ones whose hash is
+already in the output file are skipped, so an interrupted run picks up
+where it stopped and the same dump under two names is done once. The rest
+are fanned out over a process pool, each worker opens dumps with its own
+Debugger and pulls out the exception record, the faulting module+offset,
+the registers and the top frames, bucketed like crashbucket does. Results
+are appended to the output as they come in, one JSON object a line, or a
+CSV row with --csv. Dumps that failed with an error are tried again on the
+next run.
+
+    stats = dumptriage.triage(["dumps"], "triage.jsonl", workers=8)
+
+backend, if given, replaces the engine: a picklable (module level)
+callable that is called once in every worker and returns a function of
+the dump's path that returns the result dict.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import getopt
+import hashlib
+import multiprocessing
+
+
+REGISTERS = {
+    4: ("eax", "ebx", "ecx", "edx", "esi", "edi", "ebp", "esp", "eip", "efl"),
+    8: ("rax", "rbx", "rcx", "rdx", "rsi", "rdi", "rbp", "rsp", "r8", "r9",
+        "r10", "r11", "r12", "r13", "r14", "r15", "rip", "efl"),
+}
+
+COLUMNS = ("hash", "path", "status", "code", "address", "module", "offset",
+           "exact", "fuzzy", "frames", "error")
+
+
+def content_hash(path, blocksize=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def _hash_one(path):
+    try:
+        return path, content_hash(path)
+    except (IOError, OSError), e:
+        return path, None
+
+def find_dumps(roots, suffix=".dmp"):
+    '''find_dumps([dir or file, ...]) -> sorted paths of every dump under them'''
+    paths = []
+    for root in roots:
+        if os.path.isfile(root):
+            paths.append(root)
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            paths.extend(os.path.join(dirpath, name) for name in filenames
+                         if name.lower().endswith(suffix))
+    return sorted(paths)
+
+
+def engine_backend(frames=8):
+    '''the default backend, a Debugger that opens one dump after the other'''
+    from debug import Debugger
+    import idebug
+    import crashbucket
+
+    dbg = Debugger()
+    bucketer = crashbucket.CrashBucketer(dbg, None, frames=frames)
+
+    def triage_dump(path):
+        dbg.opendump(path)
+        try:
+            evtype, pid, tid, extra = dbg.control.get_last_event()
+            result = {'event': evtype, 'tid': tid}
+            if evtype != idebug.DbgEng.DEBUG_EVENT_EXCEPTION:
+                result['status'] = 'no exception'
+                return result
+            evtype, pid, tid, exinfo = dbg.control.get_access_violation_event()
+            try:
+                # registers and stack of the exception, not of the dump writer
+                dbg.execute(".ecxr")
+            except Exception:
+                pass
+            info = bucketer.bucket(exinfo.code, exinfo.address)
+            result.update({'status': 'crash', 'code': info.code,
+                           'address': info.address, 'module': info.module,
+                           'offset': info.offset, 'exact': info.exact,
+                           'fuzzy': info.fuzzy,
+                           'frames': ["%s+%x" % frame for frame in info.frames]})
+            if exinfo.nparams:
+                # info starts at ExceptionInformation[2]
+                params = [exinfo.av_flag, exinfo.av_address] + list(exinfo.info)
+                result['params'] = params[:exinfo.nparams]
+            regs = {}
+            for name in REGISTERS[dbg.ptr_size]:
+                try:
+                    regs[name] = dbg.registers[name]
+                except Exception:
+                    pass
+            result['registers'] = regs
+            return result
+        finally:
+            dbg.closedump()
+    return triage_dump
+
+
+# worker side
+_triage = None
+
+def _init_worker(backend, frames):
+    global _triage
+    if backend is None:
+        _triage = engine_backend(frames)
+    else:
+        _triage = backend()
+
+def _run_one(item):
+    path, digest = item
+    start = time.time()
+    try:
+        result = _triage(path)
+    except Exception, e:
+        result = {'status': 'error', 'error': repr(e)}
+    result['path'] = path
+    result['hash'] = digest
+    result['elapsed'] = time.time() - start
+    return result
+
+
+# output
+def _csv_row(result):
+    row = []
+    for column in COLUMNS:
+        value = result.get(column)
+        if column == "frames" and value is not None:
+            value = ";".join(value)
+        elif isinstance(value, (int, long)) and column in ("code", "address", "offset"):
+            value = "0x%x" % value
+        row.append("" if value is None else value)
+    return row
+
+def done_hashes(path, columnar=False):
+    '''done_hashes(output) -> set of the hashes already in it, but for the
+    ones that failed with an error'''
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb") as fp:
+        if columnar:
+            for row in csv.reader(fp):
+                if row and row[0] != "hash" and row[2] != "error":
+                    done.add(row[0])
+            return done
+        for line in fp:
+            try:
+                result = json.loads(line)
+                if result.get('status') != 'error':
+                    done.add(result['hash'])
+            except (ValueError, KeyError, AttributeError):
+                # a line cut short when the last run was killed
+                continue
+    return done
+
+
+def triage(roots, output, workers=None, columnar=False, frames=8,
+           backend=None, on_result=None):
+    '''triage([dir, ...], output, ...) -> stats dict'''
+    start = time.time()
+    done = done_hashes(output, columnar)
+    paths = find_dumps(roots)
+    stats = {'dumps': len(paths), 'skipped': 0, 'triaged': 0, 'errors': 0,
+             'unreadable': 0}
+
+    fresh = not os.path.exists(output) or not os.path.getsize(output)
+    fp = open(output, "ab")
+    writer = csv.writer(fp) if columnar else None
+    if writer is not None and fresh:
+        writer.writerow(COLUMNS)
+
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(),
+                                _init_worker, (backend, frames),
+                                maxtasksperchild=500)
+    try:
+        todo = []
+        for path, digest in pool.imap_unordered(_hash_one, paths, 16):
+            if digest is None:
+                stats['unreadable'] += 1
+            elif digest in done:
+                stats['skipped'] += 1
+            else:
+                done.add(digest)
+                todo.append((path, digest))
+
+        for result in pool.imap_unordered(_run_one, todo):
+            if writer is not None:
+                writer.writerow(_csv_row(result))
+            else:
+                fp.write(json.dumps(result) + "\n")
+            # every result is a checkpoint
+            fp.flush()
+            stats['triaged'] += 1
+            if result.get('status') == 'error':
+                stats['errors'] += 1
+            if on_result is not None:
+                on_result(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        fp.close()
+
+    stats['elapsed'] = time.time() - start
+    return stats
+
+
+def main(args):
+    usage = "usage: dumptriage.py [-j workers] [--csv] [--frames N] output dir..."
+    try:
+        opts, args = getopt.getopt(args, "hj:", ["help", "csv", "frames="])
+    except getopt.GetoptError, e:
+        print e
+        print usage
+        return 1
+    workers, columnar, frames = None, False, 8
+    for opt, value in opts:
+        if opt in ("-h", "--help"):
+            print usage
+            return 0
+        if opt == "-j":
+            workers = int(value)
+        elif opt == "--csv":
+            columnar = True
+        elif opt == "--frames":
+            frames = int(value)
+    if len(args) < 2:
+        print usage
+        return 1
+
+    def progress(result):
+        sys.stderr.write("%s %s %s\n" % (result.get('status'), result.get('fuzzy', ''),
+                                         result['path']))
+    stats = triage(args[1:], args[0], workers, columnar, frames, on_result=progress)
+    print "%(triaged)d triaged, %(skipped)d skipped, %(errors)d errors in %(elapsed).1fs" % stats
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,417 @@
+'''Run a Debugger on its own thread.
+
+DbgEng clients are thread affine: the Debugger has to be created, and every
+call made, on one thread. EngineThread owns that thread. It waits for events
+with a short timeout and, in between, runs the calls other threads queue
+up with call(). A queued call also interrupts a wait that is in progress,
+so it doesn't sit out the timeout.
+
+    engine = EngineThread()
+    engine.start()
+    engine.call(Debugger.spawn, "notepad.exe").result()
+    engine.go()
+    for event in engine.events(timeout=5):
+        print event.type
+
+AsyncDebugger puts asyncio on top of that, if asyncio (or trollius on
+python 2) is around:
+
+    adbg = AsyncDebugger(engine)
+    yield From(adbg.call('spawn', "notepad.exe"))
+    yield From(adbg.go())
+    events = adbg.events()
+    event = yield From(events.next_event())
+
+The event stream also has __aiter__/__anext__, for `async for`.
+
+Event payloads (Breakpoint objects in particular) wrap engine interfaces,
+look at them from inside call() rather than from the thread that got them.
+'''
+import sys
+import threading
+import Queue
+from collections import namedtuple
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+EngineEvent = namedtuple("EngineEvent", "type, event")
+
+# the engine has stopped, no more events
+STOPPED = EngineEvent('STOPPED', None)
+
+
+class CancelledError(Exception): pass
+class TimeoutError(Exception): pass
+
+
+class EngineFuture(object):
+    '''Result of a call() made on the engine thread'''
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._cancelled = False
+        self._callbacks = []
+
+    def cancel(self):
+        '''cancel() -> True if the call hadn't started yet and won't run'''
+        with self._lock:
+            if self._done.is_set() or self._cancelled is None:
+                return False
+            self._cancelled = True
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return bool(self._cancelled)
+    def done(self):
+        return self._done.is_set()
+
+    def _start(self):
+        # -> False if cancelled; after this the call can't be cancelled
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._cancelled = None
+            return True
+
+    def _set_result(self, result):
+        self._result = result
+        self._finish()
+    def _set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        '''callback(future) runs on the engine thread, or right away if done'''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Engine call didn't finish in %r seconds" % timeout)
+        if self._cancelled:
+            raise CancelledError()
+        return self._exc_info and self._exc_info[1]
+
+    def result(self, timeout=None):
+        if self.exception(timeout) is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class EngineThread(threading.Thread):
+    '''Owns a Debugger and runs its event loop.
+
+    factory: called on the engine thread to make the Debugger
+    timeout_ms: longest a wait may run before queued calls get a look in
+    '''
+    def __init__(self, factory=None, timeout_ms=100, maxevents=0):
+        super(EngineThread, self).__init__(name="buggery-engine")
+        self.daemon = True
+        self.dbg = None
+        self.timeout_ms = timeout_ms
+        self._factory = factory
+        self._requests = Queue.Queue()
+        self._subscribers = []
+        self._sublock = threading.Lock()
+        self._maxevents = maxevents
+        self._ready = threading.Event()
+        self._stopping = False
+        self._waiting = False
+        self._startup_error = None
+
+    # these run on the engine thread
+    def run(self):
+        try:
+            if self._factory is None:
+                from debug import Debugger
+                self._factory = Debugger
+            self.dbg = self._factory()
+            for eventtype in self.dbg.EVENT_INTERESTS:
+                self.dbg.add_hook(eventtype, self._make_tap(eventtype),
+                                  add_interest=False)
+        except Exception, e:
+            self._startup_error = e
+            self._ready.set()
+            self._publish(STOPPED)
+            return
+        self._ready.set()
+
+        try:
+            while not self._stopping:
+                if self._waiting:
+                    self._run_requests(block=False)
+                    self._wait()
+                else:
+                    self._run_requests(block=True)
+        finally:
+            self._publish(STOPPED)
+            while True:
+                try:
+                    future = self._requests.get_nowait()[0]
+                except Queue.Empty:
+                    break
+                future.cancel()
+
+    def _make_tap(self, eventtype):
+        def tap(event):
+            self._publish(EngineEvent(eventtype, event))
+        return tap
+
+    def _wait(self):
+        try:
+            self.dbg.wait_for_event(self.timeout_ms)
+        except Exception, e:
+            # typically no debuggee left, stop waiting until told to go()
+            self._waiting = False
+            self._publish(EngineEvent('ERROR', e))
+
+    def _run_requests(self, block):
+        while True:
+            try:
+                if block:
+                    request = self._requests.get()
+                    block = False
+                else:
+                    request = self._requests.get_nowait()
+            except Queue.Empty:
+                return
+            future, fn, args, kwargs = request
+            if not future._start():
+                continue
+            try:
+                future._set_result(fn(self.dbg, *args, **kwargs))
+            except Exception:
+                future._set_exception(sys.exc_info())
+
+    def _publish(self, event):
+        with self._sublock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub(event)
+
+    # these are for everyone else
+    def wait_ready(self, timeout=None):
+        '''wait_ready(timeout) -> the Debugger, once it has been created'''
+        self._ready.wait(timeout)
+        if self._startup_error is not None:
+            raise self._startup_error
+        return self.dbg
+
+    def _wake(self):
+        if self._waiting and self.dbg is not None:
+            self.dbg.break_wait()
+
+    def call(self, fn, *args, **kwargs):
+        '''call(fn, *args, **kwargs) -> EngineFuture
+
+        Runs fn(debugger, *args, **kwargs) on the engine thread. fn can be
+        the name of a Debugger method.
+        '''
+        if isinstance(fn, basestring):
+            name = fn
+            fn = lambda dbg, *a, **kw: getattr(dbg, name)(*a, **kw)
+        future = EngineFuture()
+        self._requests.put((future, fn, args, kwargs))
+        self._wake()
+        return future
+
+    def go(self):
+        '''start waiting for events, e.g. after spawn()/attach()'''
+        def waiting(dbg):
+            self._waiting = True
+        return self.call(waiting)
+
+    def pause(self):
+        '''stop waiting for events, the target stays broken in'''
+        def waiting(dbg):
+            self._waiting = False
+        return self.call(waiting)
+
+    def stop(self, timeout=None):
+        def stopping(dbg):
+            self._stopping = True
+        self.call(stopping)
+        self.join(timeout)
+
+    def subscribe(self, callback):
+        '''callback(EngineEvent) is called on the engine thread'''
+        with self._sublock:
+            self._subscribers.append(callback)
+    def unsubscribe(self, callback):
+        with self._sublock:
+            self._subscribers.remove(callback)
+
+    def events(self, timeout=None):
+        '''events(timeout) -> iterator of EngineEvent
+
+        Ends when the engine stops, or when no event arrived for `timeout`
+        seconds. Events that arrive faster than they are consumed are
+        queued, up to `maxevents` of them if that is set; past that new
+        events are dropped, except the end, which pushes the oldest out.
+        '''
+        queue = Queue.Queue(self._maxevents)
+        def put(event):
+            while True:
+                try:
+                    queue.put_nowait(event)
+                    return
+                except Queue.Full:
+                    if event is not STOPPED:
+                        return
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    pass
+        self.subscribe(put)
+        try:
+            while True:
+                try:
+                    event = queue.get(timeout=timeout)
+                except Queue.Empty:
+                    return
+                if event is STOPPED:
+                    return
+                yield event
+        finally:
+            self.unsubscribe(put)
+
+
+if asyncio is not None:
+    try:
+        _StopAsyncIteration = StopAsyncIteration
+    except NameError:
+        _StopAsyncIteration = StopIteration
+
+    class _AsyncEvents(object):
+        def __init__(self, adbg, maxevents):
+            self._adbg = adbg
+            self._loop = adbg.loop
+            self._queue = asyncio.Queue(maxevents)
+            self._closed = False
+            adbg.engine.subscribe(self._put)
+
+        def _put(self, event):
+            # engine thread
+            self._loop.call_soon_threadsafe(self._put_nowait, event)
+
+        def _put_nowait(self, event):
+            if event is STOPPED:
+                self.close()
+                if self._queue.full():
+                    # make room, a consumer waiting on the end must get it
+                    self._queue.get_nowait()
+            try:
+                self._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                pass
+
+        def close(self):
+            if not self._closed:
+                self._closed = True
+                self._adbg.engine.unsubscribe(self._put)
+
+        def __aiter__(self):
+            return self
+
+        def next_event(self):
+            '''next_event() -> future of the next EngineEvent'''
+            return self.__anext__()
+
+        def __anext__(self):
+            future = asyncio.Future(loop=self._loop)
+            get = asyncio.ensure_future(self._queue.get(), loop=self._loop)
+
+            def got(task):
+                if future.cancelled():
+                    return
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                elif task.result() is STOPPED:
+                    future.set_exception(_StopAsyncIteration())
+                else:
+                    future.set_result(task.result())
+            get.add_done_callback(got)
+
+            def cancel_get(f):
+                if f.cancelled():
+                    get.cancel()
+            future.add_done_callback(cancel_get)
+            return future
+
+
+    class AsyncDebugger(object):
+        '''asyncio face of an EngineThread.
+
+        call() returns an asyncio future, cancelling it before the engine
+        thread has picked the call up means it never runs. Use
+        asyncio.wait_for() for timeouts.
+        '''
+        def __init__(self, engine=None, loop=None):
+            if engine is None:
+                engine = EngineThread()
+            if not engine.is_alive():
+                engine.start()
+            self.engine = engine
+            self.loop = loop or asyncio.get_event_loop()
+
+        def call(self, fn, *args, **kwargs):
+            return self._wrap(self.engine.call(fn, *args, **kwargs))
+
+        def _wrap(self, efuture):
+            future = asyncio.Future(loop=self.loop)
+
+            def finished(ef):
+                # engine thread
+                self.loop.call_soon_threadsafe(self._transfer, ef, future)
+            efuture.add_done_callback(finished)
+
+            def cancelled(f):
+                if f.cancelled():
+                    efuture.cancel()
+            future.add_done_callback(cancelled)
+            return future
+
+        def _transfer(self, efuture, future):
+            if future.cancelled():
+                return
+            if efuture.cancelled():
+                future.cancel()
+                return
+            exc = efuture.exception()
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(efuture.result())
+
+        def go(self):
+            return self._wrap(self.engine.go())
+        def pause(self):
+            return self._wrap(self.engine.pause())
+
+        def events(self, maxevents=0):
+            return _AsyncEvents(self, maxevents)
+
+        def stop(self):
+            return self.loop.run_in_executor(None, self.engine.stop)
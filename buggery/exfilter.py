@@ -0,0 +1,171 @@
+import idebug
+
+
+HANDLED = 'handled'
+NOT_HANDLED = 'not_handled'
+IGNORE = 'ignore'
+CALLBACK = 'callback'
+
+_STATUS = {
+    HANDLED: idebug.GO_HANDLED,
+    NOT_HANDLED: idebug.GO_NOT_HANDLED,
+    IGNORE: idebug.GO_IGNORED,
+    CALLBACK: None,
+}
+
+
+class ExceptionRule(object):
+    '''One row of the filter table.
+
+    code: exception code, None matches any code
+    firstchance: True/False to match only first/second chance, None for both
+    address: (start, end) range of the faulting address, or None
+    module: module name the fault has to be in, or None
+    action: HANDLED, NOT_HANDLED, IGNORE or CALLBACK
+    callback: for CALLBACK, called with the ExceptionEvent. If None the
+              Debugger's EXCEPTION handler is called as usual.
+    '''
+    __slots__ = ('code', 'firstchance', 'address', 'module', 'action',
+                 'status', 'callback', 'hits')
+
+    def __init__(self, code=None, firstchance=None, address=None, module=None,
+                 action=NOT_HANDLED, callback=None):
+        if action not in _STATUS:
+            raise RuntimeError("Unknown filter action: %r" % (action,))
+        if address is not None and module is not None:
+            raise RuntimeError("Filter on an address range or a module, not both")
+        self.code = code
+        self.firstchance = firstchance
+        self.address = address
+        self.module = module
+        self.action = action
+        self.status = _STATUS[action]
+        self.callback = callback
+        self.hits = 0
+
+    def __repr__(self):
+        return "ExceptionRule(code=%r, firstchance=%r, address=%r, module=%r, action=%r, hits=%d)" % (
+                self.code, self.firstchance, self.address, self.module,
+                self.action, self.hits)
+
+
+class ExceptionFilter(object):
+    '''Declarative first-look table for exceptions.
+
+    The rules are compiled into a dict keyed by exception code, each entry a
+    short tuple of (firstchance, start, end, rule) in declaration order. The
+    COM callback calls match() before it builds the ExceptionEvent, so a
+    matching HANDLED/NOT_HANDLED/IGNORE rule answers the exception without
+    any further Python work. The first matching rule wins.
+
+    Module rules are turned into address ranges when compiled, and the table
+    is recompiled after module loads/unloads.
+    '''
+    def __init__(self, rules=()):
+        self.rules = []
+        self.misses = 0
+        self._table = {}
+        self._anycode = ()
+        self._dbg = None
+        self._hooked = False
+        self._dirty = True
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule=None, **kwargs):
+        if rule is None:
+            rule = ExceptionRule(**kwargs)
+        self.rules.append(rule)
+        self._dirty = True
+        if rule.module is not None:
+            self._watch_modules()
+        return rule
+
+    def remove_rule(self, rule):
+        self.rules.remove(rule)
+        self._dirty = True
+
+    @property
+    def counters(self):
+        return [(rule, rule.hits) for rule in self.rules]
+
+    def reset_counters(self):
+        self.misses = 0
+        for rule in self.rules:
+            rule.hits = 0
+
+    def _module_rules(self):
+        return [rule for rule in self.rules if rule.module is not None]
+
+    def _watch_modules(self):
+        # module rules need recompiling as modules come and go, whenever
+        # the first one shows up
+        if self._dbg is None or self._hooked:
+            return
+        self._dbg.add_hook('LOADMODULE', self._on_module_change)
+        self._dbg.add_hook('UNLOADMODULE', self._on_module_change)
+        self._hooked = True
+
+    def bind(self, dbg):
+        self._dbg = dbg
+        self._dirty = True
+        if self._module_rules():
+            self._watch_modules()
+
+    def unbind(self):
+        if self._dbg is None:
+            return
+        if self._hooked:
+            for eventtype in ('LOADMODULE', 'UNLOADMODULE'):
+                self._dbg._events.remove_hook(eventtype, self._on_module_change)
+            self._hooked = False
+        self._dbg = None
+
+    def _on_module_change(self, event):
+        self._dirty = True
+
+    def compile(self):
+        table = {}
+        anycode = []
+        for rule in self.rules:
+            if rule.module is not None:
+                if self._dbg is None:
+                    continue
+                span = self._dbg.symbols.get_module_range(rule.module)
+                if span is None:
+                    # not loaded (yet), can't match anything
+                    continue
+                start, end = span
+            elif rule.address is not None:
+                start, end = rule.address
+            else:
+                start, end = 0, None
+
+            entry = (rule.firstchance, start, end, rule)
+            if rule.code is None:
+                anycode.append(entry)
+                for entries in table.values():
+                    entries.append(entry)
+            else:
+                table.setdefault(rule.code, list(anycode)).append(entry)
+
+        self._table = dict((code, tuple(entries))
+                           for code, entries in table.iteritems())
+        self._anycode = tuple(anycode)
+        self._dirty = False
+
+    def match(self, code, firstchance, address):
+        '''match(code, firstchance, address) -> ExceptionRule or None'''
+        if self._dirty:
+            self.compile()
+
+        firstchance = bool(firstchance)
+        for fc, start, end, rule in self._table.get(code, self._anycode):
+            if fc is not None and fc != firstchance:
+                continue
+            if address < start or (end is not None and address >= end):
+                continue
+            rule.hits += 1
+            return rule
+        self.misses += 1
+        return None
@@ -0,0 +1,301 @@
+'''Run a target over many inputs, one Debugger per worker process.
+
+DbgEng clients can't be shared between threads, so the parallelism is in
+processes: each worker owns a Debugger and loops spawn -> event loop ->
+terminate over the inputs the parent hands it, one at a time, over the
+worker's own pipe. A worker killed mid-read can't take the other workers'
+inputs down with it, and the parent always knows which input a worker
+has. The parent watches a per-worker heartbeat, kills and restarts
+workers that hang (an input it never started on goes to another worker),
+and collects
+crashes (bucketed like crashbucket.CrashBucketer does), coverage and
+throughput.
+
+    h = Harness("target.exe %s", files, workers=8, timeout=5.0)
+    stats = h.run()
+    for key, crash in h.crashes.iteritems():
+        print key, crash['count'], crash['input']
+
+setup, if given, is called as setup(dbg) once in every worker and may
+return a callable; that is called after every case and whatever it returns
+(an iterable of covered addresses, say) is merged into Harness.coverage.
+setup has to be picklable, i.e. a module level function.
+'''
+import time
+import ctypes
+import multiprocessing
+import Queue
+
+
+OK = 'ok'
+CRASH = 'crash'
+TIMEOUT = 'timeout'
+HANG = 'hang'
+ERROR = 'error'
+
+
+class _Case(object):
+    def __init__(self):
+        self.exited = False
+        self.exit_code = None
+        self.crash = None
+
+
+def _run_case(dbg, cmdline, timeout, case):
+    deadline = time.time() + timeout
+    dbg.spawn(cmdline)
+    while not case.exited and case.crash is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return TIMEOUT
+        dbg.wait_for_event(int(min(remaining, 0.25) * 1000))
+    if case.crash is not None:
+        return CRASH
+    return OK
+
+
+def _bucket(bucketer, code, address):
+    info = bucketer.bucket(code, address)
+    return {'code': info.code, 'address': info.address, 'module': info.module,
+            'offset': info.offset, 'exact': info.exact, 'fuzzy': info.fuzzy}
+
+
+def _worker(wid, cmdline, tasks, results, heartbeat, timeout,
+            setup, first_chance, frames):
+    from debug import Debugger
+    import idebug
+    import crashbucket
+
+    dbg = Debugger()
+    bucketer = crashbucket.CrashBucketer(dbg, None, frames=frames)
+    case = [_Case()]
+
+    def on_exception(event):
+        if event.firstchance and not first_chance:
+            return idebug.GO_NOT_HANDLED
+        try:
+            case[0].crash = _bucket(bucketer, event.code, event.address)
+        except Exception, e:
+            case[0].crash = {'code': event.code, 'address': event.address,
+                             'error': repr(e)}
+        return idebug.DbgEng.DEBUG_STATUS_BREAK
+
+    def on_exit(exitcode):
+        case[0].exited = True
+        case[0].exit_code = exitcode
+
+    dbg.set_event_handler('EXCEPTION', on_exception)
+    dbg.set_event_handler('EXITPROCESS', on_exit)
+    collect = setup(dbg) if setup is not None else None
+
+    while True:
+        try:
+            item = tasks.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        index, data = item
+        heartbeat[wid] = time.time()
+
+        case[0] = _Case()
+        start = time.time()
+        result = {'index': index, 'input': data, 'worker': wid}
+        try:
+            cmd = cmdline(data) if callable(cmdline) else cmdline % (data,)
+            result['status'] = _run_case(dbg, cmd, timeout, case[0])
+        except Exception, e:
+            result['status'] = ERROR
+            result['error'] = repr(e)
+
+        if not case[0].exited:
+            try:
+                dbg.terminate()
+                dbg.wait_for_event(1000)
+            except Exception:
+                pass
+
+        result['crash'] = case[0].crash
+        result['exit_code'] = case[0].exit_code
+        result['elapsed'] = time.time() - start
+        if collect is not None:
+            try:
+                result['coverage'] = list(collect() or ())
+            except Exception, e:
+                result['coverage_error'] = repr(e)
+
+        heartbeat[wid] = 0.0
+        results.put(result)
+
+
+class Harness(object):
+    '''
+    cmdline: "target.exe %s" (formatted with the input) or callable(input)
+    inputs: iterable of inputs, anything picklable
+    timeout: seconds per case before the target is killed
+    hang_timeout: seconds without a finished case before a worker is
+                  considered hung and restarted (default: 3 * timeout)
+    first_chance: treat first chance exceptions as crashes too
+    on_result: called in the parent with every result dict
+    '''
+    def __init__(self, cmdline, inputs, workers=None, timeout=10.0,
+                 hang_timeout=None, setup=None, first_chance=False,
+                 frames=8, on_result=None):
+        self.cmdline = cmdline
+        self.inputs = inputs
+        self.nworkers = workers or multiprocessing.cpu_count()
+        self.timeout = timeout
+        self.hang_timeout = hang_timeout or 3 * timeout
+        self.setup = setup
+        self.first_chance = first_chance
+        self.frames = frames
+        self.on_result = on_result
+
+        self.crashes = {}
+        self.coverage = set()
+        self.worker_stats = [{'cases': 0, 'busy': 0.0, 'restarts': 0}
+                             for i in xrange(self.nworkers)]
+        self.counts = dict((s, 0) for s in (OK, CRASH, TIMEOUT, HANG, ERROR))
+
+        self._results = multiprocessing.Queue()
+        self._heartbeat = multiprocessing.RawArray(ctypes.c_double, self.nworkers)
+        self._procs = [None] * self.nworkers
+        # the parent's end of every worker's task pipe, and the
+        # (index, input) each one was handed
+        self._tasks = [None] * self.nworkers
+        self._assigned = [None] * self.nworkers
+        self._requeued = []
+
+    def _start_worker(self, wid):
+        self._heartbeat[wid] = 0.0
+        self._assigned[wid] = None
+        receiver, sender = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=_worker,
+                    args=(wid, self.cmdline, receiver, self._results,
+                          self._heartbeat, self.timeout,
+                          self.setup, self.first_chance, self.frames))
+        proc.daemon = True
+        proc.start()
+        receiver.close()
+        self._procs[wid] = proc
+        self._tasks[wid] = sender
+
+    def _feed(self, inputs):
+        for wid in xrange(self.nworkers):
+            if self._assigned[wid] is not None:
+                continue
+            if self._requeued:
+                item = self._requeued.pop()
+            else:
+                item = next(inputs, None)
+                if item is None:
+                    return
+            self._assigned[wid] = item
+            try:
+                self._tasks[wid].send(item)
+            except (IOError, OSError):
+                # the worker is gone, _check_workers() hands it on
+                pass
+
+    def _check_workers(self):
+        now = time.time()
+        for wid, proc in enumerate(self._procs):
+            started = self._heartbeat[wid]
+            hung = started and now - started > self.hang_timeout
+            if proc.is_alive() and not hung:
+                continue
+
+            proc.terminate()
+            proc.join(1.0)
+            self._tasks[wid].close()
+            self.worker_stats[wid]['restarts'] += 1
+            item = self._assigned[wid]
+            if item is not None:
+                if started:
+                    self._record({'index': item[0], 'input': item[1],
+                                  'worker': wid, 'status': HANG,
+                                  'elapsed': now - started, 'crash': None})
+                else:
+                    # died before it got to it
+                    self._requeued.append(item)
+            self._start_worker(wid)
+
+    def _record(self, result):
+        wid = result['worker']
+        item = self._assigned[wid]
+        if item is None or item[0] != result['index']:
+            # from a worker that was already given up on
+            return
+        self._assigned[wid] = None
+        status = result['status']
+        self.counts[status] = self.counts.get(status, 0) + 1
+
+        stats = self.worker_stats[wid]
+        stats['cases'] += 1
+        stats['busy'] += result.get('elapsed', 0.0)
+
+        crash = result.get('crash')
+        if crash is not None:
+            key = crash.get('fuzzy') or "%08x@%x" % (crash['code'], crash['address'])
+            bucket = self.crashes.get(key)
+            if bucket is None:
+                self.crashes[key] = {'count': 1, 'input': result['input'],
+                                     'crash': crash}
+            else:
+                bucket['count'] += 1
+        self.coverage.update(result.get('coverage', ()))
+
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def _drain(self, timeout):
+        try:
+            self._record(self._results.get(timeout=timeout))
+        except Queue.Empty:
+            pass
+        while True:
+            try:
+                self._record(self._results.get_nowait())
+            except Queue.Empty:
+                return
+
+    def run(self):
+        '''run() -> stats dict, blocks until every input has a result'''
+        start = time.time()
+        for wid in xrange(self.nworkers):
+            self._start_worker(wid)
+
+        inputs = enumerate(self.inputs)
+        while True:
+            self._feed(inputs)
+            if all(item is None for item in self._assigned):
+                break
+            self._drain(0.25)
+            self._check_workers()
+
+        for tasks in self._tasks:
+            try:
+                tasks.send(None)
+            except (IOError, OSError):
+                pass
+            tasks.close()
+        for proc in self._procs:
+            proc.join(self.timeout)
+            if proc.is_alive():
+                proc.terminate()
+        return self.stats(time.time() - start)
+
+    def stats(self, elapsed):
+        total = sum(self.counts.values())
+        workers = []
+        for ws in self.worker_stats:
+            ws = dict(ws)
+            ws['execs_per_sec'] = ws['cases'] / ws['busy'] if ws['busy'] else 0.0
+            workers.append(ws)
+        return {'elapsed': elapsed,
+                'cases': total,
+                'execs_per_sec': total / elapsed if elapsed else 0.0,
+                'counts': dict(self.counts),
+                'buckets': len(self.crashes),
+                'coverage': len(self.coverage),
+                'workers': workers}
@@ -0,0 +1,327 @@
+'''Heap tracing: every live allocation of the target, and where it came from.
+
+RtlAllocateHeap, RtlReAllocateHeap and RtlFreeHeap are hooked with
+FunctionSandwich. Each live allocation is a slot in an AllocationTable,
+parallel ctypes arrays of address, size, site and timestamp indexed by an
+open addressed hash of the address, about 28 bytes an allocation where a
+dict of tuples takes ten times that. A site is the call stack of the
+allocation, `frames` deep, interned once and referred to by number.
+
+    heap = heaptrace.HeapTracer(dbg, frames=6)
+    heap.hook()
+    dbg.spawn("target.exe")
+    ...
+    for site in heap.leaks(min_age=30)[:10]:
+        print site['bytes'], site['count'], " <- ".join(site['stack'])
+    print heap.peak()
+    print heap.top_sites(10)
+
+Allocations made before hook() was called aren't known, freeing one is
+only counted (see untracked_frees).
+'''
+import time
+import ctypes
+
+import hookers
+
+
+_EMPTY = 0
+_DELETED = 1    # heap blocks are at least 8 aligned, never at 1
+
+class AllocationTable(object):
+    '''address -> (size, site, timestamp), open addressing, linear probing'''
+    LOAD = 0.7
+
+    def __init__(self, capacity=1 << 16):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._alloc(size)
+        self.count = 0
+        self.bytes = 0
+
+    def _alloc(self, size):
+        self._mask = size - 1
+        self._shift = 64 - (size.bit_length() - 1)
+        self._used = 0      # live + deleted slots
+        self._addr = (ctypes.c_uint64 * size)()
+        self._size = (ctypes.c_uint64 * size)()
+        self._site = (ctypes.c_uint32 * size)()
+        self._time = (ctypes.c_double * size)()
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, address):
+        # fibonacci hashing: the top bits of the 64 bit product, the low
+        # ones only depend on the (alike, 16 byte aligned) low address bits
+        return (((address >> 4) * 0x9E3779B97F4A7C15) & 0xffffffffffffffff) >> self._shift
+
+    def _find(self, address):
+        addrs, mask = self._addr, self._mask
+        i = self._slot(address)
+        while True:
+            key = addrs[i]
+            if key == address:
+                return i
+            if key == _EMPTY:
+                return None
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = self._addr, self._size, self._site, self._time
+        size = len(self._addr)
+        if self.count >= size * self.LOAD / 2:
+            size <<= 1
+        # else it's mostly tombstones, rehash at the same size
+        self._alloc(size)
+        for i, key in enumerate(old[0]):
+            if key > _DELETED:
+                self._put(key, old[1][i], old[2][i], old[3][i])
+
+    def _put(self, address, size, site, timestamp):
+        addrs, mask = self._addr, self._mask
+        i = self._slot(address)
+        while addrs[i] > _DELETED:
+            i = (i + 1) & mask
+        if addrs[i] == _EMPTY:
+            self._used += 1
+        addrs[i] = address
+        self._size[i] = size
+        self._site[i] = site
+        self._time[i] = timestamp
+
+    def insert(self, address, size, site, timestamp):
+        '''insert(address, size, site, timestamp) -> replaced (size, site) or None'''
+        old = self.remove(address)
+        if self._used + 1 > len(self._addr) * self.LOAD:
+            self._grow()
+        self._put(address, size, site, timestamp)
+        self.count += 1
+        self.bytes += size
+        return old
+
+    def get(self, address):
+        '''get(address) -> (size, site, timestamp) or None'''
+        i = self._find(address)
+        if i is None:
+            return None
+        return (self._size[i], self._site[i], self._time[i])
+
+    def remove(self, address):
+        '''remove(address) -> (size, site) or None if it wasn't there'''
+        i = self._find(address)
+        if i is None:
+            return None
+        self._addr[i] = _DELETED
+        size = self._size[i]
+        self.count -= 1
+        self.bytes -= size
+        return (size, self._site[i])
+
+    def __iter__(self):
+        '''-> (address, size, site, timestamp) of every live allocation'''
+        addrs, sizes, sites, times = self._addr, self._size, self._site, self._time
+        for i in xrange(len(addrs)):
+            key = addrs[i]
+            if key > _DELETED:
+                yield key, sizes[i], sites[i], times[i]
+
+
+class HeapTracer(object):
+    '''
+    frames: depth of the stack kept for an allocation site, 0 keeps just
+            the return address (and skips the stack walk)
+    capacity: initial size of the allocation table, it grows as needed
+    '''
+    TAG = "heaptrace"
+
+    def __init__(self, dbg, frames=8, capacity=1 << 16):
+        self.dbg = dbg
+        self.frames = frames
+        self.table = AllocationTable(capacity)
+        self.allocs = 0
+        self.frees = 0
+        self.reallocs = 0
+        self.failed = 0
+        self.untracked_frees = 0
+        self.peak_bytes = 0
+        self.peak_count = 0
+        self.peak_time = None
+
+        # site number -> stack, and back
+        self._stacks = []
+        self._site_ids = {}
+        # per site: allocations, bytes ever allocated through it
+        self._site_allocs = []
+        self._site_bytes = []
+        self._modnames = {}
+        self._sandwiches = []
+        self._argstrs = None
+        # thread id -> RtlReAllocateHeap calls it is in, the RtlAllocateHeap
+        # and RtlFreeHeap those make aren't counted on their own
+        self._reallocating = {}
+        self.started = None
+
+    def hook(self):
+        self.started = time.time()
+        for name, enter, exit in (
+                ("RtlAllocateHeap", self._on_alloc, self._on_alloc_exit),
+                ("RtlReAllocateHeap", self._on_realloc, self._on_realloc_exit),
+                ("RtlFreeHeap", self._on_free, None)):
+            sandwich = hookers.FunctionSandwich(self.dbg, "ntdll!" + name,
+                                                enter, exit)
+            sandwich.inject(deferred=True, tags=(self.TAG,))
+            self._sandwiches.append(sandwich)
+
+    def unhook(self):
+        for sandwich in self._sandwiches:
+            sandwich.remove()
+        self._sandwiches = []
+
+    # hooks
+    def _args(self, count):
+        if self._argstrs is None:
+            code = "Q" if self.dbg.control.is_pointer_64bit() else "I"
+            self._argstrs = ["<" + code * n for n in xrange(5)]
+        return self.dbg.read_args(self._argstrs[count])
+
+    def _site(self):
+        if self.frames:
+            stack = tuple(fr.instruction for fr in
+                          self.dbg.control.get_stack_trace(self.frames + 1)[1:])
+        else:
+            stack = (self.dbg.control.get_return_address(),)
+        try:
+            return self._site_ids[stack]
+        except KeyError:
+            site = self._site_ids[stack] = len(self._stacks)
+            self._stacks.append(stack)
+            self._site_allocs.append(0)
+            self._site_bytes.append(0)
+            return site
+
+    def _track(self, address, size, site):
+        now = time.time()
+        self.table.insert(address, size, site, now)
+        self._site_allocs[site] += 1
+        self._site_bytes[site] += size
+        if self.table.bytes > self.peak_bytes:
+            self.peak_bytes = self.table.bytes
+            self.peak_time = now
+        if self.table.count > self.peak_count:
+            self.peak_count = self.table.count
+
+    def _nested(self):
+        return self.dbg.systemobjects.get_event_thread() in self._reallocating
+
+    def _on_alloc(self):
+        if self._reallocating and self._nested():
+            return hookers.FunctionSandwich.SKIP
+        heap, flags, size = self._args(3)
+        return (size, self._site())
+
+    def _on_alloc_exit(self, retval, retargs):
+        self.allocs += 1
+        if not retval:
+            self.failed += 1
+            return
+        size, site = retargs
+        self._track(retval, size, site)
+
+    def _on_realloc(self):
+        heap, flags, address, size = self._args(4)
+        tid = self.dbg.systemobjects.get_event_thread()
+        self._reallocating[tid] = self._reallocating.get(tid, 0) + 1
+        return (tid, address, size, self._site())
+
+    def _on_realloc_exit(self, retval, retargs):
+        tid, address, size, site = retargs
+        depth = self._reallocating.pop(tid, 1) - 1
+        if depth:
+            self._reallocating[tid] = depth
+        self.reallocs += 1
+        if not retval:
+            # the old block is still there
+            self.failed += 1
+            return
+        if self.table.remove(address) is None:
+            self.untracked_frees += 1
+        self._track(retval, size, site)
+
+    def _on_free(self):
+        if self._reallocating and self._nested():
+            return hookers.FunctionSandwich.SKIP
+        heap, flags, address = self._args(3)
+        if address:
+            self.frees += 1
+            if self.table.remove(address) is None:
+                self.untracked_frees += 1
+        return hookers.FunctionSandwich.SKIP
+
+    # reports
+    def _module_offset(self, address):
+        mod = self.dbg.symbols.get_module_by_offset(address)
+        if mod is None:
+            return "%x" % address
+        index, base = mod
+        try:
+            name = self._modnames[base]
+        except KeyError:
+            name = self._modnames[base] = self.dbg.symbols.get_module_name(index, base)
+        return "%s+%x" % (name, address - base)
+
+    def stack(self, site):
+        '''stack(site) -> ["module+offset", ...], innermost first'''
+        return [self._module_offset(pc) for pc in self._stacks[site]]
+
+    def leaks(self, min_age=0, symbols=True):
+        '''leaks(min_age) -> [dict, ...], live allocations by site, most bytes first
+
+        min_age: only count allocations at least that many seconds old
+        '''
+        cutoff = time.time() - min_age
+        counts = {}
+        sizes = {}
+        for address, size, site, stamp in self.table:
+            if stamp > cutoff:
+                continue
+            counts[site] = counts.get(site, 0) + 1
+            sizes[site] = sizes.get(site, 0) + size
+        rows = [{'site': site, 'count': counts[site], 'bytes': sizes[site]}
+                for site in counts]
+        rows.sort(key=lambda row: row['bytes'], reverse=True)
+        if symbols:
+            for row in rows:
+                row['stack'] = self.stack(row['site'])
+        return rows
+
+    def allocations(self, site):
+        '''allocations(site) -> [(address, size, timestamp), ...] still live'''
+        return [(address, size, stamp) for address, size, s, stamp in self.table
+                if s == site]
+
+    def peak(self):
+        return {'peak_bytes': self.peak_bytes, 'peak_count': self.peak_count,
+                'peak_time': self.peak_time, 'live_bytes': self.table.bytes,
+                'live_count': self.table.count}
+
+    def top_sites(self, count=10, key='bytes', symbols=True):
+        '''top_sites(count, key) -> [dict, ...], sites by everything they ever
+        allocated, key is 'bytes' or 'allocs'
+        '''
+        totals = self._site_bytes if key == 'bytes' else self._site_allocs
+        order = sorted(xrange(len(totals)), key=totals.__getitem__, reverse=True)
+        rows = [{'site': site, 'allocs': self._site_allocs[site],
+                 'bytes': self._site_bytes[site]} for site in order[:count]]
+        if symbols:
+            for row in rows:
+                row['stack'] = self.stack(row['site'])
+        return rows
+
+    def stats(self):
+        return {'allocs': self.allocs, 'frees': self.frees,
+                'reallocs': self.reallocs, 'failed': self.failed,
+                'untracked_frees': self.untracked_frees,
+                'sites': len(self._stacks), 'live_count': self.table.count,
+                'live_bytes': self.table.bytes}
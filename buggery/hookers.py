@@ -1,5 +1,12 @@
 
 class FunctionSandwich(object):
+    '''Calls on_enter(*args, **kwargs) when func_name is entered and
+    on_exit(retval, retargs) when it returns, retargs being whatever
+    on_enter returned. on_enter returning FunctionSandwich.SKIP skips the
+    exit hook for that call.
+    '''
+    SKIP = object()
+
     def __init__(self, dbg, func_name, on_enter, on_exit, *args, **kwargs):
         self.dbg = dbg
         self.func_name = func_name
@@ -8,33 +15,49 @@ class FunctionSandwich(object):
         self.args = args
         self.kwargs = kwargs
         self._bp_id = None
+        self._deferred = None
+
+    def inject(self, deferred=False, tags=()):
+        '''inject(deferred=False, tags=())
 
-    def inject(self):
-        bp = self.dbg.breakpoint(self.func_name,callback=self._on_enter)
+        deferred: func_name is "module!symbol" and the hook is armed when
+                  the module loads (see deferred.py)
+        '''
+        if deferred:
+            module, symbol = self.func_name.split("!", 1)
+            self._deferred = self.dbg.deferred_breakpoint(module, symbol,
+                                        self._on_enter, tags=tags)
+            return
+        bp = self.dbg.breakpoint(self.func_name,callback=self._on_enter,
+                                 tags=tags)
         self._bp_id = bp.id
-        bp.enable()
+        self.dbg.breakpoints.set_enabled(bp.id)
 
     def remove(self):
         if self._bp_id is not None:
-            self.dbg.control.remove_breakpoint(self._bp_id)
+            self.dbg.remove_breakpoint(self._bp_id)
             self._bp_id = None
+        if self._deferred is not None:
+            self.dbg.remove_deferred_breakpoint(self._deferred)
+            self._deferred = None
 
     def _on_enter(self, bp, *args, **kwargs):
         # run the pre-function callback, keep retval for on_exit_cb()
-        args = self.on_enter(*self.args, **self.kwargs)
+        retargs = self.on_enter(*self.args, **self.kwargs)
+        if retargs is self.SKIP:
+            return
 
         # set the exit hook
         threadid = self.dbg.systemobjects.get_event_thread()
         retaddr = self.dbg.control.get_return_address()
 
 
-        nbp = self.dbg.add_breakpoint(retaddr, oneshot=True,
-                                      callback=self._on_exit,
-                                      args=args)
+        nbp = self.dbg.breakpoint(retaddr, self._on_exit, oneshot=True,
+                                  args=(retargs,))
         # multi thread safe, fuck yeah!
         nbp.set_match_thread_id(threadid)
 
-    def _on_exit(self, bp, retargs, *args, **kwargs):
+    def _on_exit(self, bp, retargs):
         regs = { 4: "eax", 8: "rax" }
         retreg = regs[self.dbg.ptr_size]
 
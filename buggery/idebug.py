@@ -1,9 +1,9 @@
 
 import comtypes
 import ctypes as ct
-from comtypes import CoClass, GUID
+from comtypes import CoClass, GUID, COMError
 from comtypes.hresult import S_OK, S_FALSE
-from comtypes.gen import DbgEng
+from utils import DbgEng
 from collections import namedtuple
 import struct
 
@@ -16,13 +16,28 @@ GO_HANDLED = DbgEng.DEBUG_STATUS_GO_HANDLED
 GO_NOT_HANDLED = DbgEng.DEBUG_STATUS_GO_NOT_HANDLED
 GO_IGNORED = DbgEng.DEBUG_STATUS_IGNORE_EVENT
 
+# WaitForEvent() after SetInterrupt(DEBUG_INTERRUPT_EXIT)
+E_PENDING = ct.c_long(0x8000000A).value
+
 
 class Breakpoint(object):
     def __init__(self, bp):
         self.bp = bp
+        self._id = None
     @property
     def id(self):
-        return self.bp.GetId()
+        # ids never change, no need to ask the engine more than once
+        if self._id is None:
+            self._id = self.bp.GetId()
+        return self._id
+
+    @property
+    def flags(self):
+        return self.bp.GetFlags()
+    @property
+    def type(self):
+        breaktype, proctype = self.bp.GetType()
+        return breaktype
 
     def enable(self):
         self.bp.AddFlags(DbgEng.DEBUG_BREAKPOINT_ENABLED)
@@ -35,28 +50,31 @@ class Breakpoint(object):
     def command(self):
         return self.bp.GetCommand()
     @command.setter
-    def set_command(self, cmd):
+    def command(self, cmd):
         self.bp.SetCommand(cmd)
 
     @property
     def passcount(self):
         return self.bp.GetPassCount()
     @passcount.setter
-    def set_passcount(self, count):
+    def passcount(self, count):
         self.bp.SetPassCount(count)
+    @property
+    def current_passcount(self):
+        return self.bp.GetCurrentPassCount()
 
     @property
     def offset(self):
         return self.bp.GetOffset()
     @offset.setter
-    def set_offset(self, offset):
+    def offset(self, offset):
         self.bp.SetOffset(offset)
 
     @property
     def offsetexpression(self):
         return self.bp.GetOffsetExpression()
     @offsetexpression.setter
-    def set_offsetexpression(self, offexpr):
+    def offsetexpression(self, offexpr):
         self.bp.SetOffsetExpression(offexpr)
 
     def set_match_thread_id(self, tid):
@@ -69,21 +87,21 @@ class Watchpoint(Breakpoint):
         size, accesstype = self.bp.GetDataParameters()
         return size
     @size.setter
-    def set_size(self, size):
+    def size(self, size):
         old, accesstype = self.bp.GetDataParameters()
         self.bp.SetDataParameters(size, accesstype)
 
     @property
     def accesstype(self):
-        size, access = self.GetDataParameters()
+        size, access = self.bp.GetDataParameters()
         rv = ""
         rv += 'r' if access & DbgEng.DEBUG_BREAK_READ else '-'
         rv += 'w' if access & DbgEng.DEBUG_BREAK_WRITE else '-'
         rv += 'x' if access & DbgEng.DEBUG_BREAK_EXECUTE else '-'
         return rv
     @accesstype.setter
-    def set_accesstype(self, access):
-        size, old = self.GetDataParameters()
+    def accesstype(self, access):
+        size, old = self.bp.GetDataParameters()
         accesstype = 0
         if 'r' in access:
             accesstype |= DbgEng.DEBUG_BREAK_READ
@@ -137,8 +155,20 @@ CreateProcessEvent = namedtuple("CreateProcessEvent",
 SystemErrorEvent = namedtuple("SystemErrorEvent", "error, level")
 CreateThreadEvent = namedtuple("CreateThreadEvent", "handle, dataOffset, startOffset")
 
+StackFrame = namedtuple("StackFrame",
+                        "instruction, retaddr, frame, stack, number")
+MemoryRegion = namedtuple("MemoryRegion",
+                "base, allocbase, allocprotect, size, state, protect, type")
+ModuleParameters = namedtuple("ModuleParameters",
+                              "base, size, timestamp, checksum, flags")
+Instruction = namedtuple("Instruction", "address, size, text")
+
 
 class EventCallbacks(object):
+    # consulted by DebugEventCallbacks before an exception event is built,
+    # see exfilter.ExceptionFilter
+    exception_filter = None
+
     def onGetInterestMask(self): pass
     def onBreakpoint(self, bp): pass
     def onChangeDebuggeeState(self, flags, arg): pass
@@ -166,11 +196,7 @@ class EventHandler(EventCallbacks):
         return self.handle_event('INTERESTMASK', None)
 
     def onBreakpoint(self, bp):
-        if bp.GetType() == DbgEng.DEBUG_BREAKPOINT_CODE:
-            bp = Breakpoint(bp)
-        else:
-            bp = Watchpoint(bp)
-        return self.handle_event('BREAKPOINT', bp)
+        return self.handle_event('BREAKPOINT', wrap_breakpoint(bp))
 
     def onChangeDebuggeeState(self, flags, arg):
         event = ChangeDebuggeeStateEvent(flags, arg)
@@ -255,10 +281,26 @@ class DebugEventCallbacks(CoClass):
 
     def IDebugEventCallbacks_Exception(self, exception, firstChance):
         ex = exception.contents
+
+        # the filter table gets the first look, so that the noisy exceptions
+        # are answered without building any event objects
+        rule = None
+        exfilter = self._proxy.exception_filter
+        if exfilter is not None:
+            rule = exfilter.match(ex.ExceptionCode, firstChance,
+                                  ex.ExceptionAddress)
+            if rule is not None and rule.status is not None:
+                return rule.status
+
         info = [ex.ExceptionInformation[i] for i in xrange(ex.NumberParameters)]
         event = ExceptionEvent(ex.ExceptionCode, ex.ExceptionFlags,
                                ex.ExceptionRecord, ex.ExceptionAddress,
                                info, firstChance)
+        if rule is not None and rule.callback is not None:
+            retval = rule.callback(event)
+            if retval is None:
+                retval = GO_HANDLED
+            return retval
         return self._proxy.onException(event)
 
     def IDebugEventCallbacks_LoadModule(self, imageFileHandle, baseOffset,
@@ -269,8 +311,7 @@ class DebugEventCallbacks(CoClass):
                                         checkSum, timeDateStamp)
 
     def IDebugEventCallbacks_UnloadModule(self, imageBaseName, baseOffset):
-        event = UnloadModuleEvent(imageBaseName, baseOffset)
-        return self._proxy.onUnloadModule(event)
+        return self._proxy.onUnloadModule(imageBaseName, baseOffset)
 
     def IDebugEventCallbacks_CreateProcess(self, imageFileHandle, handle,
                                            baseOffset, moduleSize,
@@ -349,6 +390,44 @@ class Registers(object):
         return self._registers.GetStackOffset()
     def getframe(self):
         return self._registers.GetFrameOffset()
+    def getpc(self):
+        return self._registers.GetInstructionOffset()
+
+    def get_names(self):
+        '''get_names() -> register names, in the order get_values() has them'''
+        if self._map is None:
+            self._build_map()
+        names = [None] * len(self._map)
+        for name, index in self._map.iteritems():
+            names[index] = name
+        return names
+
+    def get_values(self):
+        '''get_values() -> ctypes array of every register's DEBUG_VALUE'''
+        f = self._registers._IDebugRegisters__com_GetValues
+        count = self._registers.GetNumberRegisters()
+        values = (DbgEng._DEBUG_VALUE * count)()
+        hresult = f(count, None, 0, values)
+        if hresult != S_OK:
+            raise RuntimeError("Reading the registers failed: %d" % hresult)
+        return values
+
+    def set_values(self, values, indices=None):
+        '''set_values(values, indices=None)
+
+        values as returned by get_values(). With indices only those
+        registers are written.
+        '''
+        f = self._registers._IDebugRegisters__com_SetValues
+        if indices is None:
+            hresult = f(len(values), None, 0, values)
+        else:
+            count = len(indices)
+            idx = (ct.c_ulong * count)(*indices)
+            subset = (DbgEng._DEBUG_VALUE * count)(*[values[i] for i in indices])
+            hresult = f(count, idx, 0, subset)
+        if hresult != S_OK:
+            raise RuntimeError("Writing the registers failed: %d" % hresult)
 
     def keys(self):
         if self._map is None:
@@ -387,6 +466,12 @@ class Registers(object):
             raise AttributeError("No such register: %s" % name)
         return self.get_value_by_name(name)
 
+def wrap_breakpoint(bp):
+    breaktype, proctype = bp.GetType()
+    if breaktype == DbgEng.DEBUG_BREAKPOINT_DATA:
+        return Watchpoint(bp)
+    return Breakpoint(bp)
+
 class BreakpointList(object):
     def __init__(self, control):
         self._control = control
@@ -397,7 +482,10 @@ class BreakpointList(object):
             bp = self._control.GetBreakpointByIndex(index)
         else:
             bp = self._control.GetBreakpointById(index)
-        return BreakpointControl(bp)
+        return wrap_breakpoint(bp)
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield wrap_breakpoint(self._control.GetBreakpointByIndex(index))
 
 class Control(object):
     def __init__(self, client):
@@ -409,9 +497,25 @@ class Control(object):
         self._control4 = query_i(interface=DbgEng.IDebugControl4)
 
     def wait_for_event(self, timeout_ms=-1):
-        retval = self._control.WaitForEvent(0, timeout_ms)
+        '''wait_for_event(timeout_ms) -> True, or False if it timed out
+
+        An interrupt with DEBUG_INTERRUPT_EXIT counts as a timeout.
+        '''
+        try:
+            retval = self._control.WaitForEvent(0, timeout_ms)
+        except COMError, e:
+            if e.hresult == E_PENDING:
+                return False
+            raise
+        if retval == S_FALSE:
+            return False
         if retval != S_OK:
             raise RuntimeError("Something fucked up: %d" % retval)
+        return True
+
+    def set_interrupt(self, flags=DbgEng.DEBUG_INTERRUPT_ACTIVE):
+        # one of the few calls that is safe from any thread
+        self._control.SetInterrupt(flags)
 
     def execute(self, cmd):
         self._control.Execute(DbgEng.DEBUG_OUTCTL_THIS_CLIENT, cmd, 0)
@@ -420,6 +524,40 @@ class Control(object):
         naddress = self._control.Assemble(address, asm)
         return naddress
 
+    def disassemble(self, address, count=1, end=None):
+        '''disassemble(address, count=1, end=None) -> [Instruction, ...]
+
+        count instructions from address, or with end every instruction that
+        starts before end. Stops early at anything that won't disassemble.
+        '''
+        f = self._control._IDebugControl__com_Disassemble
+        buf = ct.create_string_buffer(512)
+        size = ct.c_ulong()
+        next = ct.c_ulonglong()
+        instructions = []
+        while address < end if end is not None else len(instructions) < count:
+            hresult = f(ct.c_ulonglong(address), 0, buf, ct.sizeof(buf),
+                        ct.byref(size), ct.byref(next))
+            if hresult != S_OK or next.value <= address:
+                break
+            # "[symbol:\n]address bytes mnemonic operands"
+            fields = buf.value.rstrip().splitlines()[-1].split(None, 2)
+            text = fields[2] if len(fields) == 3 else ""
+            instructions.append(Instruction(address, next.value - address, text))
+            address = next.value
+        return instructions
+
+    def evaluate(self, expr):
+        '''evaluate(expr) -> value of the MASM expression, as an int'''
+        f = self._control._IDebugControl__com_Evaluate
+        value = DbgEng._DEBUG_VALUE()
+        remainder = ct.c_ulong()
+        hresult = f(expr, DbgEng.DEBUG_VALUE_INT64, ct.byref(value),
+                    ct.byref(remainder))
+        if hresult != S_OK:
+            raise RuntimeError("Can't evaluate %r: 0x%x" % (expr, hresult & 0xffffffff))
+        return int(value.u.I64)
+
     def get_execution_status(self):
         status = self._control.GetExecutionStatus()
         return status
@@ -475,6 +613,7 @@ class Control(object):
         if 'x' in mode:
             bpmode |= DbgEng.DEBUG_BREAK_EXECUTE
 
+        bp.SetOffset(address)
         bp.SetDataParameters(size, bpmode)
         bp.AddFlags(DbgEng.DEBUG_BREAKPOINT_ENABLED)
         return Watchpoint(bp)
@@ -498,7 +637,7 @@ class Control(object):
 
         addr = get_address(address)
         if addr is not None:
-            bp.SetOffset(address)
+            bp.SetOffset(addr)
         else:
             bp.SetOffsetExpression(address)
 
@@ -509,10 +648,18 @@ class Control(object):
         return self._control.GetNumberBreakpoints()
     def get_breakpoint_by_index(self, ndx):
         bp = self._control.GetBreakpointByIndex(ndx)
-        return bp
+        return wrap_breakpoint(bp)
     def get_breakpoint_by_id(self, bpid):
         bp = self._control.GetBreakpointById(bpid)
-        return bpid
+        return wrap_breakpoint(bp)
+    def get_breakpoint_ids(self):
+        '''get_breakpoint_ids() -> set of the ids the engine has'''
+        get = self._control.GetBreakpointByIndex
+        return set(get(ndx).GetId()
+                   for ndx in xrange(self._control.GetNumberBreakpoints()))
+    @property
+    def breakpoints(self):
+        return BreakpointList(self._control)
     def remove_breakpoint(self, bpid=None, ndx=None):
         if bpid is not None:
             bp = self._control.GetBreakpointById(bpid)
@@ -539,6 +686,23 @@ class Control(object):
         return self._control.GetReturnOffset()
     get_return_address = get_return_offset
 
+    def get_stack_trace(self, maxframes=32):
+        '''get_stack_trace(maxframes) -> [StackFrame, ...]
+
+        Walks the stack of the current thread, innermost frame first.
+        '''
+        f = self._control._IDebugControl__com_GetStackTrace
+        frames = (DbgEng._DEBUG_STACK_FRAME * maxframes)()
+        filled = ct.c_ulong()
+
+        hresult = f(ct.c_ulonglong(0), ct.c_ulonglong(0), ct.c_ulonglong(0),
+                    frames, maxframes, ct.byref(filled))
+        if hresult != S_OK:
+            raise RuntimeError("Stack trace failed: %d" % hresult)
+        return [StackFrame(fr.InstructionOffset, fr.ReturnOffset,
+                           fr.FrameOffset, fr.StackOffset, fr.FrameNumber)
+                for fr in frames[:filled.value]]
+
 
 class DataSpaces(object):
     def __init__(self, client):
@@ -550,6 +714,8 @@ class DataSpaces(object):
         self._data_space2 = query_i(interface=DbgEng.IDebugDataSpaces2)
         self._data_space3 = query_i(interface=DbgEng.IDebugDataSpaces3)
         self._data_space4 = query_i(interface=DbgEng.IDebugDataSpaces4)
+        # write_listener(address, size) is told about every write
+        self.write_listener = None
 
     def tags(self):
         # TODO:
@@ -567,10 +733,25 @@ class DataSpaces(object):
         return retval
 
     def query(self, address):
-        # I think this might be wrong... dont I need to pass in a buffer
-        # for the MEMINFO struct?
+        '''query(address) -> MemoryRegion'''
         meminfo = self._data_space2.QueryVirtual(address)
-        return meminfo
+        return MemoryRegion(meminfo.BaseAddress, meminfo.AllocationBase,
+                            meminfo.AllocationProtect, meminfo.RegionSize,
+                            meminfo.State, meminfo.Protect, meminfo.Type)
+
+    def iter_regions(self, start=0, end=None):
+        '''iter_regions(start, end) -> MemoryRegion, ... from start up to end'''
+        address = start
+        while end is None or address < end:
+            try:
+                region = self.query(address)
+            except Exception:
+                # past the end of the address space
+                return
+            if region.size == 0:
+                return
+            yield region
+            address = region.base + region.size
 
     def search(self, pattern, base, size, alignment=1):
         '''search(self, pattern, base, size, alignment) -> address
@@ -598,7 +779,7 @@ class DataSpaces(object):
         buf = ct.create_string_buffer(count)
         nbytes = ct.c_ulong()
 
-        f = self._data_space._IDebugDataSpace__com_ReadVirtualUncached
+        f = self._data_space._IDebugDataSpaces__com_ReadVirtualUncached
         hresult = f(ct.c_ulonglong(address), ct.byref(buf), ct.sizeof(buf),
                     ct.byref(nbytes))
         if hresult != S_OK:
@@ -606,14 +787,17 @@ class DataSpaces(object):
         return buf.raw[:nbytes.value]
 
     def write(self, address, buf):
-        nbytes = ct.ulong()
-        f = self._data_space._IDebugDataSpace__com_WriteVirtualUncached
+        nbytes = ct.c_ulong()
+        f = self._data_space._IDebugDataSpaces__com_WriteVirtualUncached
+        data = ct.create_string_buffer(buf, len(buf))
 
-        hresult = f(ct.c_ulonglong(address), ct.byref(buf), ct.c_ulong(len(buf)),
+        hresult = f(ct.c_ulonglong(address), data, ct.c_ulong(len(buf)),
                     ct.byref(nbytes))
 
         if hresult != S_OK:
             raise RuntimeError("Address Space Write FAIL: %d" % hresult)
+        if self.write_listener is not None:
+            self.write_listener(address, nbytes.value)
         return nbytes.value
 
     def search(self, pattern, address=None, length=None):
@@ -632,6 +816,89 @@ class Symbols(object):
             path = self.DEFAULT_PATH
         return self._symbols.SetSymbolPath(path)
 
+    def get_module_by_offset(self, offset):
+        '''get_module_by_offset(offset) -> (index, base)
+
+        Returns None if the offset isn't inside any loaded module.
+        '''
+        f = self._symbols._IDebugSymbols__com_GetModuleByOffset
+        index = ct.c_ulong()
+        base = ct.c_ulonglong()
+        hresult = f(ct.c_ulonglong(offset), 0, ct.byref(index), ct.byref(base))
+        if hresult != S_OK:
+            return None
+        return index.value, base.value
+
+    def get_module_by_name(self, name):
+        '''get_module_by_name(name) -> (index, base)
+
+        Returns None if no module by that name is loaded.
+        '''
+        f = self._symbols._IDebugSymbols__com_GetModuleByModuleName
+        index = ct.c_ulong()
+        base = ct.c_ulonglong()
+        hresult = f(name, 0, ct.byref(index), ct.byref(base))
+        if hresult != S_OK:
+            return None
+        return index.value, base.value
+
+    def get_modules(self):
+        '''get_modules() -> [(index, base), ...] of the loaded modules'''
+        number = ct.c_ulong()
+        unloaded = ct.c_ulong()
+        hresult = self._symbols._IDebugSymbols__com_GetNumberModules(
+                        ct.byref(number), ct.byref(unloaded))
+        if hresult != S_OK:
+            raise RuntimeError("GetNumberModules() failed: %d" % hresult)
+        f = self._symbols._IDebugSymbols__com_GetModuleByIndex
+        modules = []
+        base = ct.c_ulonglong()
+        for index in xrange(number.value):
+            if f(index, ct.byref(base)) == S_OK:
+                modules.append((index, base.value))
+        return modules
+
+    def get_module_parameters(self, base):
+        f = self._symbols._IDebugSymbols__com_GetModuleParameters
+        bases = (ct.c_ulonglong * 1)(base)
+        params = DbgEng._DEBUG_MODULE_PARAMETERS()
+        hresult = f(1, bases, 0, ct.byref(params))
+        if hresult != S_OK:
+            raise RuntimeError("No module at %x: %d" % (base, hresult))
+        return ModuleParameters(params.Base, params.Size, params.TimeDateStamp,
+                                params.Checksum, params.Flags)
+
+    def get_module_range(self, name):
+        '''get_module_range(name) -> (start, end) or None'''
+        mod = self.get_module_by_name(name)
+        if mod is None:
+            return None
+        params = self.get_module_parameters(mod[1])
+        return params.base, params.base + params.size
+
+    def get_offset_by_name(self, name):
+        '''get_offset_by_name("module!symbol") -> offset
+
+        Returns None if the symbol doesn't resolve. With more than one
+        match the engine picks one.
+        '''
+        f = self._symbols._IDebugSymbols__com_GetOffsetByName
+        offset = ct.c_ulonglong()
+        hresult = f(name, ct.byref(offset))
+        if hresult not in (S_OK, S_FALSE):
+            return None
+        return offset.value
+
+    def get_module_name(self, index, base=0):
+        f = self._symbols._IDebugSymbols__com_GetModuleNames
+        name = ct.create_string_buffer(256)
+        name_used = ct.c_ulong()
+        hresult = f(index, ct.c_ulonglong(base), None, 0, None,
+                    name, ct.sizeof(name), ct.byref(name_used), None, 0, None)
+        if hresult != S_OK:
+            raise RuntimeError("No module name for %d: %d" % (index, hresult))
+        return name.value
+
 class SystemObjects(object):
     def __init__(self, client):
         self._client = client
@@ -659,10 +926,38 @@ class SystemObjects(object):
         return self._system_objects.GetNumberThreads()
     num_threads = property(fget=get_number_threads)
 
+    def get_thread_ids(self):
+        '''get_thread_ids() -> [(engine id, system id), ...] of the current process'''
+        count = self.get_number_threads()
+        ids = (ct.c_ulong * count)()
+        sysids = (ct.c_ulong * count)()
+        f = self._system_objects._IDebugSystemObjects__com_GetThreadIdsByIndex
+        hresult = f(0, count, ids, sysids)
+        if hresult != S_OK:
+            raise RuntimeError("Listing the threads failed: %d" % hresult)
+        return zip(ids, sysids)
+
+    def get_number_processes(self):
+        return self._system_objects.GetNumberProcesses()
+
+    def get_process_ids(self):
+        '''get_process_ids() -> [(engine id, system id), ...] of the processes debugged'''
+        count = self.get_number_processes()
+        ids = (ct.c_ulong * count)()
+        sysids = (ct.c_ulong * count)()
+        f = self._system_objects._IDebugSystemObjects__com_GetProcessIdsByIndex
+        hresult = f(0, count, ids, sysids)
+        if hresult != S_OK:
+            raise RuntimeError("Listing the processes failed: %d" % hresult)
+        return zip(ids, sysids)
+
     def get_thread_teb(self):
         addr = self._system_objects.GetCurrentThreadDataOffset()
         return addr
 
+    def get_current_process_handle(self):
+        return self._system_objects.GetCurrentProcessHandle()
+
 
 class Client(object):
     def __init__(self, event_cb=None, output_cb=None, input_cb=None):
@@ -740,5 +1035,8 @@ class Client(object):
     def detach_processes(self):
         self._client.DetachProcesses()
 
+    def end_session(self, flags=DbgEng.DEBUG_END_PASSIVE):
+        self._client.EndSession(flags)
+
     def get_exit_code(self):
         return self._client.GetExitCode()
@@ -0,0 +1,255 @@
+'''Get expensive callback work off the stopped debuggee.
+
+While a callback runs the target is stopped. With an Offloader the callback
+only snapshots a few registers and some memory into a record, drops it in a
+preallocated shared-memory ring buffer and returns. A pool of worker
+processes decodes the records and runs the real (slow) handlers.
+
+    ring = RingBuffer(4096, 512)
+    pool = WorkerPool(ring, {1: parse_request}, workers=4)
+    pool.start()
+
+    off = Offloader(dbg, ring)
+    dbg.breakpoint("ws2_32!recv", off.capture(1, ("rcx", "rdx", "r8"),
+                                              memory=[("rdx", 0, 256)]))
+
+Handlers get a Record and run in the worker processes, so they have to be
+picklable (module level functions). RingBuffer and WorkerPool don't need
+the engine at all.
+'''
+import time
+import struct
+import ctypes
+import multiprocessing
+from collections import namedtuple
+
+
+Record = namedtuple("Record", "tag, tid, timestamp, registers, memory")
+
+_HEADER = struct.Struct("<HIdBB")
+_SLOT_LEN = struct.Struct("<I")
+_MEM_LEN = struct.Struct("<H")
+
+# sent to each worker to make it exit
+_STOP = 0xffff
+
+
+def pack_record(tag, tid, timestamp, regvalues, memory, limit=None):
+    '''pack_record(tag, tid, timestamp, [value, ...], [bytes, ...]) -> str
+
+    With a limit the memory is cut short, the last buffers first, so the
+    record fits in limit bytes if it can.
+    '''
+    if limit is not None:
+        excess = (_HEADER.size + 8 * len(regvalues) + _MEM_LEN.size * len(memory) +
+                  sum(len(buf) for buf in memory) - limit)
+        if excess > 0:
+            memory = list(memory)
+            for i in reversed(xrange(len(memory))):
+                cut = min(excess, len(memory[i]))
+                memory[i] = memory[i][:len(memory[i]) - cut]
+                excess -= cut
+                if not excess:
+                    break
+    parts = [_HEADER.pack(tag, tid, timestamp, len(regvalues), len(memory)),
+             struct.pack("<%dQ" % len(regvalues), *regvalues)]
+    for buf in memory:
+        parts.append(_MEM_LEN.pack(len(buf)))
+        parts.append(buf)
+    return "".join(parts)
+
+
+def unpack_record(data, regnames=None):
+    '''unpack_record(data, regnames) -> Record
+
+    With regnames the registers come back as a dict, otherwise as a tuple.
+    '''
+    tag, tid, timestamp, nregs, nmem = _HEADER.unpack_from(data, 0)
+    offset = _HEADER.size
+    regvalues = struct.unpack_from("<%dQ" % nregs, data, offset)
+    offset += 8 * nregs
+    memory = []
+    for i in xrange(nmem):
+        size, = _MEM_LEN.unpack_from(data, offset)
+        offset += _MEM_LEN.size
+        memory.append(data[offset:offset+size])
+        offset += size
+    if regnames is not None:
+        regvalues = dict(zip(regnames, regvalues))
+    return Record(tag, tid, timestamp, regvalues, memory)
+
+
+class RingBuffer(object):
+    '''Fixed size slots in shared memory, one producer, many consumers.
+
+    Two semaphores count the free and the filled slots, so a full ring
+    either drops (put(block=False)) or pushes back on the producer, and an
+    empty one puts consumers to sleep. Records longer than the slot size
+    are dropped, a record can't be cut without breaking it. Offloader
+    shortens the memory in a record to fit and counts it in `truncated`.
+    '''
+    def __init__(self, nslots=1024, slotsize=512):
+        self.nslots = nslots
+        self.slotsize = slotsize
+        self._buf = multiprocessing.RawArray(ctypes.c_char, nslots * slotsize)
+        # produced, consumed, dropped, truncated
+        self._counters = multiprocessing.RawArray(ctypes.c_ulonglong, 4)
+        self._free = multiprocessing.Semaphore(nslots)
+        self._filled = multiprocessing.Semaphore(0)
+        self._readlock = multiprocessing.Lock()
+
+    @property
+    def produced(self): return self._counters[0]
+    @property
+    def consumed(self): return self._counters[1]
+    @property
+    def dropped(self): return self._counters[2]
+    @property
+    def truncated(self): return self._counters[3]
+
+    def __len__(self):
+        return self._counters[0] - self._counters[1]
+
+    @property
+    def room(self):
+        '''the longest record a slot holds'''
+        return self.slotsize - _SLOT_LEN.size
+
+    def put(self, data, block=False, timeout=None):
+        '''put(data, block, timeout) -> False if the record was dropped'''
+        if len(data) > self.room:
+            self._counters[2] += 1
+            return False
+        if block:
+            ok = self._free.acquire(True, timeout)
+        else:
+            ok = self._free.acquire(False)
+        if not ok:
+            self._counters[2] += 1
+            return False
+
+        slot = self._counters[0] % self.nslots
+        address = ctypes.addressof(self._buf) + slot * self.slotsize
+        ctypes.memmove(address, _SLOT_LEN.pack(len(data)), _SLOT_LEN.size)
+        ctypes.memmove(address + _SLOT_LEN.size, data, len(data))
+        self._counters[0] += 1
+        self._filled.release()
+        return True
+
+    def get(self, timeout=None):
+        '''get(timeout) -> str, or None if nothing arrived in time'''
+        if timeout is None:
+            ok = self._filled.acquire()
+        else:
+            ok = self._filled.acquire(True, timeout)
+        if not ok:
+            return None
+
+        with self._readlock:
+            slot = self._counters[1] % self.nslots
+            address = ctypes.addressof(self._buf) + slot * self.slotsize
+            size, = _SLOT_LEN.unpack(ctypes.string_at(address, _SLOT_LEN.size))
+            data = ctypes.string_at(address + _SLOT_LEN.size, size)
+            self._counters[1] += 1
+        self._free.release()
+        return data
+
+
+def _worker(ring, handlers, regnames):
+    while True:
+        data = ring.get()
+        tag, = struct.unpack_from("<H", data, 0)
+        if tag == _STOP:
+            return
+        handler = handlers.get(tag)
+        if handler is None:
+            continue
+        try:
+            handler(unpack_record(data, regnames.get(tag)))
+        except Exception:
+            # a bad record must not take the worker down
+            import traceback
+            traceback.print_exc()
+
+
+class WorkerPool(object):
+    '''Processes consuming a RingBuffer.
+
+    handlers: {tag: handler(Record)}
+    regnames: {tag: (register names, ...)} to get the registers as a dict,
+              Offloader.regnames has them for every capture it made.
+    '''
+    def __init__(self, ring, handlers, workers=None, regnames=None):
+        self.ring = ring
+        self.handlers = handlers
+        self.regnames = regnames or {}
+        self.nworkers = workers or multiprocessing.cpu_count()
+        self.workers = []
+
+    def start(self):
+        for i in xrange(self.nworkers):
+            proc = multiprocessing.Process(target=_worker,
+                                           args=(self.ring, self.handlers,
+                                                 self.regnames))
+            proc.daemon = True
+            proc.start()
+            self.workers.append(proc)
+
+    def stop(self, timeout=None):
+        '''drains the ring, then stops the workers'''
+        stop = _HEADER.pack(_STOP, 0, 0, 0, 0)
+        for proc in self.workers:
+            self.ring.put(stop, block=True)
+        for proc in self.workers:
+            proc.join(timeout)
+        self.workers = []
+
+
+class Offloader(object):
+    '''Debugger side: turns captures into ring buffer records.
+
+    block/timeout: what to do when the ring is full. By default the record
+    is dropped (and counted), block=True makes the debuggee wait instead.
+    '''
+    def __init__(self, dbg, ring, block=False, timeout=None):
+        self.dbg = dbg
+        self.ring = ring
+        self.block = block
+        self.timeout = timeout
+        self.regnames = {}
+
+    def submit(self, tag, regvalues=(), memory=()):
+        tid = self.dbg.systemobjects.get_event_thread()
+        data = pack_record(tag, tid, time.time(), regvalues, memory,
+                           self.ring.room)
+        if len(data) < _HEADER.size + 8 * len(regvalues) + \
+                       sum(_MEM_LEN.size + len(buf) for buf in memory):
+            self.ring._counters[3] += 1
+        return self.ring.put(data, self.block, self.timeout)
+
+    def capture(self, tag, registers=(), memory=(), status=None):
+        '''capture(tag, registers, memory) -> breakpoint callback
+
+        registers: names of the registers to snapshot
+        memory: [(register, offset, size), ...] bytes to copy from
+                register+offset. Unreadable memory gives an empty string.
+        status: what the callback returns to the engine
+        '''
+        if tag == _STOP:
+            raise RuntimeError("Tag 0x%x is reserved" % _STOP)
+        registers = tuple(registers)
+        self.regnames[tag] = registers
+        regs = self.dbg.registers
+        read = self.dbg.dataspaces.read
+
+        def callback(bp, *args, **kwargs):
+            values = [regs[name] for name in registers]
+            mem = []
+            for name, offset, size in memory:
+                try:
+                    mem.append(read(regs[name] + offset, size))
+                except Exception:
+                    mem.append("")
+            self.submit(tag, values, mem)
+            return status
+        return callback
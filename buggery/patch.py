@@ -0,0 +1,227 @@
+'''Memory patches that can be taken back.
+
+A PatchSet is a batch of (offset, bytes) patches, absolute addresses or
+RVAs into one module. The PatchManager applies a set as a whole: patches
+that touch or sit less than `gap` bytes apart are coalesced into one run,
+the original bytes of every run are read and kept, then each run is one
+WriteVirtual. If any write fails the runs already written are put back,
+so a set is either all in or all out. revert() is the same, backwards.
+
+    ps = patch.PatchSet("no checks", module="target")
+    for rva in rvas:
+        ps.add(rva, "\\x90" * 6)
+    dbg.patches.apply(ps)
+    ...
+    dbg.patches.revert(ps)
+
+A module set stays enabled until it is reverted: if the module isn't
+loaded yet it is applied when it loads (for the executable, when its
+process starts), when it unloads the patches go with it, and when it loads
+again they are applied again. The writes go
+through DataSpaces.write(), so Debugger's write listeners hear of them.
+'''
+import bisect
+
+from deferred import module_key
+
+
+def coalesce(patches, gap=0):
+    '''coalesce([(address, data), ...], gap) -> [(start, end, [(address, data), ...]), ...]
+
+    Runs are sorted, patches less than gap bytes apart share a run.
+    Overlapping patches are an error.
+    '''
+    runs = []
+    for address, data in sorted(patches):
+        if runs and address < runs[-1][1]:
+            raise RuntimeError("Patches overlap at 0x%x" % address)
+        if runs and address - runs[-1][1] <= gap:
+            run = runs[-1]
+            run[1] = address + len(data)
+            run[2].append((address, data))
+        else:
+            runs.append([address, address + len(data), [(address, data)]])
+    return [tuple(run) for run in runs]
+
+
+class PatchSet(object):
+    '''
+    module: the offsets are RVAs into that module, None for addresses
+    '''
+    def __init__(self, name=None, module=None):
+        self.name = name
+        self.module = module_key(module) if module else None
+        self.patches = {}
+        self.enabled = False
+        self.base = None
+        self.pid = None
+        # [(start, original, patched), ...] while it is in memory
+        self.runs = None
+
+    def __repr__(self):
+        return "<PatchSet %s patches=%d enabled=%s applied=%s>" % (
+                self.name, len(self.patches), self.enabled, self.applied)
+
+    def __len__(self):
+        return len(self.patches)
+
+    @property
+    def applied(self):
+        return self.runs is not None
+
+    def add(self, offset, data):
+        if self.enabled:
+            raise RuntimeError("Can't change patch set %s while it is enabled" % self.name)
+        self.patches[offset] = str(data)
+
+
+class PatchManager(object):
+    '''
+    gap: patches this close are written as one run, with the original bytes
+         in between written back as they were
+    failed: [(PatchSet, error), ...] for sets that couldn't be applied on a
+            module load
+    '''
+    def __init__(self, dbg, gap=16):
+        self.dbg = dbg
+        self.gap = gap
+        self.sets = []
+        self.failed = []
+        self.writes = 0
+        # applied runs, per process: pid -> (sorted starts,
+        # start -> (end, PatchSet))
+        self._runs = {}
+
+        dbg.add_hook('CREATEPROCESS', self._on_create_process)
+        dbg.add_hook('LOADMODULE', self._on_load_module)
+        dbg.add_hook('UNLOADMODULE', self._on_unload_module)
+        dbg.add_hook('EXITPROCESS', self._on_exit_process)
+
+    def apply(self, ps):
+        '''apply(ps) -> True if it is in memory, False if its module isn't loaded'''
+        if ps.enabled:
+            return ps.applied
+        base = 0
+        if ps.module is not None:
+            mod = self.dbg.symbols.get_module_by_name(ps.module)
+            if mod is None:
+                ps.enabled = True
+                self.sets.append(ps)
+                return False
+            base = mod[1]
+        self._apply(ps, base)
+        ps.enabled = True
+        self.sets.append(ps)
+        return True
+
+    def revert(self, ps):
+        if not ps.enabled:
+            return
+        if ps.applied:
+            self._write_runs(ps.runs, 1, 2)
+            self._forget(ps)
+        ps.enabled = False
+        self.sets.remove(ps)
+
+    def revert_all(self):
+        for ps in reversed(self.sets[:]):
+            self.revert(ps)
+
+    def _overlap(self, pid, start, end):
+        starts, runs = self._runs.get(pid, ((), None))
+        i = bisect.bisect_right(starts, start)
+        if i and runs[starts[i - 1]][0] > start:
+            return runs[starts[i - 1]][1]
+        if i < len(starts) and starts[i] < end:
+            return runs[starts[i]][1]
+        return None
+
+    def _write(self, address, data):
+        written = self.dbg.dataspaces.write(address, data)
+        self.writes += 1
+        if written != len(data):
+            raise RuntimeError("Short write to 0x%x: %d < %d" % (address, written, len(data)))
+
+    def _write_runs(self, runs, which, undo):
+        '''writes run[which] of every run, on failure run[undo] of those done'''
+        done = []
+        try:
+            for run in runs:
+                self._write(run[0], run[which])
+                done.append(run)
+        except Exception:
+            for run in reversed(done):
+                try:
+                    self._write(run[0], run[undo])
+                except Exception:
+                    pass
+            raise
+
+    def _apply(self, ps, base):
+        runs = coalesce([(base + offset, data) for offset, data in ps.patches.iteritems()],
+                        self.gap)
+        read = self.dbg.dataspaces.read
+        pid = self.dbg.context.pid
+        todo = []
+        for start, end, patches in runs:
+            other = self._overlap(pid, start, end)
+            if other is not None:
+                raise RuntimeError("%r overlaps %r at 0x%x" % (ps, other, start))
+            original = read(start, end - start)
+            if len(original) != end - start:
+                raise RuntimeError("Can't read 0x%x bytes at 0x%x" % (end - start, start))
+            patched = bytearray(original)
+            for address, data in patches:
+                patched[address-start:address-start+len(data)] = data
+            todo.append((start, original, str(patched)))
+
+        self._write_runs(todo, 2, 1)
+        ps.runs = todo
+        ps.base = base
+        ps.pid = pid
+        starts, applied = self._runs.setdefault(pid, ([], {}))
+        for start, original, patched in todo:
+            bisect.insort(starts, start)
+            applied[start] = (start + len(original), ps)
+
+    def _forget(self, ps):
+        starts, applied = self._runs[ps.pid]
+        for start, original, patched in ps.runs:
+            del applied[start]
+            del starts[bisect.bisect_left(starts, start)]
+        if not starts:
+            del self._runs[ps.pid]
+        ps.runs = None
+        ps.base = None
+        ps.pid = None
+
+    def _on_load_module(self, event):
+        module = module_key(event.moduleName)
+        for ps in self.sets:
+            if ps.module == module and not ps.applied:
+                try:
+                    self._apply(ps, event.baseOffset)
+                except Exception, e:
+                    # COMErrors too, the other sets still get their turn
+                    self.failed.append((ps, str(e)))
+
+    def _on_create_process(self, event):
+        # the process' own image doesn't get a LOADMODULE
+        self._on_load_module(event)
+
+    def _on_unload_module(self, event):
+        pid = self.dbg.context.pid
+        for ps in self.sets:
+            if ps.applied and ps.module is not None and \
+               ps.base == event.baseOffset and ps.pid == pid:
+                self._forget(ps)
+
+    def _on_exit_process(self, exitcode):
+        pid = self.dbg.systemobjects.get_event_process()
+        for ps in self.sets[:]:
+            if ps.applied and ps.pid == pid:
+                self._forget(ps)
+                if ps.module is None:
+                    # nowhere to apply it again
+                    ps.enabled = False
+                    self.sets.remove(ps)
@@ -0,0 +1,365 @@
+'''Dump selected memory regions, compressed, in a file that can be read back
+a region at a time.
+
+    stats = regiondump.dump(dbg, "crash.bgr", modules=("target",),
+                            protect=regiondump.WRITABLE, threads=True)
+
+    dump = regiondump.RegionDump("crash.bgr")
+    data = dump.read(0x7ffe0000, 0x1000)
+    print dump.registers(dump.threads[0]['id'])['rip']
+
+Regions are read from the target in chunks of `chunk_size` and every chunk
+is zlib compressed on its own, on a writer thread, while the next chunk is
+read. Pages that can't be read are left out and recorded as holes.
+
+file    := MAGIC, chunk*, index, trailer
+trailer := <Q index offset, <I index length, MAGIC
+index   := zlib compressed JSON: the regions, each with its chunks as
+           [offset in region, size, file offset, compressed size], the
+           modules, and with threads the raw DEBUG_VALUE array of each
+           thread's registers, stored as a chunk too
+
+Reading a region back needs the index and its own chunks, nothing else,
+and no engine.
+'''
+import sys
+import time
+import zlib
+import json
+import bisect
+import struct
+import ctypes
+import threading
+import Queue
+
+import utils
+
+
+MAGIC = "BGRDUMP1"
+_TRAILER = struct.Struct("<QI8s")
+
+MEM_COMMIT = 0x1000
+MEM_PRIVATE = 0x20000
+MEM_MAPPED = 0x40000
+MEM_IMAGE = 0x1000000
+
+PAGE_NOACCESS = 0x01
+# protection masks for dump(protect=...)
+READABLE = 0xfe
+WRITABLE = 0xcc     # READWRITE, WRITECOPY and their EXECUTE_ versions
+EXECUTABLE = 0xf0
+
+# DEBUG_VALUE: 24 byte union, TailOfRawBytes, Type
+_DEBUG_VALUE = struct.Struct("<24sII")
+_INT_MASKS = {1: 0xff, 2: 0xffff, 3: 0xffffffff, 4: 0xffffffffffffffff}
+
+
+def select_regions(dbg, modules=None, protect=None, ranges=None, types=None):
+    '''select_regions(dbg, ...) -> [(start, size, MemoryRegion), ...]
+
+    Committed, readable regions, narrowed down by:
+    modules: names of modules to dump
+    ranges: [(start, end), ...] to dump, along with the modules
+    protect: mask of PAGE_* bits, one of them has to be set
+    types: mask of MEM_IMAGE, MEM_MAPPED, MEM_PRIVATE
+    '''
+    wanted = None
+    if modules is not None or ranges is not None:
+        wanted = list(ranges or ())
+        for name in modules or ():
+            span = dbg.symbols.get_module_range(name)
+            if span is None:
+                raise RuntimeError("Module %s isn't loaded" % name)
+            wanted.append(span)
+        wanted.sort()
+
+    selected = []
+    for region in dbg.dataspaces.iter_regions():
+        if region.state != MEM_COMMIT:
+            continue
+        if region.protect & utils.PAGE_GUARD or region.protect & 0xff == PAGE_NOACCESS:
+            continue
+        if protect is not None and not region.protect & 0xff & protect:
+            continue
+        if types is not None and not region.type & types:
+            continue
+        start, end = region.base, region.base + region.size
+        if wanted is None:
+            selected.append((start, region.size, region))
+            continue
+        for lo, hi in wanted:
+            lo, hi = max(lo, start), min(hi, end)
+            if lo < hi:
+                selected.append((lo, hi - lo, region))
+    return selected
+
+
+class _Writer(threading.Thread):
+    '''compresses and writes chunks, fills in where each one went'''
+    def __init__(self, fp, level, depth=8):
+        super(_Writer, self).__init__(name="regiondump writer")
+        self.daemon = True
+        self.fp = fp
+        self.level = level
+        self.offset = len(MAGIC)
+        self.written = 0
+        self.error = None
+        self.queue = Queue.Queue(depth)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            entry, data = item
+            try:
+                packed = zlib.compress(data, self.level)
+                self.fp.write(packed)
+            except Exception, e:
+                self.error = e
+                continue
+            entry.extend((self.offset, len(packed)))
+            self.offset += len(packed)
+            self.written += len(packed)
+
+    def put(self, entry, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((entry, data))
+
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def read_readable(read, address, size):
+    '''read_readable(read, address, size) -> [(address, data), ...] of what could be read'''
+    try:
+        data = read(address, size)
+        if len(data) == size:
+            return [(address, data)]
+    except RuntimeError:
+        pass
+    # something in there isn't readable, go page by page
+    pieces = []
+    end = address + size
+    while address < end:
+        step = min(utils.PAGE_SIZE - (address & (utils.PAGE_SIZE - 1)), end - address)
+        try:
+            data = read(address, step)
+        except RuntimeError:
+            data = ""
+        if data:
+            if pieces and pieces[-1][0] + len(pieces[-1][1]) == address:
+                pieces[-1] = (pieces[-1][0], pieces[-1][1] + data)
+            else:
+                pieces.append((address, data))
+        address += step
+    return pieces
+
+
+def dump(dbg, path, modules=None, protect=None, ranges=None, types=None,
+         threads=False, chunk_size=1 << 20, level=1):
+    '''dump(dbg, path, ...) -> stats dict
+
+    The selection arguments are select_regions()'s. threads saves the
+    registers of every thread. level is zlib's, 1 is fast and still
+    shrinks memory a lot.
+    '''
+    started = time.time()
+    regions = select_regions(dbg, modules, protect, ranges, types)
+    read = dbg.dataspaces.read
+    modnames = {}
+
+    def module_name(address):
+        mod = dbg.symbols.get_module_by_offset(address)
+        if mod is None:
+            return None
+        index, base = mod
+        if base not in modnames:
+            modnames[base] = dbg.symbols.get_module_name(index, base)
+        return modnames[base]
+
+    fp = open(path, "wb")
+    try:
+        fp.write(MAGIC)
+        writer = _Writer(fp, level)
+        writer.start()
+        index = {'version': 1, 'created': started, 'chunk_size': chunk_size,
+                 'ptr_size': dbg.ptr_size, 'regions': [], 'threads': []}
+        nread = 0
+        holes = 0
+        try:
+            for start, size, region in regions:
+                entry = {'base': start, 'size': size, 'protect': region.protect,
+                         'type': region.type, 'module': module_name(start),
+                         'chunks': [], 'holes': []}
+                index['regions'].append(entry)
+                offset = 0
+                while offset < size:
+                    count = min(chunk_size, size - offset)
+                    expect = start + offset
+                    for address, data in read_readable(read, expect, count):
+                        if address != expect:
+                            entry['holes'].append([expect - start, address - expect])
+                            holes += 1
+                        chunk = [address - start, len(data)]
+                        entry['chunks'].append(chunk)
+                        writer.put(chunk, data)
+                        nread += len(data)
+                        expect = address + len(data)
+                    if expect != start + offset + count:
+                        entry['holes'].append([expect - start, start + offset + count - expect])
+                        holes += 1
+                    offset += count
+
+            if threads:
+                index['threads'] = _dump_threads(dbg, writer)
+                index['register_names'] = dbg.registers.get_names()
+            modules = sorted(set((base, name) for base, name in modnames.iteritems()))
+            index['modules'] = [{'base': base, 'name': name} for base, name in modules]
+        finally:
+            writer.finish()
+
+        blob = zlib.compress(json.dumps(index), 9)
+        fp.write(blob)
+        fp.write(_TRAILER.pack(writer.offset, len(blob), MAGIC))
+    finally:
+        fp.close()
+
+    elapsed = time.time() - started
+    return {'regions': len(regions), 'read': nread, 'holes': holes,
+            'written': writer.written, 'elapsed': elapsed,
+            'mb_per_sec': nread / elapsed / 1e6 if elapsed else 0.0}
+
+
+def _dump_threads(dbg, writer):
+    sysobjs = dbg.systemobjects
+    current = sysobjs.get_current_thread_id()
+    threads = []
+    try:
+        for tid, sysid in sysobjs.get_thread_ids():
+            sysobjs.set_current_thread_id(tid)
+            values = dbg.registers.get_values()
+            chunk = [0, ctypes.sizeof(values)]
+            writer.put(chunk, ctypes.string_at(ctypes.addressof(values),
+                                               ctypes.sizeof(values)))
+            threads.append({'id': tid, 'sysid': sysid,
+                            'teb': sysobjs.get_thread_teb(), 'registers': chunk})
+    finally:
+        sysobjs.set_current_thread_id(current)
+    return threads
+
+
+class RegionDump(object):
+    '''A dump written by dump(), see the module docstring.'''
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, "rb")
+        if self._fp.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError("%s isn't a region dump" % path)
+        self._fp.seek(-_TRAILER.size, 2)
+        offset, size, magic = _TRAILER.unpack(self._fp.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise RuntimeError("%s is cut short, no index" % path)
+        self._fp.seek(offset)
+        self.index = json.loads(zlib.decompress(self._fp.read(size)))
+        self.regions = self.index['regions']
+        self.threads = self.index['threads']
+        self.modules = self.index['modules']
+        self._bases = [r['base'] for r in self.regions]
+        for region in self.regions:
+            region['_offsets'] = [c[0] for c in region['chunks']]
+
+    def _chunk(self, chunk):
+        self._fp.seek(chunk[2])
+        return zlib.decompress(self._fp.read(chunk[3]))
+
+    def region_at(self, address):
+        '''region_at(address) -> region dict or None'''
+        i = bisect.bisect_right(self._bases, address) - 1
+        if i >= 0:
+            region = self.regions[i]
+            if address < region['base'] + region['size']:
+                return region
+        return None
+
+    def read(self, address, size):
+        '''read(address, size) -> str, only the chunks it needs are decompressed'''
+        region = self.region_at(address)
+        if region is None or address + size > region['base'] + region['size']:
+            raise RuntimeError("0x%x bytes at 0x%x weren't dumped" % (size, address))
+        start = address - region['base']
+        end = start + size
+        chunks = region['chunks']
+        i = max(bisect.bisect_right(region['_offsets'], start) - 1, 0)
+        data = []
+        pos = start
+        while pos < end and i < len(chunks):
+            chunk = chunks[i]
+            if chunk[0] > pos:
+                break
+            if chunk[0] + chunk[1] > pos:
+                raw = self._chunk(chunk)
+                piece = raw[pos - chunk[0]:end - chunk[0]]
+                data.append(piece)
+                pos += len(piece)
+            i += 1
+        if pos < end:
+            raise RuntimeError("0x%x at 0x%x wasn't readable when dumped" %
+                               (end - pos, region['base'] + pos))
+        return "".join(data)
+
+    def region_data(self, region, fill="\0"):
+        '''region_data(region) -> str of the whole region, holes filled'''
+        data = bytearray(fill * region['size'])
+        for chunk in region['chunks']:
+            data[chunk[0]:chunk[0]+chunk[1]] = self._chunk(chunk)
+        return str(data)
+
+    def registers(self, tid):
+        '''registers(tid) -> {name: value}, integers as int, anything else raw'''
+        for thread in self.threads:
+            if thread['id'] == tid:
+                break
+        else:
+            raise RuntimeError("No registers for thread %d" % tid)
+        raw = self._chunk(thread['registers'])
+        regs = {}
+        for i, name in enumerate(self.index['register_names']):
+            value, tail, kind = _DEBUG_VALUE.unpack_from(raw, i * _DEBUG_VALUE.size)
+            if kind in _INT_MASKS:
+                regs[name] = struct.unpack_from("<Q", value)[0] & _INT_MASKS[kind]
+            else:
+                regs[name] = value
+        return regs
+
+    def close(self):
+        self._fp.close()
+
+
+def main(args):
+    if not args or args[0] in ("-h", "--help"):
+        print "usage: regiondump.py dump.bgr"
+        return 1
+    dump = RegionDump(args[0])
+    try:
+        for region in dump.regions:
+            stored = sum(c[1] for c in region['chunks'])
+            packed = sum(c[3] for c in region['chunks'])
+            print "%016x %10x %08x %-20s %5.1f%%%s" % (region['base'], region['size'],
+                    region['protect'], region['module'] or "",
+                    100.0 * packed / stored if stored else 0.0,
+                    " holes=%d" % len(region['holes']) if region['holes'] else "")
+        for thread in dump.threads:
+            print "thread %d (%x) teb=%x" % (thread['id'], thread['sysid'], thread['teb'])
+    finally:
+        dump.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,547 @@
+'''Drive a Debugger from another process over a socket.
+
+Everything on the wire is a frame:
+
+    >I length of what follows
+    >B kind (HELLO, REQUEST, RESPONSE, EVENT, ERROR)
+    >I request id (0 for events)
+    ...  one encoded value
+
+A client's first frame is a HELLO with the server's token; anything else,
+or the wrong token, gets an ERROR and the connection is closed, as does a
+frame that can't be parsed. Operations include execute (any engine
+command, .shell too) and write, so the server listens on loopback unless
+told otherwise, and the token is random unless one is given.
+
+A request carries a list of operations, [name, arg, ...] each, and the
+response a list of [ok, value-or-error] in the same order, so one round
+trip can read memory, registers and set breakpoints at once. Requests can
+be pipelined; they are answered in order, matched up by id. Breakpoint
+hits and subscribed events are pushed as EVENT frames in between. The
+breakpoints a connection set and its subscriptions go when it closes.
+
+Values are encoded with a small tagged format: None, bools, ints, floats,
+byte strings, unicode, lists and dicts.
+
+The server runs on the debugger's thread. serve_forever() alternates
+between servicing the sockets and waiting for debug events; or call poll()
+yourself, e.g. from a Debugger poller.
+
+    server = RPCServer(dbg, ("127.0.0.1", 4444))
+    print server.token
+    server.serve_forever()
+
+    client = RPCClient(("127.0.0.1", 4444), token)
+    (ok, data), (ok, regs) = client.call([["read", 0x401000, 0x100],
+                                          ["regs", ["rip", "rsp"]]])
+'''
+import os
+import hmac
+import socket
+import select
+import struct
+import errno
+import binascii
+from collections import deque
+
+
+HELLO = 0
+REQUEST = 1
+RESPONSE = 2
+EVENT = 3
+ERROR = 4
+
+_FRAME = struct.Struct(">IBI")
+_LEN = struct.Struct(">I")
+_INT = struct.Struct(">q")
+_UINT = struct.Struct(">Q")
+_FLOAT = struct.Struct(">d")
+
+MAX_FRAME = 64 * 1024 * 1024
+DEFAULT_ADDRESS = ("127.0.0.1", 4444)
+
+# DbgEng's DEBUG_STATUS_GO, this module doesn't need the engine bindings
+DEBUG_STATUS_GO = 1
+
+
+class ProtocolError(RuntimeError): pass
+
+
+# value codec
+def _encode(value, out):
+    if value is None:
+        out.append("N")
+    elif value is True:
+        out.append("T")
+    elif value is False:
+        out.append("F")
+    elif isinstance(value, (int, long)):
+        if -(1 << 63) <= value < (1 << 63):
+            out.append("q" + _INT.pack(value))
+        elif 0 <= value < (1 << 64):
+            out.append("Q" + _UINT.pack(value))
+        else:
+            raise ProtocolError("Integer out of range: %r" % (value,))
+    elif isinstance(value, float):
+        out.append("f" + _FLOAT.pack(value))
+    elif isinstance(value, str):
+        out.append("b" + _LEN.pack(len(value)))
+        out.append(value)
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+        out.append("s" + _LEN.pack(len(value)))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        out.append("l" + _LEN.pack(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append("d" + _LEN.pack(len(value)))
+        for key, item in value.iteritems():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise ProtocolError("Can't encode %r" % (type(value),))
+
+
+def encode(value):
+    out = []
+    _encode(value, out)
+    return "".join(out)
+
+
+def _decode(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag == "N":
+        return None, offset
+    if tag == "T":
+        return True, offset
+    if tag == "F":
+        return False, offset
+    if tag == "q":
+        return _INT.unpack_from(data, offset)[0], offset + 8
+    if tag == "Q":
+        return _UINT.unpack_from(data, offset)[0], offset + 8
+    if tag == "f":
+        return _FLOAT.unpack_from(data, offset)[0], offset + 8
+
+    count, = _LEN.unpack_from(data, offset)
+    offset += 4
+    if tag == "b":
+        return data[offset:offset+count], offset + count
+    if tag == "s":
+        return data[offset:offset+count].decode("utf-8"), offset + count
+    if tag == "l":
+        items = []
+        for i in xrange(count):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == "d":
+        items = {}
+        for i in xrange(count):
+            key, offset = _decode(data, offset)
+            items[key], offset = _decode(data, offset)
+        return items, offset
+    raise ProtocolError("Bad tag %r at %d" % (tag, offset - 1))
+
+
+def decode(data):
+    try:
+        value, offset = _decode(data, 0)
+    except (IndexError, struct.error), e:
+        raise ProtocolError("Truncated value: %s" % e)
+    if offset != len(data):
+        raise ProtocolError("%d bytes of junk after value" % (len(data) - offset))
+    return value
+
+
+def pack_frame(kind, reqid, value):
+    body = encode(value)
+    return _FRAME.pack(len(body) + 5, kind, reqid) + body
+
+
+class FrameReader(object):
+    '''Splits a byte stream into (kind, reqid, value) frames'''
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def feed(self, data):
+        # appending to a bytearray and consuming it from an offset keeps a
+        # big frame arriving in small pieces linear
+        buf = self._buf
+        buf += data
+        frames = []
+        try:
+            while len(buf) - self._pos >= 4:
+                length, = _LEN.unpack_from(buf, self._pos)
+                if length < 5 or length > MAX_FRAME:
+                    raise ProtocolError("Bad frame length %d" % length)
+                if len(buf) - self._pos < length + 4:
+                    break
+                length, kind, reqid = _FRAME.unpack_from(buf, self._pos)
+                body = str(buf[self._pos+9:self._pos+length+4])
+                self._pos += length + 4
+                frames.append((kind, reqid, decode(body)))
+        finally:
+            if self._pos:
+                del buf[:self._pos]
+                self._pos = 0
+        return frames
+
+
+def _event_value(eventtype, event):
+    if hasattr(event, "_asdict"):
+        payload = dict(event._asdict())
+    elif hasattr(event, "bp"):
+        payload = {"id": event.id}
+    else:
+        payload = event
+    try:
+        encode(payload)
+    except ProtocolError:
+        payload = repr(payload)
+    return [eventtype, payload]
+
+
+# operations, op(server, conn, *args)
+def _op_read(server, conn, address, size):
+    return server.dbg.dataspaces.read(address, size)
+
+def _op_readv(server, conn, ranges):
+    read = server.dbg.dataspaces.read
+    return [read(address, size) for address, size in ranges]
+
+def _op_write(server, conn, address, data):
+    return server.dbg.dataspaces.write(address, data)
+
+def _op_regs(server, conn, names):
+    regs = server.dbg.registers
+    return [regs[name] for name in names]
+
+def _op_setreg(server, conn, name, value):
+    server.dbg.registers[name] = value
+
+def _op_bp(server, conn, address, oneshot=False, condition=None):
+    def hit(bp):
+        if oneshot:
+            # the engine drops it, and may hand its id out again
+            conn.breakpoints.discard(bp.id)
+        server.send_event(conn, "BREAKPOINT", {"id": bp.id})
+        return server.bp_status
+    if isinstance(address, unicode):
+        address = address.encode("utf-8")
+    bp = server.dbg.breakpoint(address, hit, oneshot=oneshot,
+                               condition=condition)
+    conn.breakpoints.add(bp.id)
+    return bp.id
+
+def _op_rmbp(server, conn, bpid):
+    server.dbg.remove_breakpoint(bpid)
+    conn.breakpoints.discard(bpid)
+
+def _op_execute(server, conn, cmd):
+    return server.dbg.execute(cmd)
+
+def _op_go(server, conn):
+    server.dbg.control.set_execution_status(DEBUG_STATUS_GO)
+    server.running = True
+
+def _op_break(server, conn):
+    server.running = False
+
+def _op_subscribe(server, conn, eventtypes):
+    for eventtype in eventtypes:
+        server.subscribe(conn, eventtype)
+
+def _op_ping(server, conn, *args):
+    return list(args)
+
+
+OPERATIONS = {
+    "read": _op_read,
+    "readv": _op_readv,
+    "write": _op_write,
+    "regs": _op_regs,
+    "setreg": _op_setreg,
+    "bp": _op_bp,
+    "rmbp": _op_rmbp,
+    "execute": _op_execute,
+    "go": _op_go,
+    "break": _op_break,
+    "subscribe": _op_subscribe,
+    "ping": _op_ping,
+}
+
+
+class _Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        # frames to send, and how much of the first one went out already
+        self.outbuf = deque()
+        self.outpos = 0
+        self.events = set()
+        # ids of the breakpoints it set, they go when it does
+        self.breakpoints = set()
+        self.authenticated = False
+        # close once outbuf is sent
+        self.closing = False
+
+
+def _make_socket(address):
+    if isinstance(address, basestring):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class RPCServer(object):
+    '''Serves one Debugger to any number of local clients.
+
+    address: (host, port), a port on loopback or a unix socket path
+    token: what clients say hello with, a random one by default
+    bp_status: what breakpoints set over the wire return to the engine
+    '''
+    def __init__(self, dbg, address=DEFAULT_ADDRESS, token=None, wait_ms=50,
+                 bp_status=None):
+        if isinstance(address, (int, long)):
+            address = ("127.0.0.1", address)
+        self.dbg = dbg
+        self.address = address
+        self.token = token or binascii.hexlify(os.urandom(16))
+        self.wait_ms = wait_ms
+        self.bp_status = bp_status
+        self.running = False
+        self.operations = dict(OPERATIONS)
+        self._conns = {}
+        self._taps = {}
+
+        self.sock = _make_socket(address)
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.unlink(address)
+        else:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(8)
+        self.sock.setblocking(False)
+
+    def register(self, name, op):
+        '''register(name, op) -- op(server, conn, *args) -> value'''
+        self.operations[name] = op
+
+    def subscribe(self, conn, eventtype):
+        conn.events.add(eventtype)
+        if eventtype not in self._taps:
+            def tap(event):
+                for c in self._conns.values():
+                    if eventtype in c.events:
+                        self.send_event(c, eventtype, event)
+            self._taps[eventtype] = tap
+            self.dbg.add_hook(eventtype, tap)
+
+    def send_event(self, conn, eventtype, event):
+        conn.outbuf.append(pack_frame(EVENT, 0, _event_value(eventtype, event)))
+
+    def _refuse(self, conn, reqid, message):
+        conn.outbuf.append(pack_frame(ERROR, reqid, message))
+        conn.closing = True
+
+    def _dispatch(self, conn, kind, reqid, ops):
+        if not conn.authenticated:
+            if kind == HELLO and isinstance(ops, str) and \
+               hmac.compare_digest(ops, self.token):
+                conn.authenticated = True
+            else:
+                self._refuse(conn, reqid, "Say hello with the token first")
+            return
+        if kind != REQUEST or not isinstance(ops, list):
+            conn.outbuf.append(pack_frame(ERROR, reqid, "Expected a request"))
+            return
+        results = []
+        for op in ops:
+            try:
+                name = op[0]
+                if isinstance(name, unicode):
+                    name = name.encode("utf-8")
+                if name not in self.operations:
+                    results.append([False, "Unknown operation: %s" % name])
+                    continue
+                results.append([True, self.operations[name](self, conn, *op[1:])])
+            except Exception, e:
+                results.append([False, "%s: %s" % (type(e).__name__, e)])
+        conn.outbuf.append(pack_frame(RESPONSE, reqid, results))
+
+    def _close(self, conn):
+        del self._conns[conn.sock]
+        conn.sock.close()
+        for bpid in conn.breakpoints:
+            try:
+                self.dbg.remove_breakpoint(bpid)
+            except Exception:
+                # a one shot that went off, or the process is gone
+                pass
+        conn.breakpoints.clear()
+        for eventtype in conn.events:
+            if not any(eventtype in c.events for c in self._conns.itervalues()):
+                self.dbg._events.remove_hook(eventtype, self._taps.pop(eventtype))
+        conn.events.clear()
+
+    def poll(self, timeout=0):
+        '''service the sockets for at most `timeout` seconds'''
+        rlist = [self.sock] + self._conns.keys()
+        wlist = [c.sock for c in self._conns.values() if c.outbuf]
+        try:
+            readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for sock in readable:
+            if sock is self.sock:
+                client, addr = self.sock.accept()
+                client.setblocking(False)
+                self._conns[client] = _Connection(client)
+                continue
+            conn = self._conns[sock]
+            if conn.closing:
+                continue
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = ""
+            if not data:
+                self._close(conn)
+                continue
+            try:
+                frames = conn.reader.feed(data)
+            except ProtocolError, e:
+                # out of step with the stream, there is no getting back
+                self._refuse(conn, 0, str(e))
+                continue
+            for kind, reqid, value in frames:
+                if conn.closing:
+                    break
+                self._dispatch(conn, kind, reqid, value)
+
+        for sock in writable:
+            conn = self._conns.get(sock)
+            if conn is not None:
+                self._flush(conn)
+
+    def _flush(self, conn):
+        outbuf = conn.outbuf
+        while outbuf:
+            if conn.outpos == 0 and len(outbuf) > 1 and len(outbuf[0]) < 65536:
+                # a run of small frames goes out in one send
+                parts, size = [], 0
+                while outbuf and size < 65536 and len(outbuf[0]) < 65536:
+                    parts.append(outbuf.popleft())
+                    size += len(parts[-1])
+                outbuf.appendleft("".join(parts))
+            chunk = outbuf[0]
+            try:
+                sent = conn.sock.send(buffer(chunk, conn.outpos))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self._close(conn)
+                return
+            conn.outpos += sent
+            if conn.outpos < len(chunk):
+                return
+            outbuf.popleft()
+            conn.outpos = 0
+        if conn.closing:
+            self._close(conn)
+
+    def serve_forever(self):
+        while True:
+            self.serve_once()
+
+    def serve_once(self):
+        if not self.running:
+            self.poll(self.wait_ms / 1000.0)
+            return
+        self.poll(0)
+        try:
+            self.dbg.wait_for_event(self.wait_ms)
+        except Exception, e:
+            self.running = False
+            for conn in self._conns.values():
+                self.send_event(conn, "ERROR", repr(e))
+
+    def close(self):
+        for conn in self._conns.values():
+            self._close(conn)
+        self.sock.close()
+        for eventtype, tap in self._taps.iteritems():
+            self.dbg._events.remove_hook(eventtype, tap)
+        self._taps = {}
+
+
+class RPCClient(object):
+    '''Blocking client. submit() pipelines, call() is submit()+wait().'''
+    def __init__(self, address, token):
+        if isinstance(address, (int, long)):
+            address = ("127.0.0.1", address)
+        self.sock = _make_socket(address)
+        self.sock.connect(address)
+        self.reader = FrameReader()
+        self.events = deque()
+        self._responses = {}
+        self._next_id = 1
+        self.sock.sendall(pack_frame(HELLO, 0, str(token)))
+
+    def submit(self, ops):
+        '''submit([[op, arg, ...], ...]) -> request id'''
+        reqid = self._next_id
+        self._next_id += 1
+        self.sock.sendall(pack_frame(REQUEST, reqid, ops))
+        return reqid
+
+    def _receive(self, timeout=None):
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return False
+        if not data:
+            raise ProtocolError("Connection closed")
+        for kind, reqid, value in self.reader.feed(data):
+            if kind == EVENT:
+                self.events.append(value)
+            elif kind == ERROR:
+                if reqid in self._responses or reqid == 0:
+                    raise ProtocolError(value)
+                self._responses[reqid] = ProtocolError(value)
+            else:
+                self._responses[reqid] = value
+        return True
+
+    def wait(self, reqid, timeout=None):
+        '''wait(reqid) -> [[ok, value], ...]'''
+        while reqid not in self._responses:
+            if not self._receive(timeout):
+                raise socket.timeout("No response to request %d" % reqid)
+        value = self._responses.pop(reqid)
+        if isinstance(value, ProtocolError):
+            raise value
+        return value
+
+    def call(self, ops, timeout=None):
+        return self.wait(self.submit(ops), timeout)
+
+    def next_event(self, timeout=None):
+        '''next_event(timeout) -> [eventtype, payload] or None'''
+        if not self.events:
+            self._receive(timeout)
+        if self.events:
+            return self.events.popleft()
+        return None
+
+    def close(self):
+        self.sock.close()
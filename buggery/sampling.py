@@ -0,0 +1,127 @@
+import time
+from collections import namedtuple
+
+
+SampleStats = namedtuple("SampleStats", "sampled, estimated, throttled, exact")
+
+
+class SamplingBreakpoint(object):
+    '''A breakpoint that stops calling into Python once it gets hot.
+
+    budget/window: at most `budget` hits per `window` seconds reach the
+        callback. Once the budget is spent the breakpoint is throttled for
+        roughly `cooloff` seconds.
+    every: fixed rate sampling instead, only every Nth hit is delivered.
+
+    mode='passcount' throttles with SetPassCount(): the engine skips the
+        next N hits on its own and re-arms the breakpoint with the N+1th,
+        N being the hit rate seen in the window times `cooloff`. The skipped
+        hits are known exactly.
+    mode='disable' disables the breakpoint and re-enables it from a
+        Debugger poller after `cooloff` seconds. Skipped hits are estimated
+        from the rate seen in the window. Re-arming happens when
+        wait_for_event() returns, so use a timeout with this mode.
+    '''
+    def __init__(self, dbg, callback, budget=100, window=1.0, every=None,
+                 cooloff=1.0, mode='passcount', args=None, kwargs=None):
+        if mode not in ('passcount', 'disable'):
+            raise RuntimeError("Unknown sampling mode: %r" % (mode,))
+        self.dbg = dbg
+        self.bp = None
+        # the BreakpointTable the breakpoint is in
+        self.table = None
+        self.callback = callback
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.budget = budget
+        self.window = window
+        self.every = every
+        self.cooloff = cooloff
+        self.mode = mode
+
+        self.sampled = 0
+        self.skipped = 0
+        self.estimated_skipped = 0.0
+        self.throttled = 0
+
+        self._window_start = None
+        self._window_hits = 0
+        self._passes = 1
+        self._rate = 0.0
+        self._disabled_at = None
+
+    def arm(self):
+        self.table = self.dbg.breakpoints
+        self._window_start = time.time()
+        self._window_hits = 0
+        if self.every is not None:
+            self.bp.passcount = self._passes = self.every
+        else:
+            self._set_passes(1)
+
+    def _set_passes(self, passes):
+        if passes != self._passes:
+            self.bp.passcount = passes
+            self._passes = passes
+
+    def _on_hit(self, bp):
+        now = time.time()
+
+        # the engine let passes-1 hits go by before this one
+        self.skipped += self._passes - 1
+        self.sampled += 1
+
+        if self.every is not None:
+            # the pass count is used up by this hit, after it the engine
+            # would stop on every hit
+            self.bp.passcount = self.every
+        else:
+            if self._passes != 1:
+                self._set_passes(1)
+                self._window_start, self._window_hits = now, 0
+            elif now - self._window_start > self.window:
+                self._window_start, self._window_hits = now, 0
+
+            self._window_hits += 1
+            if self._window_hits >= self.budget:
+                self._throttle(now)
+
+        return self.callback(bp, *self.args, **self.kwargs)
+
+    def _throttle(self, now):
+        elapsed = max(now - self._window_start, 1e-6)
+        self._rate = self._window_hits / elapsed
+        self.throttled += 1
+
+        if self.mode == 'passcount':
+            self._set_passes(max(2, int(self._rate * self.cooloff)))
+        else:
+            self.table.set_enabled(self.bp.id, False)
+            self._disabled_at = now
+            self.dbg.add_poller(self._poll)
+
+    def _poll(self):
+        now = time.time()
+        if now - self._disabled_at < self.cooloff:
+            return
+        self.estimated_skipped += self._rate * (now - self._disabled_at)
+        self._disabled_at = None
+        self.dbg.remove_poller(self._poll)
+        self.table.set_enabled(self.bp.id, True)
+        self._window_start, self._window_hits = now, 0
+
+    def stats(self):
+        '''stats() -> SampleStats(sampled, estimated, throttled, exact)
+
+        estimated is the estimated total number of hits, exact says whether
+        it is really an estimate.
+        '''
+        exact = self.estimated_skipped == 0.0
+        estimated = self.sampled + self.skipped + int(self.estimated_skipped)
+        return SampleStats(self.sampled, estimated, self.throttled, exact)
+
+    def remove(self):
+        if self._disabled_at is not None:
+            self.dbg.remove_poller(self._poll)
+            self._disabled_at = None
+        self.dbg.remove_breakpoint(self.bp)
@@ -0,0 +1,329 @@
+'''Snapshot and restore a stopped target, and fuzz one function with it.
+
+Snapshot.take() saves the registers of the current thread and write
+protects every writable page. The first write to a page faults, the page's
+contents are saved and it is made writable again, so restore() only has to
+put back the pages that were written to since, re-protect them, and write
+the registers that changed.
+
+FuzzLoop runs a function over and over on top of that:
+
+    def place(loop, data):
+        loop.snapshot.write(loop.dbg.registers["rcx"], data)
+        loop.dbg.registers["rdx"] = len(data)
+
+    loop = snapshot.FuzzLoop(dbg, "target!ParseMessage", place)
+    dbg.spawn("target.exe")
+    stats = loop.run(cases)
+
+The loop waits for `start` to be hit, takes the snapshot there and puts a
+breakpoint on the return address. Each case is placed, run to the return
+(or a crash, or the timeout), collected and rolled back, without the
+target ever being restarted.
+
+Limits: only the thread that hit `start` has its registers restored, memory
+allocated after the snapshot isn't tracked, and a write the kernel does on
+the target's behalf (ReadFile into a protected buffer) fails instead of
+faulting, so pass `ranges` to leave such buffers alone. Writes done
+through the debugger don't fault either, use Snapshot.write() for those.
+'''
+import time
+import ctypes
+
+import idebug
+import utils
+
+
+EXCEPTION_ACCESS_VIOLATION = 0xC0000005
+MEM_COMMIT = 0x1000
+
+# writable protection -> the same without write
+_READONLY = {
+    0x04: 0x02,     # PAGE_READWRITE -> PAGE_READONLY
+    0x08: 0x02,     # PAGE_WRITECOPY -> PAGE_READONLY
+    0x40: 0x20,     # PAGE_EXECUTE_READWRITE -> PAGE_EXECUTE_READ
+    0x80: 0x20,     # PAGE_EXECUTE_WRITECOPY -> PAGE_EXECUTE_READ
+}
+_MODIFIERS = 0x700  # PAGE_GUARD | PAGE_NOCACHE | PAGE_WRITECOMBINE
+
+
+def _readonly(protect):
+    return _READONLY[protect & 0xff] | (protect & _MODIFIERS)
+
+def _raw(value):
+    return ctypes.string_at(ctypes.addressof(value), ctypes.sizeof(value))
+
+
+class Snapshot(object):
+    '''
+    ranges: [(start, end), ...] to track only those, default is every
+            writable page in the process
+    '''
+    def __init__(self, dbg, ranges=None):
+        self.dbg = dbg
+        self.ranges = ranges
+        self.dirty = set()
+        self.faults = 0
+        self.restores = 0
+        self.tid = None
+        # page -> [original protection, contents at snapshot time or None]
+        self._pages = {}
+        # (start, size, original protection) as protected by take()
+        self._spans = []
+        self._regs = None
+        # added here so that it runs before anybody else's EXCEPTION hook
+        # that might take our write faults for a crash
+        dbg.add_hook('EXCEPTION', self._on_exception)
+
+    def _spans_to_track(self):
+        page = utils.PAGE_SIZE
+        for region in self.dbg.dataspaces.iter_regions():
+            if region.state != MEM_COMMIT or region.protect & utils.PAGE_GUARD:
+                continue
+            if region.protect & 0xff not in _READONLY:
+                continue
+            start, end = region.base, region.base + region.size
+            if self.ranges is None:
+                yield start, end - start, region.protect
+                continue
+            for lo, hi in self.ranges:
+                lo = max(lo & ~(page - 1), start)
+                hi = min((hi + page - 1) & ~(page - 1), end)
+                if lo < hi:
+                    yield lo, hi - lo, region.protect
+
+    def take(self):
+        '''snapshot the current thread and the process' writable memory'''
+        if self._spans:
+            self.release()
+
+        self.tid = self.dbg.systemobjects.get_current_thread_id()
+        self._regs = self.dbg.registers.get_values()
+
+        handle = self.dbg.systemobjects.get_current_process_handle()
+        for start, size, protect in list(self._spans_to_track()):
+            utils.virtual_protect(handle, start, size, _readonly(protect))
+            self._spans.append((start, size, protect))
+            for page in xrange(start, start + size, utils.PAGE_SIZE):
+                self._pages[page] = [protect, None]
+
+    def _on_exception(self, event):
+        if event.code != EXCEPTION_ACCESS_VIOLATION or len(event.information) < 2:
+            return None
+        # information[0] is 1 for a write
+        if event.information[0] != 1:
+            return None
+        page = event.information[1] & ~(utils.PAGE_SIZE - 1)
+        entry = self._pages.get(page)
+        if entry is None or page in self.dirty:
+            return None
+
+        self.faults += 1
+        self._make_dirty(page, entry,
+                         self.dbg.systemobjects.get_current_process_handle())
+        return idebug.GO_HANDLED
+
+    def _make_dirty(self, page, entry, handle):
+        if entry[1] is None:
+            # the write hasn't happened yet, this is the snapshot's copy
+            entry[1] = self.dbg.dataspaces.read(page, utils.PAGE_SIZE)
+        utils.virtual_protect(handle, page, utils.PAGE_SIZE, entry[0])
+        self.dirty.add(page)
+
+    def write(self, address, data):
+        '''write(address, data) -> bytes written, rolled back by restore()'''
+        handle = self.dbg.systemobjects.get_current_process_handle()
+        first = address & ~(utils.PAGE_SIZE - 1)
+        for page in xrange(first, address + len(data), utils.PAGE_SIZE):
+            entry = self._pages.get(page)
+            if entry is not None and page not in self.dirty:
+                self._make_dirty(page, entry, handle)
+        return self.dbg.dataspaces.write(address, data)
+
+    def restore(self):
+        '''puts back the dirty pages and the changed registers'''
+        dbg = self.dbg
+        handle = dbg.systemobjects.get_current_process_handle()
+        write = dbg.dataspaces.write
+        for page in self.dirty:
+            protect, saved = self._pages[page]
+            write(page, saved)
+            utils.virtual_protect(handle, page, utils.PAGE_SIZE, _readonly(protect))
+        self.dirty.clear()
+
+        if dbg.systemobjects.get_current_thread_id() != self.tid:
+            dbg.systemobjects.set_current_thread_id(self.tid)
+        current = dbg.registers.get_values()
+        changed = [i for i in xrange(len(self._regs))
+                   if _raw(current[i]) != _raw(self._regs[i])]
+        if changed:
+            dbg.registers.set_values(self._regs, changed)
+        self.restores += 1
+
+    def release(self):
+        '''gives the pages their protection back and forgets the snapshot'''
+        handle = self.dbg.systemobjects.get_current_process_handle()
+        for start, size, protect in self._spans:
+            utils.virtual_protect(handle, start, size, protect)
+        self._spans = []
+        self._pages.clear()
+        self.dirty.clear()
+        self._regs = None
+
+    def close(self):
+        self.release()
+        self.dbg._events.remove_hook('EXCEPTION', self._on_exception)
+
+
+# case outcomes
+RETURNED = 'returned'
+CRASH = 'crash'
+TIMEOUT = 'timeout'
+EXITED = 'exited'
+
+CRASH_CODES = frozenset([
+    0xC0000005,     # access violation
+    0xC000001D,     # illegal instruction
+    0xC0000094,     # integer divide by zero
+    0xC00000FD,     # stack overflow
+    0xC0000374,     # heap corruption
+    0xC0000409,     # stack buffer overrun (/GS)
+])
+
+
+class FuzzLoop(object):
+    '''
+    start: the function to fuzz, anything Debugger.breakpoint() takes
+    place: place(loop, data), puts a case into the target when it sits at
+           the start of the function. Write with loop.snapshot.write().
+    collect: collect(dbg) -> anything, called when the function returns
+    ranges: passed on to Snapshot
+    timeout: seconds a case may run
+    crash_codes: first chance exceptions that count as a crash, any second
+                 chance exception always does
+    on_result: called with (data, result dict) after every case
+    '''
+    def __init__(self, dbg, start, place, collect=None, ranges=None,
+                 timeout=1.0, crash_codes=CRASH_CODES, on_result=None):
+        self.dbg = dbg
+        self.start = start
+        self.place = place
+        self.collect = collect
+        self.timeout = timeout
+        self.crash_codes = crash_codes
+        self.on_result = on_result
+        self.snapshot = Snapshot(dbg, ranges)
+        self.counts = {RETURNED: 0, CRASH: 0, TIMEOUT: 0, EXITED: 0}
+        self.crashes = []
+
+        self._armed = False
+        self._running = False
+        self._outcome = None
+        self._end = None
+
+    def _on_start(self, bp):
+        self.snapshot.take()
+        retaddr = self.dbg.control.get_return_address()
+        self._end = self.dbg.breakpoint(retaddr, self._on_end)
+        self._end.set_match_thread_id(self.snapshot.tid)
+        self._armed = True
+        return idebug.DbgEng.DEBUG_STATUS_BREAK
+
+    def _on_end(self, bp):
+        if not self._running:
+            return None
+        detail = self.collect(self.dbg) if self.collect is not None else None
+        regs = {4: "eax", 8: "rax"}
+        self._outcome = (RETURNED, {'retval': self.dbg.registers[regs[self.dbg.ptr_size]],
+                                    'collected': detail})
+        return idebug.DbgEng.DEBUG_STATUS_BREAK
+
+    def _on_exception(self, event):
+        if not self._running or self._outcome is not None:
+            return None
+        if event.firstchance and event.code not in self.crash_codes:
+            return None
+        self._outcome = (CRASH, {'code': event.code, 'address': event.address,
+                                 'firstchance': bool(event.firstchance)})
+        return idebug.DbgEng.DEBUG_STATUS_BREAK
+
+    def _on_exit(self, exitcode):
+        if self._running:
+            self._outcome = (EXITED, {'exit_code': exitcode})
+        self._armed = False
+
+    def _run_case(self, data):
+        dbg = self.dbg
+        self._outcome = None
+        self.place(self, data)
+
+        started = time.time()
+        # events along the way don't restart the clock
+        deadline = started + self.timeout
+        self._running = True
+        try:
+            dbg.control.set_execution_status(idebug.GO_HANDLED)
+            while self._outcome is None:
+                remaining = int((deadline - time.time()) * 1000)
+                if remaining > 0 and dbg.wait_for_event(remaining):
+                    continue
+                # hung: break in and roll back
+                dbg.control.set_interrupt(idebug.DbgEng.DEBUG_INTERRUPT_ACTIVE)
+                dbg.wait_for_event()
+                if self._outcome is None:
+                    self._outcome = (TIMEOUT, {})
+        finally:
+            self._running = False
+
+        status, result = self._outcome
+        result['status'] = status
+        result['elapsed'] = time.time() - started
+        if status != EXITED:
+            self.snapshot.restore()
+        return result
+
+    def run(self, inputs, max_cases=None):
+        '''run(inputs, max_cases) -> stats dict
+
+        Blocks until every input ran, max_cases were run, or the target is
+        gone.
+        '''
+        dbg = self.dbg
+        dbg.add_hook('EXCEPTION', self._on_exception)
+        dbg.add_hook('EXITPROCESS', self._on_exit)
+        started = time.time()
+        cases = 0
+        try:
+            if not self._armed:
+                dbg.breakpoint(self.start, self._on_start, oneshot=True)
+                while not self._armed:
+                    dbg.wait_for_event()
+
+            for data in inputs:
+                if max_cases is not None and cases >= max_cases:
+                    break
+                result = self._run_case(data)
+                cases += 1
+                self.counts[result['status']] += 1
+                if result['status'] == CRASH:
+                    self.crashes.append((data, result))
+                if self.on_result is not None:
+                    self.on_result(data, result)
+                if result['status'] == EXITED:
+                    break
+        finally:
+            dbg._events.remove_hook('EXCEPTION', self._on_exception)
+            dbg._events.remove_hook('EXITPROCESS', self._on_exit)
+
+        elapsed = time.time() - started
+        return {'cases': cases, 'elapsed': elapsed,
+                'execs_per_sec': cases / elapsed if elapsed else 0.0,
+                'counts': dict(self.counts),
+                'dirty_faults': self.snapshot.faults}
+
+    def close(self):
+        if self._end is not None and self._armed:
+            self.dbg.remove_breakpoint(self._end)
+        self._end = None
+        self._armed = False
+        self.snapshot.close()
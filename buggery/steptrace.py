@@ -0,0 +1,203 @@
+'''Single-step and branch-step tracing.
+
+The tracer drives the engine one step at a time by setting the execution
+status (STEP_INTO, STEP_OVER or STEP_BRANCH) and waiting, and records the
+program counter, plus any registers asked for, of every step. The per-step
+work is one status change, one wait, one GetInstructionOffset and a store
+into a preallocated c_uint64 array (python 2's array has no 'Q'), which
+goes to disk in one write when it is full. The waits go straight to the
+engine, the Debugger's pollers run once, when the trace is over.
+
+    tracer = dbg.step_into(100000, path="trace.bin", module=True)
+    print tracer.steps, tracer.reason
+
+    trace = steptrace.TraceFile("trace.bin")
+    print hex(trace[5000][0]), trace.find(0x401000)
+
+The file is a header followed by fixed size records, one per step, so step
+N is at a known offset and the trace can be indexed by instruction count.
+'''
+import os
+import struct
+import ctypes
+
+import idebug
+
+
+MAGIC = "BGSTEP01"
+_HEADER = struct.Struct("<II")
+
+MODES = {
+    'into': idebug.DbgEng.DEBUG_STATUS_STEP_INTO,
+    'over': idebug.DbgEng.DEBUG_STATUS_STEP_OVER,
+    'branch': idebug.DbgEng.DEBUG_STATUS_STEP_BRANCH,
+}
+
+# why run() stopped
+COUNT = 'count'
+UNTIL = 'until'
+LEFT_MODULE = 'left module'
+NO_TARGET = 'no target'
+
+
+def _header(registers):
+    names = "\0".join(registers)
+    size = len(MAGIC) + _HEADER.size + len(names)
+    size += -size % 8
+    return (MAGIC + _HEADER.pack(size, len(registers)) + names).ljust(size, "\0")
+
+
+class StepTracer(object):
+    '''
+    mode: 'into', 'over' or 'branch'
+    path: trace file, None keeps nothing but the last pc
+    registers: register names to record along with the pc
+    chunk: steps buffered before a write
+    '''
+    def __init__(self, dbg, mode='into', path=None, registers=(), chunk=65536):
+        if mode not in MODES:
+            raise RuntimeError("Unknown step mode: %r" % (mode,))
+        self.dbg = dbg
+        self.mode = mode
+        self.path = path
+        self.registers = tuple(registers)
+        self.width = 1 + len(self.registers)
+        self.chunk = chunk
+        self.steps = 0
+        self.pc = None
+        self.reason = None
+
+        self._fp = None
+        self._buf = None
+        if path is not None:
+            self._fp = open(path, "wb")
+            self._fp.write(_header(self.registers))
+            self._buf = (ctypes.c_uint64 * (chunk * self.width))()
+
+    def run(self, count=None, until=None, module=False):
+        '''run(count, until, module) -> number of steps taken
+
+        count: stop after that many steps
+        until: (start, end), stop once the pc is in there
+        module: stop once the pc leaves the module it started in
+        '''
+        dbg = self.dbg
+        set_status = dbg.control.set_execution_status
+        wait = dbg.control.wait_for_event
+        getpc = dbg.registers.getpc
+        regs = dbg.registers
+        names = self.registers
+        status = MODES[self.mode]
+
+        buf = self._buf
+        size = len(buf) if buf is not None else 0
+        pos = 0
+
+        lo = hi = None
+        if until is not None:
+            lo, hi = until
+        mlo = mhi = None
+        if module:
+            mod = dbg.symbols.get_module_by_offset(getpc())
+            if mod is not None:
+                params = dbg.symbols.get_module_parameters(mod[1])
+                mlo, mhi = params.base, params.base + params.size
+
+        steps = 0
+        reason = COUNT
+        pc = self.pc
+        try:
+            while count is None or steps < count:
+                set_status(status)
+                wait()
+                try:
+                    pc = getpc()
+                except Exception:
+                    # the target went away under the step
+                    reason = NO_TARGET
+                    break
+                steps += 1
+
+                if buf is not None:
+                    buf[pos] = pc
+                    pos += 1
+                    for name in names:
+                        buf[pos] = regs[name] & 0xffffffffffffffff
+                        pos += 1
+                    if pos == size:
+                        self._fp.write(buffer(buf))
+                        pos = 0
+
+                if lo is not None and lo <= pc < hi:
+                    reason = UNTIL
+                    break
+                if mlo is not None and not mlo <= pc < mhi:
+                    reason = LEFT_MODULE
+                    break
+        finally:
+            if pos:
+                self._fp.write(buffer(buf, 0, pos * 8))
+            self.steps += steps
+            self.pc = pc
+            self.reason = reason
+            # each step was a wait, so pollers can tell their own stop
+            dbg.waits += steps + 1 if reason == NO_TARGET else steps
+        dbg.poll()
+        return steps
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class TraceFile(object):
+    '''A trace written by StepTracer, indexed by step number.
+
+    trace[n] -> (pc, reg0, reg1, ...)
+    '''
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        head = self._fp.read(len(MAGIC) + _HEADER.size)
+        if head[:len(MAGIC)] != MAGIC:
+            raise RuntimeError("%s isn't a step trace" % path)
+        self._offset, nregs = _HEADER.unpack_from(head, len(MAGIC))
+        names = self._fp.read(self._offset - len(head)).rstrip("\0")
+        self.registers = tuple(names.split("\0")) if nregs else ()
+        self.width = 1 + nregs
+        self._recsize = 8 * self.width
+        self._count = (os.path.getsize(path) - self._offset) // self._recsize
+
+    def __len__(self):
+        return self._count
+
+    def _read(self, start, count):
+        self._fp.seek(self._offset + start * self._recsize)
+        data = self._fp.read(count * self._recsize)
+        return (ctypes.c_uint64 * (len(data) // 8)).from_buffer_copy(data)
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError("step %d out of range" % n)
+        return tuple(self._read(n, 1))
+
+    def pcs(self, start=0, stop=None, chunk=65536):
+        '''pcs(start, stop) -> iterator over the pc of every step'''
+        stop = self._count if stop is None else min(stop, self._count)
+        width = self.width
+        while start < stop:
+            count = min(chunk, stop - start)
+            values = self._read(start, count)
+            for pc in values[::width]:
+                yield pc
+            start += count
+
+    def find(self, address, start=0, stop=None):
+        '''find(address) -> [step, ...] where the pc was address'''
+        return [n for n, pc in enumerate(self.pcs(start, stop), start)
+                if pc == address]
+
+    def close(self):
+        self._fp.close()
@@ -0,0 +1,239 @@
+'''The binary log apitrace.ApiTracer writes, and a tool to render it.
+
+    python -m buggery.tracelog trace.bin            # text
+    python -m buggery.tracelog --json trace.bin     # one JSON object a line
+
+file   := MAGIC, <I header length, JSON header, record*
+record := <I length, <BHIIdB kind, proto, tid, callid, timestamp, count,
+          value*
+value  := tag byte, then
+          'n'  nothing (None)
+          'q'  <q          'Q'  <Q
+          's'  <I length, narrow string
+          'w'  <I length, UTF-16LE string
+          'b'  <I length, raw buffer
+          'e'  <I length, why the value couldn't be read
+
+The header is the list of prototypes, record.proto indexes it. An ENTER
+record has a value per argument, an EXIT record the return value followed
+by the out buffers. ENTER and EXIT of one call share the callid.
+
+Nothing in here needs the engine, the log can be read anywhere.
+'''
+import sys
+import json
+import struct
+from collections import namedtuple
+
+
+MAGIC = "BGTRACE1"
+
+ENTER = 1
+EXIT = 2
+
+_LEN = struct.Struct("<I")
+_RECORD = struct.Struct("<BHIIdB")
+_INT = struct.Struct("<q")
+_UINT = struct.Struct("<Q")
+
+TraceRecord = namedtuple("TraceRecord", "kind, proto, tid, callid, timestamp, values")
+
+
+class Unreadable(object):
+    '''a value that couldn't be decoded, logged as 'e' '''
+    __slots__ = ('reason',)
+    def __init__(self, reason):
+        self.reason = reason
+    def __repr__(self):
+        return "<%s>" % self.reason
+
+
+def encode_value(value):
+    if value is None:
+        return "n"
+    if isinstance(value, bool):
+        return "Q" + _UINT.pack(int(value))
+    if isinstance(value, (int, long)):
+        if value < 0:
+            return "q" + _INT.pack(value)
+        return "Q" + _UINT.pack(value)
+    if isinstance(value, unicode):
+        data = value.encode("utf-16le")
+        return "w" + _LEN.pack(len(data)) + data
+    if isinstance(value, bytearray):
+        return "b" + _LEN.pack(len(value)) + str(value)
+    if isinstance(value, str):
+        return "s" + _LEN.pack(len(value)) + value
+    if isinstance(value, Unreadable):
+        return "e" + _LEN.pack(len(value.reason)) + value.reason
+    raise RuntimeError("Can't log a %s" % type(value).__name__)
+
+
+def decode_values(data, offset, count):
+    values = []
+    for i in xrange(count):
+        tag = data[offset]
+        offset += 1
+        if tag == "n":
+            values.append(None)
+        elif tag == "q":
+            values.append(_INT.unpack_from(data, offset)[0])
+            offset += 8
+        elif tag == "Q":
+            values.append(_UINT.unpack_from(data, offset)[0])
+            offset += 8
+        else:
+            size, = _LEN.unpack_from(data, offset)
+            offset += _LEN.size
+            raw = data[offset:offset+size]
+            offset += size
+            if tag == "s":
+                values.append(raw)
+            elif tag == "w":
+                values.append(raw.decode("utf-16le", "replace"))
+            elif tag == "b":
+                values.append(bytearray(raw))
+            elif tag == "e":
+                values.append(Unreadable(raw))
+            else:
+                raise RuntimeError("Bad value tag %r" % tag)
+    return values, offset
+
+
+class TraceWriter(object):
+    '''protos: the header, a list of dicts (see apitrace.Prototype.header)'''
+    def __init__(self, path, protos, bufsize=1 << 20):
+        self.path = path
+        self._fp = open(path, "wb", bufsize)
+        header = json.dumps(protos)
+        self._fp.write(MAGIC + _LEN.pack(len(header)) + header)
+        self.records = 0
+        self.size = len(MAGIC) + _LEN.size + len(header)
+
+    def write(self, kind, proto, tid, callid, timestamp, values):
+        body = [_RECORD.pack(kind, proto, tid, callid, timestamp, len(values))]
+        body.extend(encode_value(v) for v in values)
+        body = "".join(body)
+        self._fp.write(_LEN.pack(len(body)) + body)
+        self.records += 1
+        self.size += _LEN.size + len(body)
+
+    def flush(self):
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class TraceReader(object):
+    def __init__(self, path):
+        self._fp = open(path, "rb")
+        if self._fp.read(len(MAGIC)) != MAGIC:
+            raise RuntimeError("%s isn't a trace log" % path)
+        size, = _LEN.unpack(self._fp.read(_LEN.size))
+        self.protos = json.loads(self._fp.read(size))
+
+    def __iter__(self):
+        read = self._fp.read
+        while True:
+            head = read(_LEN.size)
+            if len(head) < _LEN.size:
+                # end of file, or a record cut short by a crash
+                return
+            size, = _LEN.unpack(head)
+            data = read(size)
+            if len(data) < size:
+                return
+            kind, proto, tid, callid, timestamp, count = _RECORD.unpack_from(data, 0)
+            values, offset = decode_values(data, _RECORD.size, count)
+            yield TraceRecord(kind, proto, tid, callid, timestamp, values)
+
+    def close(self):
+        self._fp.close()
+
+
+# rendering
+SIGNED = ("int8", "int16", "int32", "int64", "int", "long", "bool")
+
+def format_value(typ, value, maxbuf=32):
+    if value is None:
+        return "?"
+    if isinstance(value, Unreadable):
+        return repr(value)
+    if isinstance(value, unicode):
+        return "L" + repr(value.encode("utf-8"))
+    if isinstance(value, bytearray):
+        text = str(value[:maxbuf]).encode("hex")
+        return "[%d] %s%s" % (len(value), text, "..." if len(value) > maxbuf else "")
+    if isinstance(value, str):
+        return repr(value)
+    if typ in SIGNED:
+        return "%d" % value
+    return "0x%x" % value
+
+def render_text(reader, out):
+    protos = reader.protos
+    start = None
+    for rec in reader:
+        if start is None:
+            start = rec.timestamp
+        proto = protos[rec.proto]
+        if rec.kind == ENTER:
+            args = ", ".join("%s=%s" % (name, format_value(typ, value))
+                             for (name, typ), value in zip(proto["args"], rec.values))
+            out.write("%12.6f [%x] #%d > %s(%s)\n" % (rec.timestamp - start,
+                      rec.tid, rec.callid, proto["name"], args))
+        else:
+            line = "%12.6f [%x] #%d < %s" % (rec.timestamp - start, rec.tid,
+                                             rec.callid, proto["name"])
+            if proto["ret"] != "void":
+                line += " = " + format_value(proto["ret"], rec.values[0])
+            outs = ", ".join("%s=%s" % (name, format_value(typ, value))
+                             for (name, typ), value in zip(proto["outs"], rec.values[1:]))
+            if outs:
+                line += " (%s)" % outs
+            out.write(line + "\n")
+
+def _jsonable(value):
+    if isinstance(value, bytearray):
+        return {"buffer": str(value).encode("hex")}
+    if isinstance(value, Unreadable):
+        return {"error": value.reason}
+    if isinstance(value, str):
+        return value.decode("latin-1")
+    return value
+
+def render_json(reader, out):
+    protos = reader.protos
+    for rec in reader:
+        proto = protos[rec.proto]
+        obj = {"kind": "enter" if rec.kind == ENTER else "exit",
+               "function": proto["name"], "tid": rec.tid, "call": rec.callid,
+               "time": rec.timestamp}
+        if rec.kind == ENTER:
+            obj["args"] = dict((name, _jsonable(value))
+                               for (name, typ), value in zip(proto["args"], rec.values))
+        else:
+            obj["ret"] = _jsonable(rec.values[0]) if proto["ret"] != "void" else None
+            obj["outs"] = dict((name, _jsonable(value))
+                               for (name, typ), value in zip(proto["outs"], rec.values[1:]))
+        out.write(json.dumps(obj) + "\n")
+
+
+def main(args):
+    if not args or args[0] in ("-h", "--help"):
+        print "usage: tracelog.py [--json] trace.bin"
+        return 1
+    render = render_text
+    if args[0] == "--json":
+        render = render_json
+        args = args[1:]
+    reader = TraceReader(args[0])
+    try:
+        render(reader, sys.stdout)
+    finally:
+        reader.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
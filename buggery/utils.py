@@ -1,37 +1,136 @@
 
 import os
-import win32api
-import win32con
+import sys
+import struct
+import hashlib
 
 from ctypes import *
-import comtypes.server
-import comtypes.server.connectionpoints
+import comtypes
+import comtypes.client
+import comtypes.gen
 from comtypes import HRESULT, COMError
-from comtypes.client import CreateObject, GetEvents, ShowEvents
 from comtypes.hresult import S_OK
 from comtypes.automation import IID
 
+from buggery import DebuggerException
 
-try:
-    from comtypes.gen import DbgEng
-except ImportError:
-    import comtypes
 
-    # XXX HACKHACKHACK this makes me feel dirty. And not in a good way.
-    tlb_file = os.path.join(os.path.dirname(__file__), "DbgEng.tlb")
-    comtypes.client.GetModule(tlb_file)
+TLB_FILE = os.path.join(os.path.dirname(__file__), "DbgEng.tlb")
 
-    from comtypes.gen import DbgEng
+# bump when the layout of the cache changes
+CACHE_VERSION = 1
 
-DBGENG_DLL = None
-DBGHELP_DLL = None
 
+def cache_dir(*parts):
+    '''cache_dir(*parts) -> path, created if needed
+
+    %BUGGERY_CACHE%, or %LOCALAPPDATA%\\buggery\\cache
+    '''
+    base = os.environ.get("BUGGERY_CACHE")
+    if not base:
+        base = os.path.join(os.environ.get("LOCALAPPDATA") or os.path.expanduser("~"),
+                            "buggery", "cache")
+    path = os.path.join(base, *parts)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+def _arch():
+    return struct.calcsize("P") * 8
+
+def _typelib_key(tlb_file):
+    # anything that changes the generated code has to be in here
+    st = os.stat(tlb_file)
+    key = "%d|%d|%d|%s|%s|%d" % (CACHE_VERSION, st.st_size, int(st.st_mtime),
+                                 sys.version, getattr(comtypes, "__version__", "?"),
+                                 _arch())
+    return hashlib.sha1(key).hexdigest()[:16]
 
 def module_from_tlb(tlb_file):
-    comtypes.client.GetModule(tlb_file)
+    '''module_from_tlb(tlb_file) -> the comtypes.gen wrapper module
+
+    The bindings are generated once into a cache directory keyed on the
+    tlb, the python and the comtypes version, and imported from there
+    (.pyc and all) every time after that.
+    '''
+    gen_dir = cache_dir("gen-" + _typelib_key(tlb_file))
+    if gen_dir not in comtypes.gen.__path__:
+        comtypes.gen.__path__.insert(0, gen_dir)
+
+    name = os.path.splitext(os.path.basename(tlb_file))[0]
+    try:
+        return __import__("comtypes.gen." + name, fromlist=[name])
+    except ImportError:
+        pass
 
-def find_dbg_eng_path():
+    previous = comtypes.client.gen_dir
+    comtypes.client.gen_dir = gen_dir
+    try:
+        comtypes.client.GetModule(tlb_file)
+    finally:
+        comtypes.client.gen_dir = previous
+    return __import__("comtypes.gen." + name, fromlist=[name])
+
+
+DbgEng = module_from_tlb(TLB_FILE)
+
+DBGENG_DLL = None
+DBGHELP_DLL = None
+DBGENG_PATH = None
+
+
+PAGE_SIZE = 0x1000
+PAGE_GUARD = 0x100
+
+
+def virtual_protect(handle, address, size, protect):
+    '''virtual_protect(handle, address, size, protect) -> old protection
+
+    VirtualProtectEx() on the debuggee, handle is the engine's process
+    handle (SystemObjects.get_current_process_handle)
+    '''
+    old = c_ulong()
+    if not windll.kernel32.VirtualProtectEx(c_void_p(handle), c_void_p(address),
+                                            c_size_t(size), protect, byref(old)):
+        raise WinError()
+    return old.value
+
+MEM_COMMIT = 0x1000
+MEM_RESERVE = 0x2000
+
+def virtual_alloc(handle, size, protect, address=None):
+    '''virtual_alloc(handle, size, protect, address=None) -> address
+
+    VirtualAllocEx() in the debuggee, committed. With an address that one
+    is asked for and None is returned if it can't be had.
+    '''
+    alloc = windll.kernel32.VirtualAllocEx
+    alloc.restype = c_void_p
+    base = alloc(c_void_p(handle), c_void_p(address), c_size_t(size),
+                 MEM_COMMIT | MEM_RESERVE, protect)
+    if not base:
+        if address is not None:
+            return None
+        raise WinError()
+    return base
+
+def read_process_memory(handle, address, size):
+    '''read_process_memory(handle, address, size) -> str
+
+    ReadProcessMemory() on the debuggee. Unlike the engine's reads it works
+    while the target runs.
+    '''
+    buf = create_string_buffer(size)
+    done = c_size_t()
+    if not windll.kernel32.ReadProcessMemory(c_void_p(handle), c_void_p(address),
+                                             buf, c_size_t(size), byref(done)):
+        raise WinError()
+    return buf.raw[:done.value]
+
+def _probe_dbg_eng_path():
     def check_registery():
+        import win32api
+        import win32con
         hkey = win32api.RegOpenKey(win32con.HKEY_CURRENT_USER, "Software\\Microsoft\\DebuggingTools")
         val, type = win32api.RegQueryValueEx(hkey, "WinDbg")
         return val
@@ -65,13 +164,45 @@ def find_dbg_eng_path():
                     return testPath
 
     try:
-        dll_path = check_registery()
+        return check_registery()
     except:
-        dll_path = check_common_locations()
-
-    if dll_path is None:
-        raise DebuggerException("Failed to locate Microsoft Debugging Tools in the registry. Please make sure its installed")
-
+        return check_common_locations()
+
+def _is_engine_dir(path):
+    return bool(path) and os.path.isfile(os.path.join(path, "dbgeng.dll"))
+
+def find_dbg_eng_path(refresh=False):
+    '''find_dbg_eng_path(refresh=False) -> directory holding dbgeng.dll
+
+    %BUGGERY_DBGENG_PATH% wins. Otherwise the path found by the last probe
+    is read from the cache, and the registry and the usual install
+    locations are only searched when there is no cached path, it no longer
+    has a dbgeng.dll or refresh is set.
+    '''
+    global DBGENG_PATH
+
+    dll_path = os.environ.get("BUGGERY_DBGENG_PATH")
+    if dll_path:
+        return dll_path
+    if DBGENG_PATH is not None and not refresh:
+        return DBGENG_PATH
+
+    cachefile = os.path.join(cache_dir(), "enginepath-%d-v%d" % (_arch(), CACHE_VERSION))
+    if not refresh and os.path.exists(cachefile):
+        with open(cachefile, "rb") as fp:
+            dll_path = fp.read().strip()
+        if not _is_engine_dir(dll_path):
+            dll_path = None
+
+    if not dll_path:
+        dll_path = _probe_dbg_eng_path()
+        if dll_path is None:
+            raise DebuggerException("Failed to locate Microsoft Debugging Tools in the registry. Please make sure its installed")
+        if _is_engine_dir(dll_path):
+            with open(cachefile, "wb") as fp:
+                fp.write(dll_path)
+
+    DBGENG_PATH = dll_path
     return dll_path
 
 def load_dbgeng_dlls():
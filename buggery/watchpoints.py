@@ -0,0 +1,279 @@
+import bisect
+
+import idebug
+import utils
+
+
+STATUS_GUARD_PAGE_VIOLATION = 0x80000001
+
+# ExceptionInformation[0] of an access fault
+_ACCESS_MODE = {0: 'r', 1: 'w', 8: 'x'}
+
+
+class IntervalIndex(object):
+    '''Sorted index of [start, end) ranges, ranges may overlap.
+
+    find(address) bisects on the start offsets and only walks back as far
+    as the longest range could reach.
+    '''
+    def __init__(self):
+        self._starts = []
+        self._entries = []
+        self._maxlen = 0
+
+    def __len__(self):
+        return len(self._entries)
+    def __iter__(self):
+        return iter(self._entries)
+
+    def add(self, start, end, item):
+        ndx = bisect.bisect_right(self._starts, start)
+        self._starts.insert(ndx, start)
+        self._entries.insert(ndx, (start, end, item))
+        self._maxlen = max(self._maxlen, end - start)
+
+    def remove(self, item):
+        for ndx, (start, end, it) in enumerate(self._entries):
+            if it is item:
+                del self._starts[ndx]
+                del self._entries[ndx]
+                return
+        raise KeyError(item)
+
+    def find(self, address):
+        '''find(address) -> [item, ...] of all ranges containing address'''
+        rv = []
+        ndx = bisect.bisect_right(self._starts, address) - 1
+        lowest = address - self._maxlen
+        while ndx >= 0:
+            start, end, item = self._entries[ndx]
+            if start < lowest:
+                break
+            if address < end:
+                rv.append(item)
+            ndx -= 1
+        return rv
+
+    def overlaps(self, start, end):
+        '''overlaps(start, end) -> True if any range intersects [start, end)'''
+        ndx = bisect.bisect_left(self._starts, end) - 1
+        lowest = start - self._maxlen
+        while ndx >= 0:
+            rstart, rend, item = self._entries[ndx]
+            if rstart < lowest:
+                break
+            if rend > start:
+                return True
+            ndx -= 1
+        return False
+
+
+class WatchedRange(object):
+    def __init__(self, start, size, mode, callback, args, kwargs):
+        self.start = start
+        self.end = start + size
+        self.size = size
+        self.mode = mode
+        self.callback = callback
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.hits = 0
+        self.score = 0.0
+        self.hwbp = None
+
+    @property
+    def hw_capable(self):
+        # debug registers take 1, 2, 4 or 8 naturally aligned bytes
+        return self.size in (1, 2, 4, 8) and not self.start % self.size
+
+    def __repr__(self):
+        where = "hw" if self.hwbp is not None else "page"
+        return "<WatchedRange %x-%x %s %s hits=%d>" % (self.start, self.end,
+                                                       self.mode, where,
+                                                       self.hits)
+
+
+class WatchpointManager(object):
+    '''Any number of watched ranges on top of the four debug registers.
+
+    The hottest hw capable ranges live in the `hw_slots` data breakpoints,
+    everything else is trapped by putting PAGE_GUARD on the pages it covers.
+    A guard fault is matched against an interval index of the watched
+    ranges; after the faulting instruction has been single stepped the guard
+    is put back. The target is only resumed after that step if the step
+    was the only thing that stopped it: a callback returning BREAK, another
+    event during the step or a step somebody else asked for leave it
+    stopped.
+
+    Every `rebalance_every` page hits the hit scores (decayed by half each
+    time) decide which ranges get promoted to hardware.
+    '''
+    def __init__(self, dbg, hw_slots=4, rebalance_every=64):
+        self.dbg = dbg
+        self.hw_slots = hw_slots
+        self.rebalance_every = rebalance_every
+        self.ranges = []
+        self.index = IntervalIndex()
+        self.page_hits = 0
+        self.false_hits = 0
+
+        self._pages = {}            # page -> [refcount, original protection]
+        self._rearm = []
+        self._stepping = False
+        self._step_mark = None
+        self._break = False
+        self._hits_since_rebalance = 0
+
+        dbg.add_hook('EXCEPTION', self._on_exception)
+        dbg.add_poller(self._poll)
+
+    def _process_handle(self):
+        return self.dbg.systemobjects.get_current_process_handle()
+
+    def watch(self, address, size, callback, mode='w', args=None, kwargs=None):
+        wr = WatchedRange(address, size, mode, callback, args, kwargs)
+        self.ranges.append(wr)
+        self.index.add(wr.start, wr.end, wr)
+
+        used = len([r for r in self.ranges if r.hwbp is not None])
+        if wr.hw_capable and used < self.hw_slots:
+            self._to_hardware(wr)
+        else:
+            self._guard(wr)
+        return wr
+
+    def unwatch(self, wr):
+        if wr.hwbp is not None:
+            self._from_hardware(wr)
+        else:
+            self._unguard(wr)
+        self.index.remove(wr)
+        self.ranges.remove(wr)
+
+    # hardware slots
+    def _to_hardware(self, wr):
+        wr.hwbp = self.dbg.watchpoint(wr.start, wr.size, self._on_hw_hit,
+                                      mode=wr.mode, args=(wr,))
+
+    def _from_hardware(self, wr):
+        self.dbg.remove_breakpoint(wr.hwbp)
+        wr.hwbp = None
+
+    def _on_hw_hit(self, bp, wr):
+        wr.hits += 1
+        wr.score += 1
+        return wr.callback(wr, wr.start, *wr.args, **wr.kwargs)
+
+    # guard pages
+    def _page_span(self, wr):
+        first = wr.start & ~(utils.PAGE_SIZE - 1)
+        return xrange(first, wr.end, utils.PAGE_SIZE)
+
+    def _guard(self, wr):
+        handle = self._process_handle()
+        for page in self._page_span(wr):
+            entry = self._pages.get(page)
+            if entry is not None:
+                entry[0] += 1
+                continue
+            protect = self.dbg.dataspaces.query(page).protect
+            if protect & utils.PAGE_GUARD:
+                # somebody else's guard page (stack), leave it be
+                self._pages[page] = [1, None]
+                continue
+            utils.virtual_protect(handle, page, utils.PAGE_SIZE,
+                                  protect | utils.PAGE_GUARD)
+            self._pages[page] = [1, protect]
+
+    def _unguard(self, wr):
+        handle = self._process_handle()
+        for page in self._page_span(wr):
+            entry = self._pages[page]
+            entry[0] -= 1
+            if entry[0]:
+                continue
+            del self._pages[page]
+            if entry[1] is not None:
+                utils.virtual_protect(handle, page, utils.PAGE_SIZE, entry[1])
+            if page in self._rearm:
+                self._rearm.remove(page)
+
+    def _on_exception(self, event):
+        if event.code != STATUS_GUARD_PAGE_VIOLATION or len(event.information) < 2:
+            return None
+        address = event.information[1]
+        page = address & ~(utils.PAGE_SIZE - 1)
+        entry = self._pages.get(page)
+        if entry is None or entry[1] is None:
+            return None
+
+        access = _ACCESS_MODE.get(event.information[0], 'r')
+        hit = [wr for wr in self.index.find(address)
+               if wr.hwbp is None and access in wr.mode]
+
+        # the fault cleared the guard, step over the access and put it back
+        self._rearm.append(page)
+        self._stepping = True
+        self._step_mark = (self.dbg.waits, self.dbg._events.delivered)
+        self._break = False
+        self.dbg.control.set_execution_status(idebug.DbgEng.DEBUG_STATUS_STEP_INTO)
+
+        if not hit:
+            self.false_hits += 1
+            return idebug.GO_HANDLED
+
+        self.page_hits += 1
+        self._hits_since_rebalance += 1
+        for wr in hit:
+            wr.hits += 1
+            wr.score += 1
+            status = wr.callback(wr, address, *wr.args, **wr.kwargs)
+            if status == idebug.DbgEng.DEBUG_STATUS_BREAK:
+                self._break = True
+        return idebug.GO_HANDLED
+
+    def _poll(self):
+        if not self._stepping:
+            return
+        control = self.dbg.control
+        if control.get_execution_status() != idebug.DbgEng.DEBUG_STATUS_BREAK:
+            # the wait timed out before the step was done
+            return
+        self._stepping = False
+
+        handle = self._process_handle()
+        for page in self._rearm:
+            entry = self._pages.get(page)
+            if entry is not None and entry[1] is not None:
+                utils.virtual_protect(handle, page, utils.PAGE_SIZE,
+                                      entry[1] | utils.PAGE_GUARD)
+        self._rearm = []
+
+        if self._hits_since_rebalance >= self.rebalance_every:
+            self.rebalance()
+
+        # the stop is our step's if it came in the wait the fault did and
+        # no other event was delivered since
+        if self._break or self._step_mark != (self.dbg.waits,
+                                              self.dbg._events.delivered):
+            return
+        control.set_execution_status(idebug.DbgEng.DEBUG_STATUS_GO)
+
+    def rebalance(self):
+        '''Move the highest scoring hw capable ranges into the debug registers'''
+        self._hits_since_rebalance = 0
+        capable = [wr for wr in self.ranges if wr.hw_capable]
+        capable.sort(key=lambda wr: wr.score, reverse=True)
+        wanted = set(id(wr) for wr in capable[:self.hw_slots])
+
+        for wr in capable:
+            if wr.hwbp is not None and id(wr) not in wanted:
+                self._from_hardware(wr)
+                self._guard(wr)
+        for wr in capable[:self.hw_slots]:
+            if wr.hwbp is None:
+                self._unguard(wr)
+                self._to_hardware(wr)
+
+        for wr in self.ranges:
+            wr.score /= 2.0
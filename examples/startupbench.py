@@ -0,0 +1,64 @@
+#!c:\python27\python.exe
+'''Time how long a fresh process takes to get to a usable Debugger.
+
+    startupbench.py [runs] [--cold]
+
+Every run is a new interpreter (the harness workers pay exactly this), and
+each step is timed on its own: `import buggery`, first use of idebug
+(comtypes + the DbgEng bindings) and the first Debugger() (finding and
+loading the engine). --cold empties the cache before every run.
+'''
+import os
+import sys
+import shutil
+import subprocess
+
+CHILD = r'''
+import time
+t0 = time.time()
+import buggery
+t1 = time.time()
+buggery.idebug
+t2 = time.time()
+buggery.Debugger()
+t3 = time.time()
+print "%f %f %f" % (t1 - t0, t2 - t1, t3 - t2)
+'''
+
+STEPS = ("import buggery", "bindings", "Debugger()")
+
+
+def run_once(env):
+    out = subprocess.check_output([sys.executable, "-c", CHILD], env=env)
+    return [float(v) for v in out.split()[-3:]]
+
+def main(args):
+    cold = "--cold" in args
+    args = [a for a in args if a != "--cold"]
+    runs = int(args[0]) if args else 10
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    cache = env.get("BUGGERY_CACHE")
+
+    results = []
+    for i in xrange(runs):
+        if cold:
+            if cache is None:
+                cache = env["BUGGERY_CACHE"] = os.path.abspath("startupbench.cache")
+            shutil.rmtree(cache, ignore_errors=True)
+        results.append(run_once(env))
+
+    print "%d %s runs" % (runs, "cold" if cold else "warm")
+    print "%-16s %10s %10s %10s" % ("", "min ms", "median ms", "max ms")
+    for i, step in enumerate(STEPS + ("total",)):
+        if i < len(STEPS):
+            times = sorted(r[i] for r in results)
+        else:
+            times = sorted(sum(r) for r in results)
+        print "%-16s %10.1f %10.1f %10.1f" % (step, times[0] * 1000,
+                                              times[len(times) // 2] * 1000,
+                                              times[-1] * 1000)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
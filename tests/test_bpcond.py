@@ -0,0 +1,80 @@
+import unittest
+
+from buggery import bpcond
+
+
+class CompileConditionTest(unittest.TestCase):
+    def check(self, source, expected, registers=None):
+        self.assertEqual(bpcond.compile_condition(source, registers), expected)
+
+    def test_registers_and_numbers(self):
+        self.check("rax", "(@rax != 0)")
+        self.check("RCX == 16", "(@rcx == 0x10)")
+        self.check("tid == 0x1a4", "(@$tid == 0x1a4)")
+        self.check("pc == sp", "(@$ip == @$csp)")
+
+    def test_and_or(self):
+        self.check("rcx == 0x10 and [rdx+8] != 0",
+                   "((@rcx == 0x10) and (poi((@rdx + 0x8)) != 0x0))")
+        # bare values are turned into 0/1 first, MASM's and/or are bitwise
+        self.check("rax or rbx", "((@rax != 0) or (@rbx != 0))")
+
+    def test_chained_compare(self):
+        self.check("1 < rax <= 5", "((0x1 < @rax) and (@rax <= 0x5))")
+        self.check("0 == rax == rbx != 3",
+                   "((0x0 == @rax) and (@rax == @rbx) and (@rbx != 0x3))")
+
+    def test_not(self):
+        self.check("not rax", "(@rax == 0)")
+        self.check("not (rax == 1)", "((@rax == 0x1) == 0)")
+        self.check("not rax and rbx", "((@rax == 0) and (@rbx != 0))")
+
+    def test_unary_and_binary(self):
+        self.check("-rax + 3", "(((-@rax) + 0x3) != 0)")
+        self.check("~rax", "((@rax ^ 0xffffffffffffffff) != 0)")
+        self.check("rax // 2 >> 1 == rbx % 4",
+                   "(((@rax / 0x2) >> 0x1) == (@rbx % 0x4))")
+
+    def test_derefs(self):
+        self.check("[rsp] == 0", "(poi(@rsp) == 0x0)")
+        self.check("[[rsp+8]] == 0", "(poi(poi((@rsp + 0x8))) == 0x0)")
+        self.check("dword[esp+4] > 0x100", "(dwo((@esp + 0x4)) > 0x100)")
+        self.check("byte[rax] == word[rbx]", "(by(@rax) == wo(@rbx))")
+        self.check("qword[rax] == ptr[rbx]", "(qwo(@rax) == poi(@rbx))")
+
+    def test_known_registers(self):
+        self.check("rax == 1", "(@rax == 0x1)", registers=("rax", "rbx"))
+        self.assertRaises(bpcond.ConditionError, bpcond.compile_condition,
+                          "rzx == 1", ("rax", "rbx"))
+
+    def test_bad_input(self):
+        for source in ("rax ==", "rax in (1, 2)", "rax is 1", "f(rax)",
+                       "rax.x", "'a' == rax", "1.5 < rax", "True",
+                       "[rax, rbx] == 0", "xword[rax] == 0", "dword == 0",
+                       "rax @ rbx", "rax if rbx else rcx"):
+            self.assertRaises(bpcond.ConditionError,
+                              bpcond.compile_condition, source)
+
+
+class BreakpointCommandTest(unittest.TestCase):
+    def test_j(self):
+        self.assertEqual(bpcond.breakpoint_command("rax == 1"),
+                         "j (@rax == 0x1) ''; 'gc'")
+        self.assertEqual(bpcond.breakpoint_command("rax == 1", then="r rax; g"),
+                         "j (@rax == 0x1) 'r rax; g'; 'gc'")
+
+    def test_if(self):
+        self.assertEqual(bpcond.breakpoint_command("rax", then="r", style="if"),
+                         ".if (@rax != 0) { r } .else { gc }")
+
+    def test_bad_input(self):
+        self.assertRaises(bpcond.ConditionError, bpcond.breakpoint_command,
+                          "rax", then=".echo 'x'")
+        self.assertRaises(bpcond.ConditionError, bpcond.breakpoint_command,
+                          "rax", style="bp")
+        self.assertRaises(bpcond.ConditionError, bpcond.breakpoint_command,
+                          "rax ==")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import multiprocessing
+
+from buggery import offload
+
+
+# forked workers inherit it, handlers have to be module level
+_results = multiprocessing.Queue()
+
+def _collect(record):
+    _results.put((record.tag, record.tid, record.registers, record.memory))
+
+
+class _SystemObjects(object):
+    def get_event_thread(self):
+        return 7
+
+class _Debugger(object):
+    systemobjects = _SystemObjects()
+
+
+class RecordTest(unittest.TestCase):
+    def test_roundtrip(self):
+        data = offload.pack_record(3, 0x1a4, 1.5, [1, 2 ** 64 - 1], ["abc", ""])
+        record = offload.unpack_record(data)
+        self.assertEqual(record, offload.Record(3, 0x1a4, 1.5, (1, 2 ** 64 - 1),
+                                                ["abc", ""]))
+        record = offload.unpack_record(data, ("rcx", "rdx"))
+        self.assertEqual(record.registers, {"rcx": 1, "rdx": 2 ** 64 - 1})
+
+    def test_limit_cuts_the_last_buffers_first(self):
+        full = offload.pack_record(1, 2, 0.0, [5], ["a" * 10, "b" * 10])
+        data = offload.pack_record(1, 2, 0.0, [5], ["a" * 10, "b" * 10],
+                                   limit=len(full) - 15)
+        self.assertEqual(len(data), len(full) - 15)
+        self.assertEqual(offload.unpack_record(data).memory, ["a" * 5, ""])
+
+    def test_limit_leaves_short_records_alone(self):
+        full = offload.pack_record(1, 2, 0.0, [5], ["abc"])
+        self.assertEqual(offload.pack_record(1, 2, 0.0, [5], ["abc"],
+                                             limit=len(full)), full)
+
+
+class RingBufferTest(unittest.TestCase):
+    def test_put_get(self):
+        ring = offload.RingBuffer(4, 64)
+        self.assertTrue(ring.put("one"))
+        self.assertTrue(ring.put(""))
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(ring.get(0), "one")
+        self.assertEqual(ring.get(0), "")
+        self.assertEqual(ring.get(0), None)
+        self.assertEqual((ring.produced, ring.consumed, ring.dropped), (2, 2, 0))
+
+    def test_wraparound(self):
+        ring = offload.RingBuffer(3, 32)
+        out = []
+        for i in xrange(10):
+            self.assertTrue(ring.put("record %d" % i))
+            if i % 2:
+                out.append(ring.get(0))
+                out.append(ring.get(0))
+        self.assertEqual(out, ["record %d" % i for i in xrange(10)])
+        self.assertEqual(len(ring), 0)
+
+    def test_full_ring_drops(self):
+        ring = offload.RingBuffer(2, 32)
+        self.assertTrue(ring.put("a"))
+        self.assertTrue(ring.put("b"))
+        self.assertFalse(ring.put("c"))
+        self.assertFalse(ring.put("d", block=True, timeout=0.01))
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual(ring.get(0), "a")
+        self.assertTrue(ring.put("e"))
+        self.assertEqual([ring.get(0), ring.get(0)], ["b", "e"])
+
+    def test_oversize_records_are_dropped(self):
+        ring = offload.RingBuffer(2, 32)
+        self.assertTrue(ring.put("x" * ring.room))
+        self.assertFalse(ring.put("x" * (ring.room + 1)))
+        self.assertEqual(ring.dropped, 1)
+        self.assertEqual(ring.produced, 1)
+        self.assertEqual(ring.get(0), "x" * ring.room)
+        self.assertEqual(ring.get(0), None)
+
+
+class OffloaderTest(unittest.TestCase):
+    def test_submit_shortens_memory_to_fit(self):
+        ring = offload.RingBuffer(2, 64)
+        off = offload.Offloader(_Debugger(), ring)
+        self.assertTrue(off.submit(1, [1, 2], ["m" * 100]))
+        self.assertEqual(ring.truncated, 1)
+        record = offload.unpack_record(ring.get(0))
+        self.assertEqual(record.tid, 7)
+        self.assertEqual(record.registers, (1, 2))
+        self.assertTrue(0 < len(record.memory[0]) < 100)
+
+    def test_submit_leaves_small_records_alone(self):
+        ring = offload.RingBuffer(2, 64)
+        off = offload.Offloader(_Debugger(), ring)
+        self.assertTrue(off.submit(1, [1], ["abc"]))
+        self.assertEqual(ring.truncated, 0)
+        self.assertEqual(offload.unpack_record(ring.get(0)).memory, ["abc"])
+
+    def test_reserved_tag(self):
+        off = offload.Offloader(_Debugger(), offload.RingBuffer(2, 64))
+        self.assertRaises(RuntimeError, off.capture, offload._STOP)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_stop_drains_the_ring(self):
+        ring = offload.RingBuffer(16, 64)
+        pool = offload.WorkerPool(ring, {1: _collect}, workers=3,
+                                  regnames={1: ("rax",)})
+        pool.start()
+        for i in xrange(200):
+            data = offload.pack_record(1 if i % 4 else 2, i, 0.0, [i], ["%d" % i])
+            self.assertTrue(ring.put(data, block=True, timeout=5))
+        pool.stop(timeout=10)
+        self.assertEqual(pool.workers, [])
+
+        got = sorted(_results.get(timeout=5) for i in xrange(150))
+        # tag 2 has no handler, those are read and skipped
+        self.assertEqual(got, [(1, i, {"rax": i}, ["%d" % i])
+                               for i in xrange(200) if i % 4])
+        self.assertTrue(_results.empty())
+        self.assertEqual(ring.consumed, ring.produced)
+        self.assertEqual(len(ring), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+import socket
+import struct
+import threading
+import unittest
+from collections import namedtuple
+
+from buggery import rpc
+
+
+Breakpoint = namedtuple("Breakpoint", "id, address")
+Module = namedtuple("Module", "moduleName, baseOffset")
+
+
+class StandInDebugger(object):
+    '''Just enough of a Debugger for the server: memory at BASE, a few
+    registers, breakpoints that go off when hit() says so and hooks that
+    fire() calls.'''
+    BASE = 0x1000
+
+    def __init__(self):
+        self.memory = bytearray(0x1000)
+        self.registers = {"rip": 0x1000, "rsp": 0x2000}
+        self.bps = {}
+        self.hooks = {}
+        self.statuses = []
+        self.dataspaces = self
+        self.control = self
+        self._events = self
+        self._next_id = 0
+
+    # DataSpaces
+    def read(self, address, size):
+        start = address - self.BASE
+        if start < 0 or start + size > len(self.memory):
+            raise RuntimeError("Can't read 0x%x" % address)
+        return str(self.memory[start:start+size])
+
+    def write(self, address, data):
+        start = address - self.BASE
+        self.memory[start:start+len(data)] = data
+        return len(data)
+
+    # Control
+    def set_execution_status(self, status):
+        self.statuses.append(status)
+
+    # breakpoints
+    def breakpoint(self, address, callback, oneshot=False, condition=None):
+        bp = Breakpoint(self._next_id, address)
+        self._next_id += 1
+        self.bps[bp.id] = (bp, callback, oneshot)
+        return bp
+
+    def remove_breakpoint(self, bpid):
+        del self.bps[bpid]
+
+    def hit(self, bpid):
+        bp, callback, oneshot = self.bps[bpid]
+        if oneshot:
+            del self.bps[bpid]
+        return callback(bp)
+
+    # hooks
+    def add_hook(self, eventtype, hook):
+        self.hooks.setdefault(eventtype, []).append(hook)
+
+    def remove_hook(self, eventtype, hook):
+        self.hooks[eventtype].remove(hook)
+
+    def fire(self, eventtype, event):
+        for hook in self.hooks.get(eventtype, ()):
+            hook(event)
+
+    def execute(self, cmd):
+        return "ran %s" % cmd
+
+    def wait_for_event(self, timeout_ms):
+        return False
+
+
+def _op_hit(server, conn, bpid):
+    return server.dbg.hit(bpid)
+
+def _op_fire(server, conn, eventtype, name):
+    server.dbg.fire(eventtype, Module(name, 0x400000))
+
+
+class CodecTest(unittest.TestCase):
+    def test_roundtrip(self):
+        values = [None, True, False, 0, -1, 2 ** 63 - 1, -2 ** 63, 2 ** 64 - 1,
+                  1.5, "", "\0\xff bytes", u"\xe9t\xe9", [], [1, [2, "x"]],
+                  {"a": [None], 1: {2: 3}}]
+        for value in values:
+            self.assertEqual(rpc.decode(rpc.encode(value)), value)
+        self.assertEqual(rpc.decode(rpc.encode((1, 2))), [1, 2])
+
+    def test_bad_values(self):
+        self.assertRaises(rpc.ProtocolError, rpc.encode, 2 ** 64)
+        self.assertRaises(rpc.ProtocolError, rpc.encode, object())
+        for data in ("", "q\0\0", "l\0\0\0\x02N", "NN", "?"):
+            self.assertRaises(rpc.ProtocolError, rpc.decode, data)
+
+
+class FrameReaderTest(unittest.TestCase):
+    def test_frames_split_anywhere(self):
+        stream = (rpc.pack_frame(rpc.REQUEST, 1, [["ping", 1]]) +
+                  rpc.pack_frame(rpc.EVENT, 0, "x" * 100000) +
+                  rpc.pack_frame(rpc.RESPONSE, 2, None))
+        for step in (1, 7, 4096, len(stream)):
+            reader = rpc.FrameReader()
+            frames = []
+            for i in xrange(0, len(stream), step):
+                frames.extend(reader.feed(stream[i:i+step]))
+            self.assertEqual(frames, [(rpc.REQUEST, 1, [["ping", 1]]),
+                                      (rpc.EVENT, 0, "x" * 100000),
+                                      (rpc.RESPONSE, 2, None)])
+
+    def test_bad_length(self):
+        reader = rpc.FrameReader()
+        self.assertRaises(rpc.ProtocolError, reader.feed, struct.pack(">I", 2))
+        reader = rpc.FrameReader()
+        self.assertRaises(rpc.ProtocolError, reader.feed,
+                          struct.pack(">I", rpc.MAX_FRAME + 1))
+
+    def test_bad_body(self):
+        reader = rpc.FrameReader()
+        self.assertRaises(rpc.ProtocolError, reader.feed,
+                          struct.pack(">IBI", 6, rpc.REQUEST, 1) + "?")
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dbg = StandInDebugger()
+        self.server = rpc.RPCServer(self.dbg, ("127.0.0.1", 0), token="sesame")
+        self.server.register("hit", _op_hit)
+        self.server.register("fire", _op_fire)
+        self.address = self.server.sock.getsockname()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        self.clients = []
+
+    def _serve(self):
+        while not self._stop.is_set():
+            self.server.poll(0.01)
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self._stop.set()
+        self._thread.join(5)
+        self.server.close()
+
+    def client(self, token="sesame"):
+        client = rpc.RPCClient(self.address, token)
+        self.clients.append(client)
+        return client
+
+    def raw(self, data):
+        '''send data on a fresh connection -> frames received until EOF'''
+        sock = socket.create_connection(self.address)
+        sock.settimeout(5)
+        sock.sendall(data)
+        reader = rpc.FrameReader()
+        frames = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            frames.extend(reader.feed(chunk))
+        sock.close()
+        return frames
+
+    def test_batch(self):
+        client = self.client()
+        results = client.call([["write", 0x1010, "hello"],
+                               ["read", 0x1010, 5],
+                               ["readv", [[0x1010, 2], [0x1013, 2]]],
+                               ["regs", ["rip", "rsp"]],
+                               ["setreg", "rip", 0x1234],
+                               ["execute", "lm"],
+                               ["read", 0, 4],
+                               ["nope"],
+                               ["ping", 1, "two"]], timeout=5)
+        self.assertEqual(results[:6], [[True, 5], [True, "hello"],
+                                       [True, ["he", "lo"]],
+                                       [True, [0x1000, 0x2000]],
+                                       [True, None], [True, "ran lm"]])
+        self.assertEqual(results[6][0], False)
+        self.assertIn("RuntimeError", results[6][1])
+        self.assertEqual(results[7], [False, "Unknown operation: nope"])
+        self.assertEqual(results[8], [True, [1, "two"]])
+        self.assertEqual(self.dbg.registers["rip"], 0x1234)
+
+    def test_pipelining(self):
+        client = self.client()
+        ids = [client.submit([["ping", i]]) for i in xrange(50)]
+        big = client.submit([["read", 0x1000, 0x1000]])
+        for i, reqid in reversed(list(enumerate(ids))):
+            self.assertEqual(client.wait(reqid, 5), [[True, [i]]])
+        self.assertEqual(client.wait(big, 5), [[True, "\0" * 0x1000]])
+
+    def test_events(self):
+        client = self.client()
+        bpid = client.call([["bp", 0x1000]], 5)[0][1]
+        client.call([["subscribe", ["LOADMODULE"]],
+                     ["hit", bpid],
+                     ["fire", "LOADMODULE", "kernel32"],
+                     ["fire", "UNLOADMODULE", "kernel32"]], 5)
+        self.assertEqual(client.next_event(5), ["BREAKPOINT", {"id": bpid}])
+        self.assertEqual(client.next_event(5),
+                         ["LOADMODULE", {"moduleName": "kernel32",
+                                         "baseOffset": 0x400000}])
+        self.assertEqual(client.next_event(0.1), None)
+
+    def test_go(self):
+        client = self.client()
+        self.assertEqual(client.call([["go"]], 5), [[True, None]])
+        self.assertEqual(self.dbg.statuses, [rpc.DEBUG_STATUS_GO])
+        self.assertTrue(self.server.running)
+        client.call([["break"]], 5)
+        self.assertFalse(self.server.running)
+
+    def test_close_removes_breakpoints_and_subscriptions(self):
+        other = self.client()
+        other.call([["subscribe", ["LOADMODULE"]], ["bp", 0x2000]], 5)
+        client = self.client()
+        client.call([["bp", 0x1000], ["bp", 0x1004, True],
+                     ["subscribe", ["LOADMODULE", "EXITPROCESS"]]], 5)
+        # a one shot that went off isn't the connection's to remove
+        client.call([["hit", 2]], 5)
+        self.assertEqual(sorted(self.dbg.bps), [0, 1])
+        client.close()
+        other.call([["ping"]], 5)
+        for i in xrange(100):
+            if len(self.server._conns) == 1:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(sorted(self.dbg.bps), [0])
+        self.assertEqual(len(self.dbg.hooks["LOADMODULE"]), 1)
+        self.assertEqual(self.dbg.hooks["EXITPROCESS"], [])
+
+    def test_wrong_token(self):
+        client = self.client("open up")
+        self.assertRaises(rpc.ProtocolError, client.call, [["ping"]], 5)
+        self.assertEqual(self.dbg.bps, {})
+
+    def test_request_before_hello(self):
+        frames = self.raw(rpc.pack_frame(rpc.REQUEST, 1, [["bp", 0x1000]]))
+        self.assertEqual([kind for kind, reqid, value in frames], [rpc.ERROR])
+        self.assertEqual(self.dbg.bps, {})
+
+    def test_garbage_closes(self):
+        frames = self.raw(rpc.pack_frame(rpc.HELLO, 0, "sesame") +
+                          struct.pack(">I", 3) + "junk")
+        self.assertEqual([kind for kind, reqid, value in frames], [rpc.ERROR])
+
+
+if __name__ == '__main__':
+    unittest.main()